@@ -0,0 +1,114 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+
+from apps.static_report.cache import lookup_cache
+from apps.static_report.dao_services import IntegrityDaoService, ReportViewDaoService
+from apps.static_report.services import TsNAPStaticReportService, audit_writes, log_summary, refresh_views
+from apps.static_report.sharding import merge_summaries
+from http_client import http_client
+from profiler import profiler
+from rate_limiter import api_limiter
+from response_cache import response_cache
+from settings import BACKFILL_QUARTER_CONCURRENCY, TSNAP_WRITE_BATCH_SIZE
+from sql_audit import sql_audit
+
+logger = logging.getLogger(__name__)
+
+SHARED_COUNTERS = ('requests', 'response_cache', 'api_concurrency', 'sql')
+
+
+class BackfillService:
+    """
+    Syncs a range of quarters, several at a time.
+
+    Every quarter is a regular checkpointed sync run in its own thread, with its own database sessions. The
+    quarters share the HTTP client, the DIIA API limiter, the response cache and the lookup cache, so the
+    ASC organizations, TsNAPs and general data that repeat from quarter to quarter are looked up once.
+
+    Fetching from the API overlaps freely; writing does not: the quarters take turns through a shared lock,
+    one transaction at a time, because they upsert the same rows. TsNAP rows hold the latest state of a
+    TsNAP, so the newest quarter of the range is synced after all the others have finished and has the
+    last word.
+    """
+    def __init__(self, quarter_concurrency: int = BACKFILL_QUARTER_CONCURRENCY, **service_options):
+        """
+        :param quarter_concurrency: Number of quarters synced at the same time.
+        :param service_options: Keyword arguments for `TsNAPStaticReportService`. Unless given, a quarter
+            commits after every write batch, so that it holds the write lock only while writing.
+        """
+        self.quarter_concurrency = max(quarter_concurrency, 1)
+        self.service_options = {'commit_batch_size': TSNAP_WRITE_BATCH_SIZE, **service_options}
+        self.write_lock = threading.Lock()
+        self.report_view_dao_service = ReportViewDaoService()
+        self.integrity_dao_service = IntegrityDaoService()
+
+    def backfill(self, quarters: List[Tuple[int, int]], resume: bool = False, retry_failed: bool = False) -> dict:
+        """
+        Syncs all ODA reports of the given quarters.
+
+        A quarter that fails does not stop the others: its sync run stays unfinished and can be resumed.
+
+        :param quarters: `(year, quarter)` pairs.
+        :param resume: Continue the last unfinished run of every quarter, skipping the items it finished.
+        :param retry_failed: Continue the last unfinished run of every quarter, syncing only the ODA reports
+            with failed items.
+
+        :return dict: The merged summary of all quarters.
+        """
+        *older, newest = sorted(set(quarters))
+        summaries, failed_quarters = [], []
+        try:
+            with ThreadPoolExecutor(max_workers=self.quarter_concurrency, thread_name_prefix='quarter') as executor:
+                futures = {executor.submit(self.sync_quarter, year, quarter, resume, retry_failed): (year, quarter)
+                           for year, quarter in older}
+                runs = [(futures[future], future.result) for future in as_completed(futures)]
+            runs.append((newest, lambda: self.sync_quarter(*newest, resume, retry_failed)))
+
+            for (year, quarter), sync in runs:
+                try:
+                    summaries.append(sync())
+                except Exception as err:
+                    logger.exception(f'Failed to sync {year} Q{quarter}: {err}')
+                    failed_quarters.append(f'{year} Q{quarter}')
+        finally:
+            logger.info(f'Lookup cache: {lookup_cache.stats()}')
+            lookup_cache.clear()
+
+        summary = merge_summaries([{key: value for key, value in quarter_summary.items() if key not in SHARED_COUNTERS}
+                                   for quarter_summary in summaries])
+        # The HTTP client, the response cache, the API limiter and the SQL audit are shared: their counters cover
+        # all quarters.
+        summary.update(requests=http_client.stats(), response_cache=response_cache.stats(),
+                       api_concurrency=api_limiter.stats(), sql=sql_audit.stats())
+        log_summary(summary)
+        audit_writes(self.integrity_dao_service, summary)
+        if failed_quarters:
+            logger.error(f'Failed quarters: {", ".join(failed_quarters)}')
+        refresh_views(self.report_view_dao_service, summary)
+        return summary
+
+    def sync_quarter(self, year: int, quarter: int, resume: bool = False, retry_failed: bool = False) -> dict:
+        """
+        Syncs one quarter as a checkpointed run.
+
+        :param year: The year of the reports.
+        :param quarter: The quarter (1 to 4) of the reports.
+        :param resume: Continue the last unfinished run of the quarter.
+        :param retry_failed: Continue the last unfinished run, syncing only the ODA reports with failed items.
+
+        :return dict: The summary of the quarter.
+        """
+        service = TsNAPStaticReportService(write_lock=self.write_lock, keep_lookup_cache=True, **self.service_options)
+        try:
+            with profiler.profiling():
+                run_id = service.sync_run_dao_service.start(year, quarter, resume=resume or retry_failed)
+                oda_reports = service.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+
+                service.create_or_update_reports(
+                    service.sync_run_dao_service.pending_reports(oda_reports, retry_failed))
+            logger.info(f'Sync run {run_id} ({year} Q{quarter}): {service.sync_run_dao_service.finish()}')
+            return service.summary()
+        finally:
+            service.close()
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+from settings import LOOKUP_CACHE_MAX_ENTRIES
+
+MISSING = object()
+"""Marks a key that is known to have no row in the database."""
+
+
+class LookupCache:
+    """
+    A thread-safe, size-bounded LRU map from natural keys to primary keys.
+
+    Only ids are cached, never ORM instances, so one cache can be shared by several sessions. When the
+    cache is full the least recently used keys are evicted; callers fall back to the database for them.
+    """
+
+    def __init__(self, max_entries: int = LOOKUP_CACHE_MAX_ENTRIES):
+        """
+        :param max_entries: Maximum number of cached keys.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, table: str, key: Hashable) -> Any:
+        """
+        Looks up the id of a row.
+
+        :param table: The table name.
+        :param key: The natural key value.
+
+        :return: The row id, `MISSING` if the row is known not to exist, or None if the key is not cached.
+        """
+        with self._lock:
+            value = self._entries.get((table, key))
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end((table, key))
+            self.hits += 1
+            return value
+
+    def set(self, table: str, key: Hashable, value: Any):
+        """
+        Caches the id of a row.
+
+        :param table: The table name.
+        :param key: The natural key value.
+        :param value: The row id, or `MISSING`.
+        """
+        self.set_many(table, {key: value})
+
+    def set_many(self, table: str, values: Dict[Hashable, Any]):
+        """
+        Caches the ids of several rows of one table.
+
+        :param table: The table name.
+        :param values: Row ids (or `MISSING`) keyed by natural key value.
+        """
+        with self._lock:
+            for key, value in values.items():
+                self._entries[(table, key)] = value
+                self._entries.move_to_end((table, key))
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops all cached keys."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache counters.
+
+        :return dict: Number of cached keys, hits and misses.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+lookup_cache = LookupCache()
@@ -0,0 +1,255 @@
+import heapq
+import itertools
+import logging
+import signal
+import threading
+import time
+from contextlib import nullcontext
+from typing import Dict, List, Set, Tuple
+
+from apps.static_report.services import TsNAPStaticReportService, log_summary, refresh_views
+from apps.static_report.types import TSNAPRegion
+from apps.static_report.utils import get_current_quarter, get_current_year
+from settings import DAEMON_MIN_REFRESH_AGE, DAEMON_POLL_INTERVAL, DAEMON_REFRESH_RATE, DAEMON_TICK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# A TsNAP of the queue: the ODA report it is listed in and its asc_org idf.
+Key = Tuple[int, str]
+
+
+class StalenessQueue:
+    """
+    TsNAPs of the current quarter ordered by the time they were last refreshed, the stalest first.
+
+    TsNAPs the daemon has not refreshed yet count as refreshed at 0, so new ones go first. The heap may hold
+    outdated entries of a TsNAP; they are skipped when popped. Not thread-safe: the daemon uses it from one
+    thread.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Key]] = []
+        self._items: Dict[Key, dict] = {}
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def update(self, report_id: int, entries: List[TSNAPRegion]):
+        """
+        Adds the TsNAPs listed in a region, keeping the refresh time of the ones already queued.
+
+        :param report_id: The ID of the ODA report.
+        :param entries: The TsNAPs of the region from `entries/`.
+        """
+        for entry in entries:
+            key = (report_id, entry['asc_org']['idf'])
+            item = self._items.get(key)
+            if item is None:
+                self._items[key] = {'entry': entry, 'refreshed_at': 0.0, 'queued': True}
+                heapq.heappush(self._heap, (0.0, next(self._order), key))
+            else:
+                item['entry'] = entry
+
+    def keys(self, report_id: int) -> Set[Key]:
+        """Returns the queued TsNAPs of an ODA report."""
+        return {key for key in self._items if key[0] == report_id}
+
+    def retain(self, keys: Set[Key]):
+        """
+        Drops the TsNAPs that are no longer listed, e.g. those of the previous quarter.
+
+        :param keys: The TsNAPs to keep.
+        """
+        for key in set(self._items) - keys:
+            del self._items[key]
+
+    def pop_stale(self, count: int, refreshed_before: float) -> List[Tuple[Key, TSNAPRegion]]:
+        """
+        Takes the stalest TsNAPs out of the queue until they are given back with `done`.
+
+        :param count: Maximum number of TsNAPs.
+        :param refreshed_before: Only TsNAPs last refreshed before this time.
+
+        :return list: `(key, entry)` pairs.
+        """
+        stale = []
+        while self._heap and len(stale) < count and self._heap[0][0] < refreshed_before:
+            refreshed_at, _, key = heapq.heappop(self._heap)
+            item = self._items.get(key)
+            if item is None or not item['queued'] or item['refreshed_at'] != refreshed_at:
+                continue
+            item['queued'] = False
+            stale.append((key, item['entry']))
+        return stale
+
+    def done(self, key: Key, refreshed_at: float):
+        """
+        Puts a TsNAP taken by `pop_stale` back into the queue.
+
+        :param key: The TsNAP.
+        :param refreshed_at: When it was refreshed.
+        """
+        item = self._items.get(key)
+        if item is not None:
+            item.update(refreshed_at=refreshed_at, queued=True)
+            heapq.heappush(self._heap, (refreshed_at, next(self._order), key))
+
+
+class SyncDaemon:
+    """
+    Keeps the current quarter up to date continuously instead of syncing it in one burst.
+
+    Every `poll_interval` seconds the ODA reports and the region listings of the current quarter are
+    fetched and saved, and the listed TsNAPs are put into a `StalenessQueue`. In between, every `tick`
+    seconds the daemon refreshes `refresh_rate * tick` of the stalest TsNAPs that were not refreshed for
+    `min_refresh_age` seconds, through the regular write path of `TsNAPStaticReportService`, so the load on
+    the DIIA API and the database stays steady. The materialized views are refreshed after every poll that
+    followed changes.
+
+    SIGTERM and SIGINT stop the daemon once the work in flight is written; a second signal aborts it.
+    """
+
+    def __init__(self, poll_interval: float = DAEMON_POLL_INTERVAL, refresh_rate: float = DAEMON_REFRESH_RATE,
+                 tick: float = DAEMON_TICK_SECONDS, min_refresh_age: float = DAEMON_MIN_REFRESH_AGE,
+                 **service_options):
+        """
+        :param poll_interval: Seconds between two polls of `list/` and `entries/`.
+        :param refresh_rate: TsNAP details refreshed per second.
+        :param tick: Seconds between two refresh batches.
+        :param min_refresh_age: A TsNAP is not refreshed again before this many seconds.
+        :param service_options: Keyword arguments for `TsNAPStaticReportService`.
+        """
+        self.poll_interval = poll_interval
+        self.tick = tick
+        self.batch_size = max(round(refresh_rate * tick), 1)
+        self.min_refresh_age = min_refresh_age
+        self.service = TsNAPStaticReportService(keep_lookup_cache=True, **service_options)
+        self.queue = StalenessQueue()
+        self.stopping = threading.Event()
+        self._changed_since_refresh = 0
+
+    def run(self):
+        """Polls and refreshes until stopped by a signal or `stop`."""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        logger.info(f'Sync daemon started: {self.batch_size} TsNAPs every {self.tick}s, '
+                    f'polling every {self.poll_interval}s.')
+
+        next_poll = 0.0
+        try:
+            while not self.stopping.is_set():
+                started = time.monotonic()
+                if started >= next_poll:
+                    # A poll that fails is retried on the next tick.
+                    if self._survive(self.poll, 'Poll'):
+                        next_poll = time.monotonic() + self.poll_interval
+                    started = time.monotonic()
+                self._survive(self.refresh, 'Refresh')
+                self.stopping.wait(max(self.tick - (time.monotonic() - started), 0))
+        finally:
+            self._refresh_views()
+            log_summary(self.service.summary())
+            self.service.close()
+            logger.info('Sync daemon stopped.')
+
+    def stop(self):
+        """Asks the daemon to stop after the work in flight."""
+        self.stopping.set()
+
+    def poll(self):
+        """Saves the ODA reports of the current quarter and queues the TsNAPs listed in their regions."""
+        year, quarter = get_current_year(), get_current_quarter()
+        oda_reports = self.service.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+        if not oda_reports:
+            logger.error(f'No ODA reports for {year} Q{quarter}; keeping the queue.')
+            return
+
+        listed = set()
+        for report in oda_reports:
+            if self.stopping.is_set():
+                return
+            try:
+                with self.service.write_lock or nullcontext():
+                    self.service.oda_report_dao_service.update_or_create(report)
+            except Exception as err:
+                logger.exception(f'Failed to save ODA report {report["id"]}: {err}')
+                self.service.oda_report_dao_service.session.rollback()
+                listed |= self.queue.keys(report['id'])
+                continue
+
+            pages = []
+            entries = list(self.service.sr_dia_api_dao_service.iter_tsnaps_in_region(
+                report['id'], on_page=lambda page, response: pages.append((page, 'results' in response))))
+            self.queue.update(report['id'], entries)
+            listed |= {(report['id'], entry['asc_org']['idf']) for entry in entries}
+            if not all(fetched for _, fetched in pages):
+                # Part of the listing is missing: keep the TsNAPs queued before.
+                listed |= self.queue.keys(report['id'])
+
+        self.queue.retain(listed)
+        logger.info(f'Polled {year} Q{quarter}: {len(oda_reports)} ODA reports, {len(self.queue)} TsNAPs queued.')
+        self._refresh_views()
+        log_summary(self.service.summary())
+
+    def refresh(self):
+        """Fetches and writes the next batch of stale TsNAPs, one transaction per ODA report."""
+        stale = self.queue.pop_stale(self.batch_size, time.time() - self.min_refresh_age)
+        if not stale:
+            return
+
+        # Grouped by the queued entries, so that a detail payload whose idf differs from the listing
+        # still goes to the ODA report it was listed in.
+        by_report: Dict[int, List[TSNAPRegion]] = {}
+        for (report_id, _), entry in stale:
+            by_report.setdefault(report_id, []).append(entry)
+
+        failures = []
+        changed_before = self._changed()
+        try:
+            for report_id, entries in by_report.items():
+                details = list(self.service.fetch_tsnap_details(entries, failures))
+                try:
+                    _, failed = self.service.write_tsnaps(report_id, details)
+                    failures.extend(failed)
+                except Exception as err:
+                    logger.exception(f'Failed to write {len(details)} TsNAPs of ODA report {report_id}: {err}')
+                    failures.extend(tsnap_detail['asc_org']['idf'] for tsnap_detail in details)
+        finally:
+            self._changed_since_refresh += self._changed() - changed_before
+            # TsNAPs that failed wait like the others, so that they do not crowd out the stale ones.
+            refreshed_at = time.time()
+            for key, _ in stale:
+                self.queue.done(key, refreshed_at)
+        if failures:
+            logger.error(f'Failed to refresh TsNAPs: {", ".join(failures)}')
+
+    def _survive(self, step, name: str) -> bool:
+        """
+        Runs a step of the loop, logging an error instead of stopping the daemon, e.g. on a timeout or a lost
+        database connection. The sessions are ended after an error, so that the next step starts cleanly.
+
+        :return bool: Whether the step succeeded.
+        """
+        try:
+            step()
+            return True
+        except Exception as err:
+            logger.exception(f'{name} failed: {err}')
+            self.service.close()
+            return False
+
+    def _changed(self) -> int:
+        counts = self.service.tsnap_report_dao_service.change_counts
+        return counts['new'] + counts['changed']
+
+    def _refresh_views(self):
+        if self._changed_since_refresh:
+            refresh_views(self.service.report_view_dao_service, {'tsnaps': {'changed': self._changed_since_refresh}})
+            self._changed_since_refresh = 0
+
+    def _on_signal(self, signum, frame):
+        if self.stopping.is_set():
+            raise SystemExit(f'Aborted by signal {signum}.')
+        logger.info(f'Signal {signum}: stopping after the work in flight.')
+        self.stop()
@@ -1,26 +1,54 @@
+import io
 import logging
+import math
 from abc import abstractmethod
-from typing import List
+from collections import Counter
+from contextlib import closing, contextmanager
+from datetime import datetime
+from typing import IO, Callable, Collection, Dict, Iterator, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
 
 import requests
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session as SessionType
 
+import json_stream
+from apps.static_report.cache import MISSING, LookupCache, lookup_cache
 from apps.static_report.models import (RSA, ActivityData, Address,
                                        AdminServiceData, ASCOrg, GeneralData,
                                        InfoSupportData, Locality)
 from apps.static_report.models import ODAReport as ODAReportModel
-from apps.static_report.models import RespPersonData, TsNAP
+from apps.static_report.models import RespPersonData, SyncCheckpoint, SyncRun, TsNAP
 from apps.static_report.types import ODAReport, ODAReportRSA, TSNAPDetails, TSNAPRegion
+from apps.static_report.utils import bounded_map, payload_hash
 from database import db
-from settings import DIIA_API_URL
+from http_client import ResponseStream, http_client
+from instrumentation import instrumented
+from metrics import metrics
+from profiler import profiler
+from rate_limiter import AdaptiveLimiter, api_limiter
+from response_cache import response_cache
+from settings import API_STREAM_RESULTS, DB_STREAM_BATCH_SIZE, DIIA_API_URL, ENTRIES_FETCH_CONCURRENCY
+from sql_audit import sql_audit
 
 logger = logging.getLogger(__name__)
 
 class SRDiiaApiDaoService:
-    """A DAO service for receiving data from the DIIA API."""
+    """
+    A DAO service for receiving data from the DIIA API.
+
+    All requests go through `limiter`, which adapts the number of requests in flight to the latency and
+    the throttling responses of the API. With `streaming` on, region pages are decoded item by item while
+    they are downloaded instead of being prefetched whole.
+    """
     base_url: str = f'{DIIA_API_URL}/v1/static_reports'
+    limiter: AdaptiveLimiter = api_limiter
+    streaming: bool = API_STREAM_RESULTS
 
+    @instrumented('pagination')
     def get_oda_reports(self, year: int, quarter: int) -> List[ODAReport]:
         """
         Fetches the list of ODA reports for a specified year and quarter.
@@ -31,46 +59,129 @@ class SRDiiaApiDaoService:
         :return List[ODAReport]: A list of ODA reports for the specified year and quarter.
         """
         logger.info(f'Get ODA Reports: year - {year}, quarter - {quarter}.')
-        return self.make_get_request(f'list/{year}/{quarter}/?format=json').get('results')
+        return self.make_get_request(f'list/{year}/{quarter}/?format=json').get('results', [])
 
-    def get_tsnaps_in_region(self, report_id: int, collected_results: List[TSNAPRegion] = None, page: int=1) -> List[TSNAPRegion]:
+    def get_tsnaps_in_region(self, report_id: int) -> List[TSNAPRegion]:
         """
-        Fetches the list of TsNAPs of the region:.
+        Fetches the list of TsNAPs of the region.
         
         :param report_id: The ID of the ODA report to retrieve TSNAP region data.
-        :param collected_results: A list of TSNAPRegion objects to accumulate results across pages. Default is None, which initializes an empty list.
-        :param page: The current page number for paginated requests. Default is 1.
 
         :return List[TSNAPRegion]: A list of TSNAP regions associated with the specified report ID.
         """
+        return list(self.iter_tsnaps_in_region(report_id))
+
+    def iter_tsnaps_in_region(self, report_id: int, on_page: Optional[Callable[[int, dict], None]] = None,
+                              skip: Collection[str] = ()) -> Iterator[TSNAPRegion]:
+        """
+        Lazily yields the TsNAPs of the region, page by page.
+
+        The total count from the first page tells how many pages there are, so the remaining pages
+        are fetched concurrently and yielded in page order as soon as they arrive. If the API does not
+        report a count, the `next` links are followed one by one instead. In the streaming mode the pages
+        are streamed one after another, see `_stream_pages`.
+
+        :param report_id: The ID of the ODA report to retrieve TSNAP region data.
+        :param on_page: Called with the page number and the response of every fetched page. The response
+            is an empty dict if the page could not be fetched.
+        :param skip: asc_org idfs of TsNAPs not to yield, e.g. those a resumed run has already written.
+
+        :return Iterator[TSNAPRegion]: TSNAP regions associated with the specified report ID.
+        """
         logger.info(f'Get list of TSNAP region: report_id: {report_id}')
+        on_page = on_page or (lambda page, response: None)
+        tsnaps = self._iter_pages(report_id, on_page)
+        if skip:
+            tsnaps = (tsnap for tsnap in tsnaps if tsnap['asc_org']['idf'] not in skip)
+        # Waiting for the prefetched pages counts as pagination too, not as the stage of the consumer.
+        return profiler.stage_iter('pagination', tsnaps)
+
+    def _iter_pages(self, report_id: int, on_page: Callable[[int, dict], None]) -> Iterator[TSNAPRegion]:
+        if self.streaming:
+            yield from self._stream_pages(report_id, on_page)
+            return
+
+        first_page = self.get_tsnaps_page(report_id, 1)
+        on_page(1, first_page)
+        results = first_page.get('results', [])
+        yield from results
+
+        if not first_page.get('next'):
+            return
+
+        count = first_page.get('count')
+        if count is None or not results:
+            yield from self._follow_next_pages(report_id, first_page['next'], on_page)
+            return
+
+        page_count = math.ceil(count / len(results))
+        page_numbers = range(2, page_count + 1)
+        pages = bounded_map(lambda page: self.get_tsnaps_page(report_id, page), page_numbers, ENTRIES_FETCH_CONCURRENCY)
+        for page_number, page in zip(page_numbers, pages):
+            on_page(page_number, page)
+            yield from page.get('results', [])
+
+    @instrumented('pagination')
+    def get_tsnaps_page(self, report_id: int, page: int) -> dict:
+        """
+        Fetches a single page of the TsNAPs of the region.
+
+        :param report_id: The ID of the ODA report.
+        :param page: The page number, starting from 1.
+
+        :return dict: The page with the 'count', 'next' and 'results' fields, or an empty dict on error.
+        """
+        return self.make_get_request(f'entries/{report_id}?page={page}')
 
-        if collected_results is None:
-            collected_results = []
+    def _stream_pages(self, report_id: int, on_page: Callable[[int, dict], None]) -> Iterator[TSNAPRegion]:
+        """
+        Streams the pages one after another, yielding every TsNAP as soon as it is decoded.
 
-        entries = self.make_get_request(f'entries/{report_id}?page={page}')
-        collected_results.extend(entries.get('results', []))
+        Nothing is prefetched, so memory stays constant however large the region is, at the price of
+        fetching the pages sequentially. The page count is taken from the first page; without it the
+        `next` links are followed.
 
-        next_url = entries.get('next')
+        :param report_id: The ID of the ODA report.
+        :param on_page: Called with the page number and the response of every page, without its results
+            (see `iter_results`).
 
-        if next_url:
-            query_params = self._get_query_params(next_url)
-            return self.get_tsnaps_in_region(report_id, collected_results, query_params.get('page'))
+        :return Iterator[TSNAPRegion]: TSNAP regions associated with the specified report ID.
+        """
+        page, page_count = 1, None
+        while page_count is None or page <= page_count:
+            meta = {}
+            yield from self.iter_results(f'entries/{report_id}?page={page}', meta)
+            on_page(page, meta)
 
-        return collected_results
+            if page == 1 and meta.get('count') is not None and meta.get('results'):
+                page_count = math.ceil(meta['count'] / meta['results'])
+            elif page_count is None and not meta.get('next'):
+                return
+            page += 1
 
-    def _get_query_params(self, url: str) -> dict:
+    def _follow_next_pages(self, report_id: int, next_url: str,
+                           on_page: Callable[[int, dict], None]) -> Iterator[TSNAPRegion]:
         """
-        Retrieve all query params from url.
+        Walks the pages sequentially by their `next` links.
 
-        :param url: url to parse.
+        :param report_id: The ID of the ODA report.
+        :param next_url: The `next` link of the first page.
+        :param on_page: Called with the page number and the response of every fetched page.
 
-        :return dict: query params.
+        :return Iterator[TSNAPRegion]: TSNAP regions from the second page on.
         """
-        query_params = url.split('?')[1]
-        return dict(param.split('=') for param in query_params.split('&') if '=' in param)
+        while next_url:
+            page = parse_qs(urlsplit(next_url).query).get('page', [None])[0]
+            if page is None:
+                logger.error(f'No page number in the next link: {next_url}')
+                return
 
+            entries = self.get_tsnaps_page(report_id, int(page))
+            on_page(int(page), entries)
+            yield from entries.get('results', [])
+            next_url = entries.get('next')
 
+    @instrumented('detail_fetch')
     def get_tsnap_details(self, report_entries_id: int) -> List[TSNAPDetails]:
         """
         Fetches detailed data for a specific TSNAP report entry.
@@ -82,33 +193,194 @@ class SRDiiaApiDaoService:
         logger.info(f'Get list of TSNAP details: report_entries_id: {report_entries_id}.')
         return self.make_get_request(f'detail/{report_entries_id}').get('results')
 
-    def make_get_request(self, url: str) -> list:
+    def make_get_request(self, url: str) -> dict:
         """
         Makes an HTTP GET request to the specified URL and returns the results.
+
+        Transient failures are retried by the shared HTTP client before giving up. When the response cache
+        is enabled, fresh cached responses are served without a request, stale ones are revalidated with a
+        conditional request, and in offline mode the network is not used at all.
         
         :param url: The endpoint URL for the GET request.
-        :return list: JSON response with the 'results' field, or an empty list on error.
+        :return dict: JSON response with the 'results' field, or an empty dict on error.
+        """
+        body = self._open(url)
+        if body is None:
+            return {}
+
+        try:
+            return json_stream.loads(body.read())
+        except ValueError as val_err:
+            logger.error(f'JSON decode error: {val_err}, url: {url}')
+            self._forget(url)
+        
+        return {}
+
+    def iter_results(self, url: str, meta: dict) -> Iterator[dict]:
+        """
+        Makes an HTTP GET request and yields the items of its `results` one by one while the body is read,
+        so that only the current item is held in memory.
+
+        :param url: The endpoint URL for the GET request.
+        :param meta: Filled with the other top-level fields of the response, e.g. `count` and `next`. Once
+            the response is read completely, `results` holds the number of yielded items; it is missing if
+            the request failed or the body was not valid JSON.
+
+        :return Iterator[dict]: The items of `results`.
+        """
+        body = self._open(url, stream=True)
+        if body is None:
+            return
+
+        with closing(body):
+            results = 0
+            try:
+                for item in json_stream.iter_items(body, 'results', meta):
+                    results += 1
+                    yield item
+            except ValueError as val_err:
+                logger.error(f'JSON decode error: {val_err}, url: {url}')
+                meta.pop('results', None)
+                self._forget(url)
+                return
+            except requests.exceptions.RequestException as req_err:
+                logger.error(f'An error occurred while reading the response: {req_err}, url: {url}')
+                meta.pop('results', None)
+                return
+
+        meta['results'] = results
+
+    def _open(self, url: str, stream: bool = False) -> Optional[IO[bytes]]:
+        """
+        Gets the body of a response from the response cache or the DIIA API.
+
+        :param url: The endpoint URL for the GET request.
+        :param stream: Read the body from the connection while it is consumed instead of downloading it
+            first. Ignored when the response cache is enabled, since a cached body is stored whole.
+
+        :return IO[bytes]: The body, or None on error.
         """
+        full_url = f'{self.base_url}/{url}'
+        cached = response_cache.get(full_url) if response_cache.enabled else None
+        if cached is not None and response_cache.is_fresh(cached):
+            response_cache.count('hits')
+            return io.BytesIO(cached.body)
+        if response_cache.enabled and response_cache.offline:
+            response_cache.count('misses')
+            logger.error(f'Not cached in offline mode, url: {url}')
+            return None
+
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
         try:
-            response = requests.get(f'{self.base_url}/{url}')
-            response.raise_for_status()
-            return response.json()
+            response = http_client.get(full_url, endpoint=url.split('/')[0], headers=headers, limiter=self.limiter,
+                                       stream=stream and not response_cache.enabled)
         except requests.exceptions.HTTPError as http_err:
-            status_code = http_err.response.status_code if http_err.response else "No response"
-            logger.error(f'Status code: {status_code}')
+            status_code = http_err.response.status_code if http_err.response is not None else "No response"
+            logger.error(f'Status code: {status_code}, url: {url}')
+            return None
         except requests.exceptions.RequestException as req_err:
             logger.error(f'An error occurred: {req_err}')
-        except ValueError as val_err:
-            logger.error(f'JSON decode error: {val_err}')
-        
-        return []
+            return None
 
+        if response.status_code == 304 and cached is not None:
+            response_cache.count('revalidated')
+            response_cache.touch(full_url)
+            return io.BytesIO(cached.body)
 
-class AbstractReportDaoService:
-    """Base report DAO Service."""
+        if response_cache.enabled:
+            response_cache.count('misses')
+            response_cache.set(full_url, response.content, response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'))
+        elif stream:
+            return ResponseStream(response)
+
+        return io.BytesIO(response.content)
+
+    def _forget(self, url: str):
+        """Drops a response that turned out to be broken from the response cache."""
+        if response_cache.enabled:
+            response_cache.delete(f'{self.base_url}/{url}')
+
+
+class SessionDaoService:
+    """
+    Base DAO service holding a database session of its own.
+
+    By default every `save` commits. Inside `unit_of_work` saves only flush, and the whole unit is
+    committed once on exit.
+    """
     def __init__(self):
         self.session: SessionType = db.create_session()
+        self.in_unit_of_work: bool = False
+
+    def close(self):
+        """Ends the session and returns its connection to the pool."""
+        self.session.close()
+
+    def save(self, objs: list):
+        """
+        Adds a list of objects to the database session and commits the changes.
+
+        Inside a unit of work the changes are only flushed.
+
+        :param objs: A list of objects to be added to the session and persisted in the database.
+        """
+        for obj in objs:
+            self.session.add(obj)
+
+        self.commit()
+
+    def commit(self):
+        """Commits the session, or only flushes it inside a unit of work."""
+        if self.in_unit_of_work:
+            self.session.flush()
+        else:
+            with metrics.time('db_commit_seconds'), profiler.stage('commit'):
+                self.session.commit()
+
+    def end_read(self):
+        """
+        Ends the transaction begun by reads, so that the session gives its connection back to the pool
+        instead of holding it until its next write. Inside a unit of work the transaction goes on.
+        """
+        if not self.in_unit_of_work:
+            self.session.commit()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Runs the enclosed saves in a single transaction, committed once on exit and rolled back on error.
+        """
+        self.in_unit_of_work = True
+        try:
+            yield
+            with metrics.time('db_commit_seconds'), profiler.stage('commit'):
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.in_unit_of_work = False
+
+
+class AbstractReportDaoService(SessionDaoService):
+    """
+    Base report DAO Service, writing the records of the DIIA API.
+
+    `savepoint` isolates a single item of a unit of work so that its failure rolls back only that item.
+
+    `change_counts` counts the processed records by outcome: 'new', 'changed' or 'unchanged'.
+    """
+    def __init__(self):
+        super().__init__()
         self.base_url: str = f'{DIIA_API_URL}/v1/static_reports'
+        self.failed_items: List[str] = []
+        self.change_counts: Counter = Counter()
 
     @abstractmethod
     def update_or_create(self, data: dict):
@@ -130,20 +402,25 @@ class AbstractReportDaoService:
         for key, value in data.items():
             setattr(obj, key, value)
 
-    def save(self, objs: list):
+    @contextmanager
+    def savepoint(self, item: str):
         """
-        Adds a list of objects to the database session and commits the changes.
+        Runs the enclosed saves in a SAVEPOINT. On error only the savepoint is rolled back: the error is
+        logged, `item` is added to `failed_items` and the enclosing transaction goes on.
 
-        :param objs: A list of objects to be added to the session and persisted in the database.
+        :param item: Key of the processed item, used in the log and in `failed_items`.
         """
-        for obj in objs:
-            self.session.add(obj)
-
-        self.session.commit()
+        try:
+            with self.session.begin_nested():
+                yield
+        except Exception as err:
+            logger.exception(f'Failed to save {item}, rolled back: {err}')
+            self.failed_items.append(item)
 
 
 class ODAReportDaoService(AbstractReportDaoService):
     """DAO service for managing ODA data."""
+    @instrumented('flush', 'oda_report')
     def update_or_create(self, data: ODAReport) -> ODAReportModel:
         """
         Updates an existing ODA report record in the database if it exists; otherwise, creates a new record.
@@ -155,25 +432,33 @@ class ODAReportDaoService(AbstractReportDaoService):
         report_data = {
             "id": data.get("id"),
             "year": data.get("year"),
-            "quarter": data.get("quarter")
+            "quarter": data.get("quarter"),
+            "payload_hash": payload_hash(data),
         }
 
+        oda_report = self.session.query(ODAReportModel).filter_by(id=report_data["id"]).one_or_none()
+        if oda_report and oda_report.payload_hash == report_data["payload_hash"]:
+            self.change_counts['unchanged'] += 1
+            self.end_read()
+            return oda_report
+
         rsa_record = self._update_or_create_rsa_record(data.get("rsa"))
         
         self.session.flush()
 
-        oda_report = self.session.query(ODAReportModel).filter_by(id=report_data["id"]).one_or_none()
         if oda_report:
-            oda_report.year = report_data["year"]
-            oda_report.quarter = report_data["quarter"]
+            self.update(oda_report, report_data)
             oda_report.rsa_info_id = rsa_record.id
+            self.change_counts['changed'] += 1
         else:
             oda_report = ODAReportModel(**report_data)
             oda_report.rsa_info_id = rsa_record.id
+            self.change_counts['new'] += 1
     
         self.save([oda_report])
         return oda_report
 
+    @metrics.timed('dao_upsert_seconds', entity='rsa')
     def _update_or_create_rsa_record(self, data: ODAReportRSA) -> RSA:
         """
         Updates an existing ODA report record in the database if it exists; otherwise, creates a new record.
@@ -194,40 +479,246 @@ class ODAReportDaoService(AbstractReportDaoService):
 
 
 class TsNAPReportDaoService(AbstractReportDaoService):
-    """DAO service for managing TsNAP data."""
-    def update_or_create(self, data: TSNAPDetails):
+    """
+    DAO service for managing TsNAP data.
+
+    Rows looked up by natural key (asc_org by idf, tsnap by asc_org id, general_data by asc_idf) are
+    resolved through a shared `LookupCache`. `preload` fills it for a batch of idfs with a few `IN (...)`
+    queries and keeps the loaded rows in the session, so the lookups by id that follow hit the identity map.
+    """
+    detail_tables = (
+        ('activity_data', ActivityData, 'activity_data_id'),
+        ('info_support_data', InfoSupportData, 'info_support_data_id'),
+        ('admin_service_data', AdminServiceData, 'admin_service_data_id'),
+        ('resp_person_data', RespPersonData, 'resp_person_data_id'),
+    )
+    # Staged models in merge order, with the foreign keys taken from other staged models.
+    staged_models = (
+        (Locality, {}),
+        (Address, {'locality_id': Locality}),
+        (ASCOrg, {'address_id': Address}),
+        (GeneralData, {}),
+        (ActivityData, {}),
+        (InfoSupportData, {}),
+        (AdminServiceData, {}),
+        (RespPersonData, {}),
+        (TsNAP, {'asc_org_id': ASCOrg, 'general_data_id': GeneralData, 'activity_data_id': ActivityData,
+                 'info_support_data_id': InfoSupportData, 'admin_service_data_id': AdminServiceData,
+                 'resp_person_data_id': RespPersonData}),
+    )
+    # How the id of the existing row of a staged row is found; resolved in reverse merge order.
+    staged_id_lookups = {
+        'tsnap': '(SELECT t.id FROM tsnap t JOIN asc_org a ON a.id = t.asc_org_id WHERE a.idf = s.tsnap_idf)',
+        'resp_person_data': '(SELECT t.resp_person_data_id FROM staging_tsnap st JOIN tsnap t ON t.id = st.id WHERE st.tsnap_idf = s.tsnap_idf)',
+        'admin_service_data': '(SELECT t.admin_service_data_id FROM staging_tsnap st JOIN tsnap t ON t.id = st.id WHERE st.tsnap_idf = s.tsnap_idf)',
+        'info_support_data': '(SELECT t.info_support_data_id FROM staging_tsnap st JOIN tsnap t ON t.id = st.id WHERE st.tsnap_idf = s.tsnap_idf)',
+        'activity_data': '(SELECT t.activity_data_id FROM staging_tsnap st JOIN tsnap t ON t.id = st.id WHERE st.tsnap_idf = s.tsnap_idf)',
+        'general_data': '(SELECT g.id FROM general_data g WHERE g.asc_idf = s.tsnap_idf)',
+        'asc_org': '(SELECT a.id FROM asc_org a WHERE a.idf = s.tsnap_idf)',
+        'address': '(SELECT a.address_id FROM asc_org a WHERE a.idf = s.tsnap_idf)',
+        'locality': 'CASE WHEN s.codifier IS NOT NULL THEN (SELECT l.id FROM locality l WHERE l.codifier = s.codifier) '
+                    'ELSE (SELECT ad.locality_id FROM asc_org a JOIN address ad ON ad.id = a.address_id WHERE a.idf = s.tsnap_idf) END',
+    }
+    # What a TsNAP adds to the rollups of its ODA report and locality, by rollup column.
+    rollup_measures = {
+        'num_active': 'CASE WHEN g.is_active THEN 1 ELSE 0 END',
+        'num_total_empl': 'COALESCE(act.num_total_empl, 0)',
+        'num_total_services': 'COALESCE(adm.num_total_services, 0)',
+        'num_e_services': 'COALESCE(adm.num_e_services, 0)',
+    }
+    # Natural keys of the staged models whose rows are shared by several TsNAPs, and possibly by the TsNAPs
+    # of other workers: their rows are upserted on the key. Such models must not have links.
+    staged_shared_keys = {Locality: 'codifier'}
+
+    def __init__(self, cache: LookupCache = lookup_cache):
+        """
+        :param cache: Cache of ids keyed by natural key. Shared by default.
+        """
+        super().__init__()
+        self.lookup_cache = cache
+        self._preloaded: list = []
+
+    @instrumented('flush', 'tsnap')
+    def update_or_create(self, data: TSNAPDetails) -> str:
+        """
+        Updates an existing TsNAP with all its related rows if it exists; otherwise, creates a new one.
+
+        TsNAPs whose payload hash matches the stored one are skipped without writing anything.
+
+        :param data: TsNAP details from the DIIA API.
+
+        :return str: 'new', 'changed' or 'unchanged'.
+        """
+        data_hash = payload_hash(data)
+        asc_org = self._find(ASCOrg, ASCOrg.idf, data['asc_org']['idf'])
+        tsnap = self._find(TsNAP, TsNAP.asc_org_id, asc_org.id) if asc_org else None
+        if tsnap and tsnap.payload_hash == data_hash:
+            self.change_counts['unchanged'] += 1
+            return 'unchanged'
+
         asc_org_data = data.get('asc_org')
 
         asc_org = self._update_or_create_asc_org(asc_org_data)
 
-        tsnap = self.session.query(TsNAP).filter(TsNAP.asc_org_id == asc_org.id).first()
+        tsnap = self._find(TsNAP, TsNAP.asc_org_id, asc_org.id)
         general_data = self._update_or_create_general_data(asc_org.idf, data.get('general_data'))
 
+        status = 'changed' if tsnap else 'new'
         if not tsnap:
-            self._create_tsnap(data, asc_org.id, general_data.id)
-            activity_data = ActivityData(**data.get('activity_data'))
-            info_support_data = InfoSupportData(**data.get('info_support_data'))
-            admin_service_data = AdminServiceData(**data.get('admin_service_data'))
-            resp_person_data = RespPersonData(**data.get('resp_person_data'))
-            self.save([activity_data, info_support_data, admin_service_data, resp_person_data])
-
-            tsnap = TsNAP(asc_org_id=asc_org.id, general_data_id=general_data.id, activity_data_id=activity_data.id,
-                          info_support_data_id=info_support_data.id, admin_service_data_id=admin_service_data.id, resp_person_data_id=resp_person_data.id)
-            
-            self.save([tsnap])
+            tsnap = self._create_tsnap(data, asc_org.id, general_data.id, data_hash)
+            self.lookup_cache.set(TsNAP.__tablename__, asc_org.id, tsnap.id)
         else:
-            self.update(self.session.query(ActivityData).filter(ActivityData.id == tsnap.activity_data_id).first(), data.get('activity_data', {}))
-            self.update(self.session.query(InfoSupportData).filter(InfoSupportData.id == tsnap.info_support_data_id).first(), data.get('info_support_data', {}))
-            self.update(self.session.query(AdminServiceData).filter(AdminServiceData.id == tsnap.admin_service_data_id).first(), data.get('admin_service_data', {}))
-            self.update(self.session.query(RespPersonData).filter(RespPersonData.id == tsnap.resp_person_data_id).first(), data.get('resp_person_data', {}))
+            self.update(self._get(ActivityData, tsnap.activity_data_id), data.get('activity_data', {}))
+            self.update(self._get(InfoSupportData, tsnap.info_support_data_id), data.get('info_support_data', {}))
+            self.update(self._get(AdminServiceData, tsnap.admin_service_data_id), data.get('admin_service_data', {}))
+            self.update(self._get(RespPersonData, tsnap.resp_person_data_id), data.get('resp_person_data', {}))
+            tsnap.payload_hash = data_hash
+            self.save([tsnap])
+
+        self.change_counts[status] += 1
+        return status
+
+    def preload(self, idfs: List[str]):
+        """
+        Loads the existing rows of a batch of TsNAPs into the session and the lookup cache.
+
+        :param idfs: asc_org idfs of the batch.
+        """
+        idfs = list(set(idfs))
+        asc_orgs = self.session.scalars(select(ASCOrg).where(ASCOrg.idf.in_(idfs))).all()
+        asc_org_ids = [asc_org.id for asc_org in asc_orgs]
+        tsnaps = self.session.scalars(select(TsNAP).where(TsNAP.asc_org_id.in_(asc_org_ids))).all()
+        general_data = self.session.scalars(select(GeneralData).where(GeneralData.asc_idf.in_(idfs))).all()
+        addresses = self._load_by_ids(Address, [asc_org.address_id for asc_org in asc_orgs])
+        localities = self._load_by_ids(Locality, [address.locality_id for address in addresses])
+
+        self._preloaded = [*asc_orgs, *tsnaps, *general_data, *addresses, *localities]
+        for _, model, foreign_key in self.detail_tables:
+            self._preloaded.extend(self._load_by_ids(model, [getattr(tsnap, foreign_key) for tsnap in tsnaps]))
+
+        self.lookup_cache.set_many(ASCOrg.__tablename__, {
+            **dict.fromkeys(idfs, MISSING), **{asc_org.idf: asc_org.id for asc_org in asc_orgs}})
+        self.lookup_cache.set_many(TsNAP.__tablename__, {
+            **dict.fromkeys(asc_org_ids, MISSING), **{tsnap.asc_org_id: tsnap.id for tsnap in tsnaps}})
+        self.lookup_cache.set_many(GeneralData.__tablename__, {
+            **dict.fromkeys(idfs, MISSING), **{row.asc_idf: row.id for row in general_data}})
+
+    @instrumented('flush')
+    def update_rollups(self, report_id: int, idfs: List[str]):
+        """
+        Brings the rollups of an ODA report up to date with the current state of some of its TsNAPs.
+
+        Every TsNAP of a report has a row in 'tsnap_rollup_contribution' with what it adds to the
+        'tsnap_rollup' row of its locality. The new contributions are stored and only the differences from
+        the old ones are added to the rollups, in a single statement: TsNAPs that did not change cost
+        nothing, and a TsNAP that moved to another locality moves its contribution along.
+
+        :param report_id: The ID of the ODA report; it must already be saved.
+        :param idfs: asc_org idfs of the TsNAPs written for the report.
+        """
+        if not idfs:
+            return
+
+        measures = list(self.rollup_measures)
+        columns = ', '.join(measures)
+        current = (
+            'SELECT a.idf AS asc_org_idf, COALESCE(l.codifier, \'\') AS locality_codifier, '
+            + ', '.join(f'{expression} AS {name}' for name, expression in self.rollup_measures.items()) +
+            ' FROM asc_org a JOIN tsnap t ON t.asc_org_id = a.id '
+            'JOIN general_data g ON g.id = t.general_data_id '
+            'JOIN activity_data act ON act.id = t.activity_data_id '
+            'JOIN admin_service_data adm ON adm.id = t.admin_service_data_id '
+            'LEFT JOIN address ad ON ad.id = a.address_id LEFT JOIN locality l ON l.id = ad.locality_id '
+            'WHERE a.idf = ANY(:idfs)')
+        previous = 'SELECT * FROM tsnap_rollup_contribution WHERE oda_report_id = :report_id AND asc_org_idf = ANY(:idfs)'
+        stored = (
+            f'INSERT INTO tsnap_rollup_contribution (oda_report_id, asc_org_idf, locality_codifier, {columns}) '
+            f'SELECT :report_id, asc_org_idf, locality_codifier, {columns} FROM current '
+            f'ON CONFLICT (oda_report_id, asc_org_idf) DO UPDATE SET locality_codifier = excluded.locality_codifier, '
+            + ', '.join(f'{name} = excluded.{name}' for name in measures))
+        deltas = (
+            'SELECT locality_codifier, sum(num_tsnaps) AS num_tsnaps, '
+            + ', '.join(f'sum({name}) AS {name}' for name in measures) +
+            f' FROM (SELECT locality_codifier, 1 AS num_tsnaps, {columns} FROM current UNION ALL '
+            f'SELECT locality_codifier, -1, {", ".join(f"-{name}" for name in measures)} FROM previous) changes '
+            f'GROUP BY locality_codifier')
+        rollups = (
+            f'INSERT INTO tsnap_rollup (oda_report_id, locality_codifier, year, quarter, num_tsnaps, {columns}) '
+            f'SELECT r.id, d.locality_codifier, r.year, r.quarter, d.num_tsnaps, {", ".join(f"d.{name}" for name in measures)} '
+            f'FROM deltas d JOIN oda_reports r ON r.id = :report_id '
+            f'WHERE ' + ' OR '.join(f'd.{name} <> 0' for name in ['num_tsnaps', *measures]) + ' '
+            f'ON CONFLICT (oda_report_id, locality_codifier) DO UPDATE SET year = excluded.year, quarter = excluded.quarter, '
+            + ', '.join(f'{name} = tsnap_rollup.{name} + excluded.{name}' for name in ['num_tsnaps', *measures]))
+
+        self.session.flush()
+        with metrics.time('dao_rollup_seconds'):
+            self.session.execute(text(
+                f'WITH current AS ({current}), previous AS ({previous}), stored AS ({stored}), deltas AS ({deltas}) '
+                f'{rollups}'), {'report_id': report_id, 'idfs': list(idfs)})
+            self.session.execute(text('DELETE FROM tsnap_rollup WHERE oda_report_id = :report_id AND num_tsnaps = 0'),
+                                 {'report_id': report_id})
+
+    def release(self):
+        """Lets the session forget the rows loaded by `preload`."""
+        self._preloaded = []
+
+    def _load_by_ids(self, model, ids: list) -> list:
+        """
+        Loads the rows of a model with a single `IN (...)` query.
+
+        :param model: The model to load.
+        :param ids: Primary keys. None values are ignored.
+
+        :return list: The loaded instances.
+        """
+        ids = [row_id for row_id in set(ids) if row_id is not None]
+        if not ids:
+            return []
+        return self.session.scalars(select(model).where(model.id.in_(ids))).all()
+
+    def _find(self, model, column, key):
+        """
+        Finds a row by natural key, through the lookup cache.
+
+        :param model: The model to look up.
+        :param column: The natural key column.
+        :param key: The natural key value.
+
+        :return: The model instance, or None if it does not exist.
+        """
+        cached_id = self.lookup_cache.get(model.__tablename__, key)
+        if cached_id is MISSING:
+            return None
+        if cached_id is not None:
+            obj = self.session.get(model, cached_id)
+            if obj is not None:
+                return obj
+
+        obj = self.session.query(model).filter(column == key).first()
+        self.lookup_cache.set(model.__tablename__, key, obj.id if obj else MISSING)
+        return obj
+
+    def _get(self, model, row_id: Optional[int]):
+        """
+        Gets a row by primary key, from the session identity map when it is already loaded.
+
+        :param model: The model to look up.
+        :param row_id: The primary key value.
+
+        :return: The model instance, or None.
+        """
+        return self.session.get(model, row_id) if row_id is not None else None
     
-    def _create_tsnap(self, data: TSNAPDetails, asc_org_id: int, general_data_id: int):
+    def _create_tsnap(self, data: TSNAPDetails, asc_org_id: int, general_data_id: int, data_hash: str) -> TsNAP:
         """
         Create TsNAP instance in the database.
 
         :param data: TsNAP data.
         :param asc_org_id: instance of asc_org.
         :param general_data_id: instance of general_data_id.
+        :param data_hash: payload hash of the TsNAP data.
+
+        :return TsNAP: The created TsNAP.
         """
         activity_data = ActivityData(**data.get('activity_data'))
         info_support_data = InfoSupportData(**data.get('info_support_data'))
@@ -236,22 +727,27 @@ class TsNAPReportDaoService(AbstractReportDaoService):
         self.save([activity_data, info_support_data, admin_service_data, resp_person_data])
 
         tsnap = TsNAP(asc_org_id=asc_org_id, general_data_id=general_data_id, activity_data_id=activity_data.id,
-                        info_support_data_id=info_support_data.id, admin_service_data_id=admin_service_data.id, resp_person_data_id=resp_person_data.id)
+                        info_support_data_id=info_support_data.id, admin_service_data_id=admin_service_data.id, resp_person_data_id=resp_person_data.id,
+                        payload_hash=data_hash)
         
         self.save([tsnap])
+        return tsnap
 
+    @metrics.timed('dao_upsert_seconds', entity='general_data')
     def _update_or_create_general_data(self, asc_ord_idf: str, data) -> GeneralData:
-        general_data = self.session.query(GeneralData).filter(GeneralData.asc_idf == asc_ord_idf).first()
+        general_data = self._find(GeneralData, GeneralData.asc_idf, asc_ord_idf)
         if not general_data:
             general_data = GeneralData(**data)
         else:
             self.update(general_data, data)
 
         self.save([general_data])
+        self.lookup_cache.set(GeneralData.__tablename__, asc_ord_idf, general_data.id)
         return general_data
 
+    @metrics.timed('dao_upsert_seconds', entity='asc_org')
     def _update_or_create_asc_org(self, data: dict) -> ASCOrg:
-        asc_org = self.session.query(ASCOrg).filter(ASCOrg.idf == data['idf']).first()
+        asc_org = self._find(ASCOrg, ASCOrg.idf, data['idf'])
         address_data = data.pop('address')
 
         if not asc_org:
@@ -264,10 +760,12 @@ class TsNAPReportDaoService(AbstractReportDaoService):
             asc_org.address_id = address.id
 
         self.save([asc_org])
+        self.lookup_cache.set(ASCOrg.__tablename__, asc_org.idf, asc_org.id)
         return asc_org
 
+    @metrics.timed('dao_upsert_seconds', entity='address')
     def _update_or_create_address(self, asc_org: ASCOrg, data) -> Address:
-        address = self.session.query(Address).filter(Address.id == asc_org.address_id).first()
+        address = self._get(Address, asc_org.address_id)
 
         locality_data = data.pop('locality')
 
@@ -283,8 +781,14 @@ class TsNAPReportDaoService(AbstractReportDaoService):
         self.save([address])
         return address
     
+    @metrics.timed('dao_upsert_seconds', entity='locality')
     def _update_or_create_locality(self, address: Address, data) -> Locality:
-        locality = self.session.query(Locality).filter(Locality.id == address.locality_id).first()
+        # Localities with a codifier are shared by all the addresses in them.
+        codifier = data.get('codifier')
+        if codifier:
+            locality = self._find(Locality, Locality.codifier, codifier)
+        else:
+            locality = self._get(Locality, address.locality_id)
 
         if not locality and data:
             locality = Locality(**data)
@@ -292,4 +796,536 @@ class TsNAPReportDaoService(AbstractReportDaoService):
             self.update(locality, data)
 
         self.save([locality])
+        if codifier:
+            self.lookup_cache.set(Locality.__tablename__, codifier, locality.id)
         return locality
+
+    @instrumented('flush', 'tsnap', processed=len, metric='dao_batch_seconds')
+    def bulk_update_or_create(self, details: List[TSNAPDetails]) -> Dict[str, int]:
+        """
+        Updates or creates a batch of TsNAPs with a few set-based statements per table.
+
+        asc_org, general_data, tsnap and locality rows are upserted with `INSERT ... ON CONFLICT` on their
+        natural keys (`ASCOrg.idf`, `GeneralData.asc_idf`, `TsNAP.asc_org_id`, `Locality.codifier`). The other
+        tables are matched through the ids already linked to the existing asc_org and tsnap rows: linked rows
+        are updated by primary key, the rest are inserted with multi-row `INSERT ... RETURNING`.
+
+        TsNAPs whose payload hash matches the stored one are left untouched.
+
+        :param details: TsNAP details to write. If an idf repeats, the last payload wins.
+
+        :return Dict[str, int]: TsNAP ids keyed by asc_org idf.
+        """
+        by_idf = {data['asc_org']['idf']: data for data in details}
+        if not by_idf:
+            return {}
+
+        existing_asc_orgs = {row.idf: row for row in self.session.execute(
+            select(ASCOrg.idf, ASCOrg.id, ASCOrg.address_id).where(ASCOrg.idf.in_(list(by_idf))))}
+        idf_by_asc_org_id = {row.id: idf for idf, row in existing_asc_orgs.items()}
+        existing_tsnaps = {idf_by_asc_org_id[row.asc_org_id]: row for row in self.session.execute(
+            select(TsNAP).where(TsNAP.asc_org_id.in_(list(idf_by_asc_org_id)))).scalars()}
+
+        hashes = {idf: payload_hash(data) for idf, data in by_idf.items()}
+        unchanged = {idf: existing_tsnaps[idf].id for idf in by_idf
+                     if idf in existing_tsnaps and existing_tsnaps[idf].payload_hash == hashes[idf]}
+        self.change_counts['unchanged'] += len(unchanged)
+        self.change_counts['changed'] += len(existing_tsnaps.keys() - unchanged.keys())
+        self.change_counts['new'] += len(by_idf.keys() - existing_tsnaps.keys())
+        by_idf = {idf: data for idf, data in by_idf.items() if idf not in unchanged}
+        if not by_idf:
+            return unchanged
+
+        address_ids = self._bulk_update_or_create_addresses(by_idf, existing_asc_orgs)
+
+        asc_org_rows = []
+        for idf, data in by_idf.items():
+            row = {'idf': idf, 'name': data['asc_org']['name']}
+            if idf in address_ids:
+                row['address_id'] = address_ids[idf]
+            asc_org_rows.append(row)
+        asc_org_ids = self._bulk_upsert(ASCOrg, asc_org_rows, 'idf')
+
+        general_data_ids = self._bulk_upsert(GeneralData, [
+            {**self._column_values(GeneralData, data.get('general_data')), 'asc_idf': idf}
+            for idf, data in by_idf.items()
+        ], 'asc_idf')
+
+        tsnap_rows = {idf: {'asc_org_id': asc_org_ids[idf], 'general_data_id': general_data_ids[idf], 'payload_hash': hashes[idf]}
+                      for idf in by_idf}
+        for name, model, foreign_key in self.detail_tables:
+            detail_ids = self._bulk_save_by_id(model, {
+                idf: (getattr(existing_tsnaps.get(idf), foreign_key, None), self._column_values(model, data.get(name)))
+                for idf, data in by_idf.items()
+            })
+            for idf, detail_id in detail_ids.items():
+                tsnap_rows[idf][foreign_key] = detail_id
+
+        ids_by_asc_org_id = self._bulk_upsert(TsNAP, list(tsnap_rows.values()), 'asc_org_id')
+        tsnap_ids = {idf: ids_by_asc_org_id[asc_org_ids[idf]] for idf in tsnap_rows}
+        self.commit()
+
+        return {**unchanged, **tsnap_ids}
+
+    def _bulk_update_or_create_addresses(self, by_idf: Dict[str, TSNAPDetails], existing_asc_orgs: dict) -> Dict[str, int]:
+        """
+        Updates or creates the addresses and localities of a batch of TsNAPs.
+
+        :param by_idf: TsNAP details keyed by asc_org idf.
+        :param existing_asc_orgs: Existing asc_org rows (with `address_id`) keyed by idf.
+
+        :return Dict[str, int]: Address ids keyed by asc_org idf, for TsNAPs that have an address.
+        """
+        addresses = {idf: data['asc_org'].get('address') for idf, data in by_idf.items() if data['asc_org'].get('address')}
+        existing_address_ids = {idf: existing_asc_orgs[idf].address_id for idf in addresses
+                                if idf in existing_asc_orgs and existing_asc_orgs[idf].address_id}
+        existing_locality_ids = dict(self.session.execute(
+            select(Address.id, Address.locality_id).where(Address.id.in_(list(existing_address_ids.values())))).all())
+
+        localities = {idf: self._column_values(Locality, address['locality'])
+                      for idf, address in addresses.items() if address.get('locality')}
+        # Localities with a codifier are shared by all the addresses in them; the rest stay linked to their address.
+        shared = {idf: values for idf, values in localities.items() if values.get('codifier')}
+        ids_by_codifier = self._bulk_upsert(Locality, list(shared.values()), 'codifier')
+        locality_ids = {idf: ids_by_codifier[values['codifier']] for idf, values in shared.items()}
+        locality_ids.update(self._bulk_save_by_id(Locality, {
+            idf: (existing_locality_ids.get(existing_address_ids.get(idf)), values)
+            for idf, values in localities.items() if idf not in shared
+        }))
+
+        address_rows = {}
+        for idf, address in addresses.items():
+            values = self._column_values(Address, address)
+            if idf in locality_ids:
+                values['locality_id'] = locality_ids[idf]
+            address_rows[idf] = (existing_address_ids.get(idf), values)
+
+        return self._bulk_save_by_id(Address, address_rows)
+
+    def _bulk_upsert(self, model, rows: List[dict], key: str) -> dict:
+        """
+        Inserts rows, updating the existing ones that share the natural key, with `INSERT ... ON CONFLICT`.
+
+        :param model: The model to write to. `key` must be covered by a unique constraint.
+        :param rows: Column values of the rows. If a key repeats, the last row wins.
+        :param key: The natural key column.
+
+        :return dict: Row ids keyed by natural key value.
+        """
+        table = model.__table__
+        # A statement cannot update the same row twice.
+        rows = list({row[key]: row for row in rows}.values())
+        ids = {}
+        with metrics.time('dao_bulk_upsert_seconds', entity=table.name):
+            for group in self._group_by_columns(rows):
+                statement = pg_insert(table).values(group)
+                updated_columns = {column: statement.excluded[column] for column in group[0] if column != key}
+                statement = statement.on_conflict_do_update(
+                    index_elements=[key], set_=updated_columns or {key: statement.excluded[key]}
+                ).returning(table.c[key], table.c.id)
+                ids.update((row_key, row_id) for row_key, row_id in self.session.execute(statement))
+
+        return ids
+
+    def _bulk_save_by_id(self, model, rows: Dict[str, tuple]) -> Dict[str, int]:
+        """
+        Updates the rows that already have an id by primary key and inserts the rest.
+
+        :param model: The model to write to.
+        :param rows: `(id or None, column values)` keyed by asc_org idf.
+
+        :return Dict[str, int]: Row ids keyed by asc_org idf.
+        """
+        ids = {idf: row_id for idf, (row_id, _) in rows.items() if row_id}
+        updates = [{'id': row_id, **values} for row_id, values in rows.values() if row_id and values]
+        with metrics.time('dao_bulk_upsert_seconds', entity=model.__tablename__):
+            if updates:
+                self.session.execute(update(model), updates)
+
+            new_idfs = [idf for idf, (row_id, _) in rows.items() if not row_id]
+            for group_idfs in self._group_by_columns(new_idfs, key=lambda idf: rows[idf][1]):
+                new_ids = self.session.scalars(
+                    insert(model).returning(model.id, sort_by_parameter_order=True), [rows[idf][1] for idf in group_idfs]
+                ).all()
+                ids.update(zip(group_idfs, new_ids))
+
+        return ids
+
+    @staticmethod
+    def _group_by_columns(items: list, key=lambda row: row) -> List[list]:
+        """
+        Splits items into groups whose rows have the same set of columns, as multi-row statements require.
+
+        :param items: Items to group.
+        :param key: Returns the row (a dict of column values) of an item.
+
+        :return List[list]: Groups of items, in first-seen order.
+        """
+        groups = {}
+        for item in items:
+            groups.setdefault(frozenset(key(item)), []).append(item)
+
+        return list(groups.values())
+
+    @staticmethod
+    def _column_values(model, data: Optional[dict]) -> dict:
+        """
+        Picks the values of the model columns from an API payload, leaving out nested objects and the id.
+
+        :param model: The model the values are for.
+        :param data: The API payload.
+
+        :return dict: Column values.
+        """
+        columns = model.__table__.columns
+        return {key: value for key, value in (data or {}).items() if key in columns and key != 'id'}
+
+
+    @instrumented('flush', 'tsnap', processed=len, metric='dao_batch_seconds')
+    def stage(self, details: List[TSNAPDetails]):
+        """
+        Loads a batch of TsNAPs into the staging tables with `COPY FROM STDIN`, to be written by `merge_staged`.
+
+        The staging tables are temporary, so they skip the WAL like unlogged tables, are private to the
+        connection (several workers can stage at the same time) and are dropped on commit. Every TsNAP is
+        flattened into one row per model, keyed by its asc_org idf in `tsnap_idf`. Rows are full rows: columns missing from
+        the payload get their default.
+
+        :param details: TsNAP details to stage.
+        """
+        self.session.execute(text(';'.join(
+            f'CREATE TEMP TABLE IF NOT EXISTS staging_{model.__tablename__} (tsnap_idf text NOT NULL, id integer, '
+            f'is_new boolean NOT NULL DEFAULT false, '
+            + ', '.join(f'{column.name} {column.type.compile(dialect=postgresql.dialect())}'
+                        for column in self._staged_columns(model, links)) + ') ON COMMIT DROP'
+            for model, links in self.staged_models
+        )))
+
+        rows = {model: [] for model, _ in self.staged_models}
+        for data in details:
+            idf = data['asc_org']['idf']
+            address = data['asc_org'].get('address')
+            locality = address.get('locality') if address else None
+            if locality:
+                rows[Locality].append((idf, self._column_values(Locality, locality)))
+            if address:
+                rows[Address].append((idf, self._column_values(Address, address)))
+            rows[ASCOrg].append((idf, {'idf': idf, 'name': data['asc_org']['name']}))
+            rows[GeneralData].append((idf, {**self._column_values(GeneralData, data.get('general_data')), 'asc_idf': idf}))
+            for name, model, _ in self.detail_tables:
+                rows[model].append((idf, self._column_values(model, data.get(name))))
+            rows[TsNAP].append((idf, {'payload_hash': payload_hash(data)}))
+
+        with self.session.connection().connection.cursor() as cursor:
+            for model, links in self.staged_models:
+                columns = self._staged_columns(model, links)
+                defaults = {column.name: column.default.arg for column in columns
+                            if column.default is not None and column.default.is_scalar}
+                buffer = io.StringIO()
+                for idf, values in rows[model]:
+                    values = {**defaults, **values}
+                    buffer.write('\t'.join(map(self._copy_value, [idf, *(values.get(column.name) for column in columns)])))
+                    buffer.write('\n')
+                buffer.seek(0)
+
+                with metrics.time('dao_copy_seconds', entity=model.__tablename__):
+                    cursor.copy_expert(f'COPY staging_{model.__tablename__} (tsnap_idf, {", ".join(column.name for column in columns)}) '
+                                       f'FROM STDIN', buffer)
+
+    @instrumented('flush')
+    def merge_staged(self):
+        """
+        Writes the staged TsNAPs into the model tables with set-based statements, in the current transaction.
+
+        Ids of the existing rows are resolved first, through the same links the other write paths use.
+        TsNAPs whose payload hash matches the stored one are then dropped from staging, new rows get ids from
+        the table sequences, and every table is written with one `UPDATE ... FROM` and one
+        `INSERT ... SELECT`, parents first. If an idf was staged twice, the last payload wins.
+        """
+        with metrics.time('dao_merge_seconds'):
+            for model, _ in self.staged_models:
+                table = f'staging_{model.__tablename__}'
+                self.session.execute(text(f'DELETE FROM {table} a USING {table} b WHERE a.tsnap_idf = b.tsnap_idf AND a.ctid < b.ctid'))
+
+            for model, _ in reversed(self.staged_models):
+                self.session.execute(text(f'UPDATE staging_{model.__tablename__} s SET id = '
+                                          f'{self.staged_id_lookups[model.__tablename__]}'))
+
+            new, changed, unchanged = self.session.execute(text(
+                'SELECT count(*) FILTER (WHERE s.id IS NULL), '
+                'count(*) FILTER (WHERE s.id IS NOT NULL AND t.payload_hash IS DISTINCT FROM s.payload_hash), '
+                'count(*) FILTER (WHERE t.payload_hash = s.payload_hash) '
+                'FROM staging_tsnap s LEFT JOIN tsnap t ON t.id = s.id')).one()
+            self.change_counts.update({'new': new, 'changed': changed, 'unchanged': unchanged})
+
+            for model, _ in self.staged_models:
+                self.session.execute(text(
+                    f'DELETE FROM staging_{model.__tablename__} s USING staging_tsnap st JOIN tsnap t ON t.id = st.id '
+                    f'WHERE st.tsnap_idf = s.tsnap_idf AND t.payload_hash = st.payload_hash'))
+
+            for model, links in self.staged_models:
+                self._merge_staged_table(model, links)
+
+    def _merge_staged_table(self, model, links: Dict[str, type]):
+        """
+        Writes one staging table into its model table.
+
+        :param model: The model to write to.
+        :param links: Staged parent models keyed by foreign key column; the foreign keys are taken from the
+            ids resolved for the parents, keeping the current value when the parent was not staged.
+        """
+        table, staging = model.__tablename__, f'staging_{model.__tablename__}'
+        columns = [column.name for column in self._staged_columns(model, links)]
+        joins = ' '.join(f'LEFT JOIN staging_{parent.__tablename__} {foreign_key} ON {foreign_key}.tsnap_idf = s.tsnap_idf'
+                         for foreign_key, parent in links.items())
+
+        # Every staged row has an id of its own: idfs staged twice are deleted before, TsNAPs own their rows
+        # through the natural keys, and the shared rows are upserted on their key.
+        source = f'{staging} s'
+
+        with metrics.time('dao_bulk_upsert_seconds', entity=table):
+            shared_key = self.staged_shared_keys.get(model)
+            unkeyed = 'true'
+            if shared_key:
+                # Other workers may be writing the same keys: the rows with a key are upserted on it in one
+                # statement, which waits for a concurrent transaction inserting the same key, and the staged
+                # rows take their ids. Only the rows without a key are left for the statements below.
+                self.session.execute(text(
+                    f'INSERT INTO {table} ({", ".join(columns)}) SELECT DISTINCT ON ({shared_key}) {", ".join(columns)} '
+                    f'FROM {staging} WHERE {shared_key} IS NOT NULL ORDER BY {shared_key}, ctid DESC '
+                    f'ON CONFLICT ({shared_key}) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in columns)}'))
+                self.session.execute(text(
+                    f'UPDATE {staging} s SET id = t.id FROM {table} t WHERE s.{shared_key} = t.{shared_key}'))
+                unkeyed = f's.{shared_key} IS NULL'
+            self.session.execute(text(
+                f"UPDATE {staging} SET id = nextval(pg_get_serial_sequence('{table}', 'id')), is_new = true "
+                f"WHERE id IS NULL"))
+
+            assignments = [f'{column} = s.{column}' for column in columns]
+            assignments += [f'{foreign_key} = COALESCE({foreign_key}.id, t.{foreign_key})' for foreign_key in links]
+            self.session.execute(text(
+                f'UPDATE {table} t SET {", ".join(assignments)} FROM {source} {joins} '
+                f'WHERE t.id = s.id AND NOT s.is_new AND {unkeyed}'))
+
+            self.session.execute(text(
+                f'INSERT INTO {table} (id, {", ".join([*columns, *links])}) '
+                f'SELECT s.id, {", ".join([*(f"s.{column}" for column in columns), *(f"{key}.id" for key in links)])} '
+                f'FROM {source} {joins} WHERE s.is_new'))
+
+    @staticmethod
+    def _staged_columns(model, links: Dict[str, type]) -> list:
+        """
+        Lists the columns of a model that are staged: all but the id and the foreign keys resolved at merge.
+
+        :param model: The staged model.
+        :param links: Staged parent models keyed by foreign key column.
+
+        :return list: The staged columns.
+        """
+        return [column for column in model.__table__.columns if column.name != 'id' and column.name not in links]
+
+    @staticmethod
+    def _copy_value(value) -> str:
+        """
+        Formats a value for the text format of `COPY`.
+
+        :param value: The value.
+
+        :return str: The escaped value; `\\N` for NULL.
+        """
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class ReportViewDaoService(SessionDaoService):
+    """
+    DAO service for the materialized report views.
+
+    `tsnap_full_view` is a snapshot of the joined TsNAP tables, so readers never wait for a sync and point
+    lookups use its indexes. It is refreshed at the end of every sync run that changed TsNAPs.
+    """
+    views = ('tsnap_full_view',)
+
+    def refresh(self):
+        """
+        Recomputes the views with `REFRESH MATERIALIZED VIEW CONCURRENTLY`: the old contents stay readable
+        until the new ones are committed.
+        """
+        for view in self.views:
+            with metrics.time('view_refresh_seconds', view=view):
+                self.session.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}'))
+                self.commit()
+            logger.info(f'Refreshed {view}.')
+
+
+class IntegrityDaoService(SessionDaoService):
+    """
+    DAO service that looks for rows left behind or written twice by the TsNAP write paths.
+
+    Every TsNAP owns its general data and detail rows: a row no TsNAP references is an orphan of a
+    duplicated or abandoned insert, and a row referenced by several TsNAPs was linked to the wrong one.
+    Addresses belong to ASC organizations; localities are shared, and one can lose its last address when
+    addresses move to another locality.
+    """
+    owned_tables = (('general_data', 'tsnap', 'general_data_id'),
+                    *((table, 'tsnap', foreign_key) for table, _, foreign_key in TsNAPReportDaoService.detail_tables),
+                    ('address', 'asc_org', 'address_id'))
+
+    def anomalies(self) -> Dict[str, int]:
+        """
+        Counts the orphaned and shared rows of every owned table, and the localities without addresses.
+
+        :return dict: `orphaned/<table>` and `shared/<table>` counts.
+        """
+        counts = {}
+        for table, owner, foreign_key in self.owned_tables:
+            counts[f'orphaned/{table}'] = self.session.execute(text(
+                f'SELECT count(*) FROM {table} r WHERE NOT EXISTS (SELECT 1 FROM {owner} o WHERE o.{foreign_key} = r.id)'
+            )).scalar()
+            counts[f'shared/{table}'] = self.session.execute(text(
+                f'SELECT count(*) FROM (SELECT {foreign_key} FROM {owner} WHERE {foreign_key} IS NOT NULL '
+                f'GROUP BY {foreign_key} HAVING count(*) > 1) shared')).scalar()
+        counts['orphaned/locality'] = self.session.execute(text(
+            'SELECT count(*) FROM locality l WHERE NOT EXISTS (SELECT 1 FROM address a WHERE a.locality_id = l.id)'
+        )).scalar()
+        self.session.rollback()
+        return counts
+
+
+class SyncRunDaoService(SessionDaoService):
+    """
+    DAO service for the checkpoints of sync runs.
+
+    A run records which ODA reports, entry pages and TsNAPs (by asc_org idf) of a quarter are done or failed,
+    so that an interrupted run can be resumed without redoing the finished items. Until a run is started or
+    attached, marking items is a no-op.
+    """
+    def __init__(self):
+        super().__init__()
+        self.run_id: Optional[int] = None
+
+    def start(self, year: int, quarter: int, resume: bool = False) -> int:
+        """
+        Starts a new run of a quarter or, with `resume`, continues the last unfinished one.
+
+        :param year: The year being synced.
+        :param quarter: The quarter being synced.
+        :param resume: Continue the last unfinished run of the quarter, if there is one.
+
+        :return int: The run id.
+        """
+        run = None
+        if resume:
+            run = self.session.scalars(
+                select(SyncRun).where(SyncRun.year == year, SyncRun.quarter == quarter, SyncRun.status != 'finished')
+                .order_by(SyncRun.id.desc()).limit(1)).first()
+
+        if run:
+            logger.info(f'Resuming sync run {run.id} of {year} Q{quarter}.')
+            run.status = 'running'
+        else:
+            run = SyncRun(year=year, quarter=quarter, status='running')
+
+        self.save([run])
+        self.run_id = run.id
+        return run.id
+
+    def attach(self, run_id: int):
+        """
+        Records checkpoints of an already started run, e.g. in a worker process.
+
+        :param run_id: The run id.
+        """
+        self.run_id = run_id
+
+    def finish(self) -> str:
+        """
+        Closes the run: it is finished if no item failed, and stays resumable otherwise.
+
+        :return str: The final status of the run.
+        """
+        status = 'failed' if self.keys('failed') else 'finished'
+        run = self.session.get(SyncRun, self.run_id)
+        run.status = status
+        run.finished_at = datetime.utcnow()
+        self.save([run])
+        return status
+
+    def pending_reports(self, oda_reports: List[ODAReport], retry_failed: bool = False) -> List[ODAReport]:
+        """
+        Leaves out the ODA reports the run does not need to sync.
+
+        :param oda_reports: ODA reports from the DIIA API.
+        :param retry_failed: Keep only the reports with failed items instead of all unfinished ones.
+
+        :return List[ODAReport]: The reports to sync.
+        """
+        if retry_failed:
+            failed_reports = self.reports_with_failures()
+            return [report for report in oda_reports if report['id'] in failed_reports]
+
+        done_reports = self.keys('done', kind='report')
+        return [report for report in oda_reports if str(report['id']) not in done_reports]
+
+    @sql_audit.tagged('checkpoint', processed=0)
+    def mark(self, kind: str, report_id: int, keys: List[str], status: str):
+        """
+        Records the outcome of items with a single upsert.
+
+        :param kind: 'report', 'page' or 'tsnap'.
+        :param report_id: The ODA report the items belong to.
+        :param keys: Keys of the items.
+        :param status: 'done' or 'failed'.
+        """
+        if self.run_id is None or not keys:
+            return
+
+        rows = [{'run_id': self.run_id, 'kind': kind, 'key': str(key), 'report_id': report_id,
+                 'status': status, 'updated_at': datetime.utcnow()} for key in dict.fromkeys(keys)]
+        statement = pg_insert(SyncCheckpoint.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['run_id', 'kind', 'key'],
+            set_={'status': statement.excluded.status, 'updated_at': statement.excluded.updated_at})
+        self.session.execute(statement)
+        self.commit()
+
+    def keys(self, status: str, kind: Optional[str] = None, report_id: Optional[int] = None) -> Set[str]:
+        """
+        Returns the keys of the run items with a given outcome.
+
+        :param status: 'done' or 'failed'.
+        :param kind: Only items of this kind.
+        :param report_id: Only items of this ODA report.
+
+        :return Set[str]: The item keys.
+        """
+        if self.run_id is None:
+            return set()
+
+        query = select(SyncCheckpoint.key).where(SyncCheckpoint.run_id == self.run_id, SyncCheckpoint.status == status)
+        if kind is not None:
+            query = query.where(SyncCheckpoint.kind == kind)
+        if report_id is not None:
+            query = query.where(SyncCheckpoint.report_id == report_id)
+
+        # A run can have a checkpoint for every TsNAP of the quarter: they are read through a server-side cursor.
+        keys = set(self.session.scalars(query.execution_options(yield_per=DB_STREAM_BATCH_SIZE)))
+        self.end_read()
+        return keys
+
+    def reports_with_failures(self) -> Set[int]:
+        """
+        Returns the ODA reports that have a failed item of any kind.
+
+        :return Set[int]: ODA report ids.
+        """
+        if self.run_id is None:
+            return set()
+
+        report_ids = set(self.session.scalars(select(SyncCheckpoint.report_id).distinct().where(
+            SyncCheckpoint.run_id == self.run_id, SyncCheckpoint.status == 'failed')))
+        self.end_read()
+        return report_ids
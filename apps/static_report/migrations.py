@@ -0,0 +1,203 @@
+import logging
+from typing import Callable, List, Sequence, Tuple
+
+from sqlalchemy import Connection, insert, select, text
+from sqlalchemy.engine import Engine
+
+from apps.static_report.models import SchemaMigration, TsNAPRollup, TsNAPRollupContribution
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key of the advisory lock that keeps two processes from migrating at the same time.
+MIGRATION_LOCK_KEY = 0x7472656d
+
+
+def create_tables(connection: Connection):
+    """Creates the missing tables. On a new database they get their current shape, so the rest is a no-op."""
+    db.Base.metadata.create_all(connection)
+
+
+def add_payload_hashes(connection: Connection):
+    """Adds the payload hash columns used to skip unchanged ODA reports and TsNAPs."""
+    connection.execute(text('ALTER TABLE oda_reports ADD COLUMN IF NOT EXISTS payload_hash VARCHAR(64)'))
+    connection.execute(text('ALTER TABLE tsnap ADD COLUMN IF NOT EXISTS payload_hash VARCHAR(64)'))
+
+
+def add_natural_keys(connection: Connection):
+    """
+    Adds the unique natural keys of tsnap and locality, removing the duplicates first.
+
+    Of every group of duplicates the newest row is kept and the references to the others are moved to
+    it. Duplicate TsNAPs are deleted together with their detail rows.
+    """
+    _merge_duplicates(connection, 'locality', 'codifier', referenced_by=[('address', 'locality_id')])
+
+    connection.execute(text(
+        'CREATE TEMP TABLE duplicate_tsnap ON COMMIT DROP AS '
+        'SELECT * FROM (SELECT *, row_number() OVER (PARTITION BY asc_org_id ORDER BY id DESC) AS position '
+        'FROM tsnap) ranked WHERE position > 1'))
+    deleted = connection.execute(text('DELETE FROM tsnap WHERE id IN (SELECT id FROM duplicate_tsnap)')).rowcount
+    for table in ('activity_data', 'info_support_data', 'admin_service_data', 'resp_person_data'):
+        connection.execute(text(
+            f'DELETE FROM {table} WHERE id IN (SELECT {table}_id FROM duplicate_tsnap) '
+            f'AND NOT EXISTS (SELECT 1 FROM tsnap WHERE tsnap.{table}_id = {table}.id)'))
+    if deleted:
+        logger.info(f'Deleted {deleted} duplicate TsNAPs.')
+
+    _add_unique_constraint(connection, 'locality', 'locality_codifier_key', 'codifier')
+    _add_unique_constraint(connection, 'tsnap', 'tsnap_asc_org_id_key', 'asc_org_id', include='id, payload_hash')
+
+
+def add_lookup_indexes(connection: Connection):
+    """Indexes the foreign keys the DAO and `tsnap_full_view` join on, and the checkpoint lookups."""
+    for table, column in (('address', 'locality_id'), ('asc_org', 'address_id'), ('tsnap', 'general_data_id'),
+                          ('tsnap', 'activity_data_id'), ('tsnap', 'info_support_data_id'),
+                          ('tsnap', 'admin_service_data_id'), ('tsnap', 'resp_person_data_id')):
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})'))
+
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_sync_checkpoint_run_id_status '
+        'ON sync_checkpoint (run_id, status, kind, report_id) INCLUDE (key)'))
+
+
+TSNAP_FULL_VIEW_QUERY = """
+SELECT
+    t.id AS tsnap_id,
+    "asc".id AS asc_org_id,
+    "asc".idf AS asc_org_idf,
+    "asc".name AS asc_org_name,
+    gen.asc_name AS asc_name,
+    gen.asc_idf AS asc_idf,
+    gen.asc_type AS asc_type,
+    gen.created_by AS created_by,
+    gen.is_active AS is_active,
+    gen.date_created AS date_created,
+    addr.address_full AS address_full,
+    addr.postal_code AS postal_code,
+    addr.lat AS latitude,
+    addr.lon AS longitude,
+    loc.name AS locality_name,
+    loc.codifier AS locality_codifier,
+    act.num_total_empl AS total_employees,
+    act.manager_name AS manager_name,
+    act.has_online_inform AS has_online_information,
+    info.has_person_org_register AS has_person_org_register,
+    info.has_land_cadastre AS has_land_cadastre,
+    info.has_website_access AS has_website_access,
+    admin.num_total_services AS total_services,
+    admin.num_e_services AS e_services,
+    admin.is_all_asc_services_via_center AS all_services_via_center,
+    resp.name AS responsible_person_name,
+    resp.phone AS responsible_person_phone,
+    resp.email AS responsible_person_email
+FROM tsnap t
+JOIN "asc_org" "asc" ON t.asc_org_id = "asc".id
+JOIN general_data gen ON t.general_data_id = gen.id
+JOIN address addr ON "asc".address_id = addr.id
+JOIN locality loc ON addr.locality_id = loc.id
+JOIN activity_data act ON t.activity_data_id = act.id
+JOIN info_support_data info ON t.info_support_data_id = info.id
+JOIN admin_service_data admin ON t.admin_service_data_id = admin.id
+JOIN resp_person_data resp ON t.resp_person_data_id = resp.id
+"""
+
+
+def materialize_tsnap_full_view(connection: Connection):
+    """
+    Replaces the plain `tsnap_full_view` of create_view.sql, if it was created, with a materialized view.
+
+    The unique index on `tsnap_id` is what lets `REFRESH MATERIALIZED VIEW CONCURRENTLY` run without
+    blocking the readers.
+    """
+    kind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = 'tsnap_full_view'")).scalar()
+    if kind == 'v':
+        connection.execute(text('DROP VIEW tsnap_full_view'))
+    connection.execute(text(f'CREATE MATERIALIZED VIEW IF NOT EXISTS tsnap_full_view AS {TSNAP_FULL_VIEW_QUERY}'))
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_tsnap_full_view_tsnap_id ON tsnap_full_view (tsnap_id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_tsnap_full_view_asc_org_idf ON tsnap_full_view (asc_org_idf)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_tsnap_full_view_locality_codifier ON tsnap_full_view (locality_codifier)'))
+
+
+def create_rollup_tables(connection: Connection):
+    """Creates the per ODA report and locality rollups, filled by the next sync of every report."""
+    TsNAPRollup.__table__.create(connection, checkfirst=True)
+    TsNAPRollupContribution.__table__.create(connection, checkfirst=True)
+
+
+def add_general_data_key(connection: Connection):
+    """
+    Adds the unique key of general_data that the bulk and copy write modes upsert on, merging the rows with
+    the same asc_idf first: the newest one is kept and the TsNAPs of the others are moved to it.
+    """
+    _merge_duplicates(connection, 'general_data', 'asc_idf', referenced_by=[('tsnap', 'general_data_id')])
+    _add_unique_constraint(connection, 'general_data', 'general_data_asc_idf_key', 'asc_idf')
+
+
+# Applied in order, each at most once. Never edit or reorder an applied migration: append a new one.
+MIGRATIONS: Sequence[Tuple[int, str, Callable[[Connection], None]]] = (
+    (1, 'create tables', create_tables),
+    (2, 'payload hashes', add_payload_hashes),
+    (3, 'natural keys', add_natural_keys),
+    (4, 'lookup indexes', add_lookup_indexes),
+    (5, 'materialized tsnap_full_view', materialize_tsnap_full_view),
+    (6, 'rollup tables', create_rollup_tables),
+    (7, 'general_data natural key', add_general_data_key),
+)
+
+
+def migrate(engine: Engine) -> List[int]:
+    """
+    Applies the pending migrations in one transaction, recording them in 'schema_migrations'.
+
+    Databases created before the migrations were introduced are brought up to date as well: every
+    migration is safe to run on a schema that already has some of its changes.
+
+    :param engine: The engine of the database to migrate.
+
+    :return List[int]: Versions of the applied migrations.
+    """
+    with engine.begin() as connection:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        SchemaMigration.__table__.create(connection, checkfirst=True)
+        applied = set(connection.scalars(select(SchemaMigration.version)))
+
+        pending = [(version, name, upgrade) for version, name, upgrade in MIGRATIONS if version not in applied]
+        for version, name, upgrade in pending:
+            logger.info(f'Applying migration {version}: {name}.')
+            upgrade(connection)
+            connection.execute(insert(SchemaMigration).values(version=version, name=name))
+
+    return [version for version, _, _ in pending]
+
+
+def _merge_duplicates(connection: Connection, table: str, key: str, referenced_by: List[Tuple[str, str]]):
+    """
+    Keeps the newest row of every group of rows sharing a non-null key, pointing the references to the
+    others at it, and deletes the others.
+
+    :param table: The table to deduplicate.
+    :param key: The natural key column.
+    :param referenced_by: `(table, column)` pairs of the foreign keys referencing the table.
+    """
+    connection.execute(text(
+        f'CREATE TEMP TABLE duplicate_{table} ON COMMIT DROP AS SELECT id, keep_id FROM '
+        f'(SELECT id, max(id) OVER (PARTITION BY {key}) AS keep_id FROM {table} WHERE {key} IS NOT NULL) ranked '
+        f'WHERE id <> keep_id'))
+    for referencing_table, column in referenced_by:
+        connection.execute(text(
+            f'UPDATE {referencing_table} r SET {column} = d.keep_id FROM duplicate_{table} d WHERE r.{column} = d.id'))
+    deleted = connection.execute(text(
+        f'DELETE FROM {table} t USING duplicate_{table} d WHERE t.id = d.id')).rowcount
+    if deleted:
+        logger.info(f'Merged {deleted} duplicate {table} rows by {key}.')
+
+
+def _add_unique_constraint(connection: Connection, table: str, name: str, columns: str, include: str = ''):
+    """Adds a unique constraint unless the table already has one with that name."""
+    exists = connection.execute(text('SELECT 1 FROM pg_constraint WHERE conname = :name'), {'name': name}).first()
+    if not exists:
+        include = f' INCLUDE ({include})' if include else ''
+        connection.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({columns}){include}'))
@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Float, Integer, String, ForeignKey, Boolean, Date
+from datetime import datetime
+
+from sqlalchemy import Column, Float, Integer, String, ForeignKey, Boolean, Date, DateTime, Index, UniqueConstraint
 
 from database import db
 from sqlalchemy.orm import relationship
@@ -25,6 +27,7 @@ class ODAReport(db.Base):
     id = Column(Integer, primary_key=True)
     year = Column(Integer, nullable=False)
     quarter = Column(Integer, nullable=False)
+    payload_hash = Column(String(64), nullable=True)
 
     rsa_info_id = Column(Integer, ForeignKey('rsa.id'), nullable=False)
 
@@ -43,7 +46,7 @@ class Locality(db.Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=True)
-    codifier = Column(String, nullable=True)
+    codifier = Column(String, nullable=True, unique=True)
 
     def __init__(self, **data):
         """Initializes a Locality object."""
@@ -57,7 +60,7 @@ class Address(db.Base):
     
     id = Column(Integer, primary_key=True)
     address_full = Column(String, nullable=False)
-    locality_id = Column(Integer, ForeignKey('locality.id'), nullable=True)
+    locality_id = Column(Integer, ForeignKey('locality.id'), nullable=True, index=True)
     postal_code = Column(String, nullable=True)
     lat = Column(Float, nullable=True)
     lon = Column(Float, nullable=True)
@@ -76,7 +79,7 @@ class ASCOrg(db.Base):
     idf = Column(String, nullable=False, unique=True)  # Unique identifier
     name = Column(String, nullable=False)
     
-    address_id = Column(Integer, ForeignKey('address.id'), nullable=True)
+    address_id = Column(Integer, ForeignKey('address.id'), nullable=True, index=True)
 
     def __init__(self, **data):
         """Initializes an ASCOrg object with the provided data."""
@@ -90,7 +93,7 @@ class GeneralData(db.Base):
 
     id = Column(Integer, primary_key=True)
     asc_name = Column(String, nullable=False)
-    asc_idf = Column(String, nullable=False)
+    asc_idf = Column(String, nullable=False, unique=True)
     asc_type = Column(Integer, nullable=True)
     created_by = Column(String, nullable=True)
     edrpou = Column(String, nullable=True)
@@ -226,15 +229,91 @@ class RespPersonData(db.Base):
 class TsNAP(db.Base):
     """Represents a TsNAP region record in the 'tsnap' table."""
     __tablename__ = 'tsnap'
+    # One TsNAP per ASC organization. The key also covers the id and the payload hash, so the
+    # "is this TsNAP unchanged" lookups are answered from the index alone.
+    __table_args__ = (UniqueConstraint('asc_org_id', name='tsnap_asc_org_id_key',
+                                       postgresql_include=['id', 'payload_hash']),)
     
     id = Column(Integer, primary_key=True)
     asc_org_id = Column(Integer, ForeignKey('asc_org.id'), nullable=False)
-    general_data_id = Column(Integer, ForeignKey('general_data.id'), nullable=False)
-    activity_data_id = Column(Integer, ForeignKey('activity_data.id'), nullable=False)
-    info_support_data_id = Column(Integer, ForeignKey('info_support_data.id'), nullable=False)
-    admin_service_data_id = Column(Integer, ForeignKey('admin_service_data.id'), nullable=False)
-    resp_person_data_id = Column(Integer, ForeignKey('resp_person_data.id'), nullable=False)
+    general_data_id = Column(Integer, ForeignKey('general_data.id'), nullable=False, index=True)
+    activity_data_id = Column(Integer, ForeignKey('activity_data.id'), nullable=False, index=True)
+    info_support_data_id = Column(Integer, ForeignKey('info_support_data.id'), nullable=False, index=True)
+    admin_service_data_id = Column(Integer, ForeignKey('admin_service_data.id'), nullable=False, index=True)
+    resp_person_data_id = Column(Integer, ForeignKey('resp_person_data.id'), nullable=False, index=True)
+    payload_hash = Column(String(64), nullable=True)
 
     def __init__(self, **data):
         """Initializes the TsNAPRegion with provided data."""
         for key, value in data.items(): setattr(self, key, value)
+
+
+class TsNAPRollup(db.Base):
+    """Represents the aggregates of the TsNAPs of an ODA report in a locality in the 'tsnap_rollup' table."""
+    __tablename__ = 'tsnap_rollup'
+    __table_args__ = (Index('ix_tsnap_rollup_year_quarter', 'year', 'quarter'),)
+
+    oda_report_id = Column(Integer, ForeignKey('oda_reports.id'), primary_key=True)
+    locality_codifier = Column(String, primary_key=True)  # Empty for TsNAPs without a locality
+    year = Column(Integer, nullable=False)
+    quarter = Column(Integer, nullable=False)
+    num_tsnaps = Column(Integer, nullable=False, default=0)
+    num_active = Column(Integer, nullable=False, default=0)
+    num_total_empl = Column(Integer, nullable=False, default=0)
+    num_total_services = Column(Integer, nullable=False, default=0)
+    num_e_services = Column(Integer, nullable=False, default=0)
+
+
+class TsNAPRollupContribution(db.Base):
+    """Represents what a TsNAP of an ODA report adds to its 'tsnap_rollup' row, in the 'tsnap_rollup_contribution' table."""
+    __tablename__ = 'tsnap_rollup_contribution'
+
+    oda_report_id = Column(Integer, ForeignKey('oda_reports.id'), primary_key=True)
+    asc_org_idf = Column(String, primary_key=True)
+    locality_codifier = Column(String, nullable=False)
+    num_active = Column(Integer, nullable=False)
+    num_total_empl = Column(Integer, nullable=False)
+    num_total_services = Column(Integer, nullable=False)
+    num_e_services = Column(Integer, nullable=False)
+
+
+class SyncRun(db.Base):
+    """Represents a sync of one quarter in the 'sync_run' table."""
+    __tablename__ = 'sync_run'
+
+    id = Column(Integer, primary_key=True)
+    year = Column(Integer, nullable=False)
+    quarter = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default='running')  # running, finished or failed
+    started_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __init__(self, **data):
+        """Initializes a SyncRun object with the provided data."""
+        for key, value in data.items(): setattr(self, key, value)
+
+
+class SyncCheckpoint(db.Base):
+    """Represents the outcome of an item (ODA report, page or TsNAP) of a sync run in the 'sync_checkpoint' table."""
+    __tablename__ = 'sync_checkpoint'
+    __table_args__ = (
+        UniqueConstraint('run_id', 'kind', 'key'),
+        Index('ix_sync_checkpoint_run_id_status', 'run_id', 'status', 'kind', 'report_id', postgresql_include=['key']),
+    )
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('sync_run.id'), nullable=False)
+    kind = Column(String, nullable=False)  # report, page or tsnap
+    key = Column(String, nullable=False)  # report id, '<report id>:<page>' or asc_org idf
+    report_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False)  # done or failed
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class SchemaMigration(db.Base):
+    """Represents an applied schema migration in the 'schema_migrations' table."""
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False, default=datetime.utcnow)
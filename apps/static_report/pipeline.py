@@ -0,0 +1,167 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List
+
+from settings import PIPELINE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+_EMPTY = object()
+
+
+class _StageError:
+    """Carries an exception raised in a stage thread to the consumer of its queue."""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StageStats:
+    """
+    Throughput counters of a pipeline stage.
+
+    Attributes:
+        items (int): Number of items the stage produced.
+        blocked (float): Seconds the stage waited for room in its full output queue (downstream is slower).
+        starved (float): Seconds the consumer of the stage waited on its empty output queue (this stage is slower).
+    """
+
+    def __init__(self, name: str, started: float):
+        self.name = name
+        self.items = 0
+        self.blocked = 0.0
+        self.starved = 0.0
+        self.started = started
+        self.finished = None
+
+    def report(self) -> str:
+        """
+        Formats the counters for the log.
+
+        :return str: One line summary of the stage.
+        """
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rate = self.items / elapsed if elapsed > 0 else 0.0
+        return (f'{self.name}: {self.items} items in {elapsed:.2f}s ({rate:.1f}/s), '
+                f'blocked on output {self.blocked:.2f}s, output awaited {self.starved:.2f}s')
+
+
+class Pipeline:
+    """
+    Connects the stages of a sync with bounded queues, each producing stage running in its own thread.
+
+    A stage stops pulling from its input while its output queue is full, so a slow consumer throttles the
+    stages before it instead of letting items pile up in memory. Usage::
+
+        with Pipeline() as pipeline:
+            entries = pipeline.stage('pagination', iter_entries())
+            details = pipeline.stage('detail fetch', fetch_details(entries))
+            for detail in details:
+                with pipeline.measure('write'):
+                    write(detail)
+    """
+
+    def __init__(self, queue_size: int = PIPELINE_QUEUE_SIZE):
+        """
+        :param queue_size: Capacity of the queue after every stage.
+        """
+        self.queue_size = queue_size
+        self.started = time.monotonic()
+        self.stats: Dict[str, StageStats] = {}
+        self._threads: List[threading.Thread] = []
+        self._closed = threading.Event()
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stage(self, name: str, items: Iterable) -> Iterator:
+        """
+        Starts consuming `items` in a background thread.
+
+        :param name: Stage name used in the statistics.
+        :param items: The stage work, usually a generator reading the previous stage.
+
+        :return Iterator: The items produced by the stage, read from its bounded output queue.
+        """
+        stats = self.stats[name] = StageStats(name, self.started)
+        output = queue.Queue(maxsize=self.queue_size)
+        thread = threading.Thread(target=self._run_stage, args=(items, output, stats), name=f'pipeline-{name}', daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+        return self._read(output, stats)
+
+    @contextmanager
+    def measure(self, name: str, items: int = 1):
+        """
+        Counts work done in the calling thread, typically the final stage.
+
+        :param name: Stage name used in the statistics.
+        :param items: Number of items processed by the enclosed block.
+        """
+        stats = self.stats.setdefault(name, StageStats(name, self.started))
+        yield
+        stats.items += items
+        stats.finished = time.monotonic()
+
+    def close(self):
+        """Stops the stage threads, discarding any items still queued, and waits for them to exit."""
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+
+    def log_stats(self):
+        """Writes the throughput of every stage to the log."""
+        for stats in self.stats.values():
+            logger.info(f'Pipeline stage {stats.report()}')
+
+    def _run_stage(self, items: Iterable, output: queue.Queue, stats: StageStats):
+        try:
+            for item in items:
+                if not self._put(output, item, stats):
+                    return
+                stats.items += 1
+            self._put(output, _DONE, stats)
+        except BaseException as err:
+            self._put(output, _StageError(err), stats)
+        finally:
+            stats.finished = time.monotonic()
+            if hasattr(items, 'close'):
+                items.close()
+
+    def _put(self, output: queue.Queue, item, stats: StageStats) -> bool:
+        started = time.monotonic()
+        try:
+            while not self._closed.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.blocked += time.monotonic() - started
+
+    def _read(self, output: queue.Queue, stats: StageStats) -> Iterator:
+        while True:
+            started = time.monotonic()
+            item = _EMPTY
+            while item is _EMPTY and not self._closed.is_set():
+                try:
+                    item = output.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            stats.starved += time.monotonic() - started
+
+            if item is _EMPTY or item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
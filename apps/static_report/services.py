@@ -1,25 +1,328 @@
-from apps.static_report.dao_services import SRDiiaApiDaoService, ODAReportDaoService, TsNAPReportDaoService
+import logging
+import threading
+from contextlib import nullcontext
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from apps.static_report.cache import lookup_cache
+from apps.static_report.dao_services import (SRDiiaApiDaoService, IntegrityDaoService, ODAReportDaoService,
+                                             ReportViewDaoService, SyncRunDaoService, TsNAPReportDaoService)
+from apps.static_report.pipeline import Pipeline
+from apps.static_report.snapshot import SnapshotApiDaoService
+from apps.static_report.types import ODAReport, TSNAPDetails, TSNAPRegion
+from apps.static_report.utils import bounded_map, chunked, lazy_chunks
+from http_client import http_client
+from profiler import profiler
+from response_cache import response_cache
+from settings import (DETAIL_FETCH_CONCURRENCY, SQL_STATEMENT_BUDGET_PER_TSNAP, SYNC_COMMIT_BATCH_SIZE, SYNC_WRITE_MODE,
+                      TSNAP_WRITE_BATCH_SIZE)
+from sql_audit import per_entity, sql_audit
+
+logger = logging.getLogger(__name__)
 
 
 class TsNAPStaticReportService:
-    """Service to manage ODA and TsNAP data."""
-    oda_report_dao_service = ODAReportDaoService()
-    tsnap_report_dao_service = TsNAPReportDaoService()
-    sr_dia_api_dao_service = SRDiiaApiDaoService()
+    """
+    Service to manage ODA and TsNAP data.
+
+    Every instance has its own DAO services and database sessions, so services running in several threads
+    or worker processes never share a session; a session holds a pooled connection only during a transaction.
+    """
+    write_modes = ('orm', 'bulk', 'copy')
+
+    def __init__(self, detail_fetch_concurrency: int = DETAIL_FETCH_CONCURRENCY, write_mode: str = SYNC_WRITE_MODE,
+                 write_batch_size: int = TSNAP_WRITE_BATCH_SIZE, commit_batch_size: int = SYNC_COMMIT_BATCH_SIZE,
+                 run_id: Optional[int] = None, write_lock: Optional[threading.Lock] = None,
+                 keep_lookup_cache: bool = False, snapshot_path: Optional[str] = None, snapshot_mmap: bool = False):
+        """
+        :param detail_fetch_concurrency: Maximum number of TsNAP detail requests running in parallel.
+        :param write_mode: 'orm' writes TsNAPs one by one, 'bulk' upserts them in set-based batches, 'copy'
+            loads them into staging tables with COPY and merges them once per transaction.
+        :param write_batch_size: Number of TsNAPs preloaded (in the 'orm' mode), upserted (in the 'bulk'
+            mode) or copied (in the 'copy' mode) together.
+        :param commit_batch_size: Number of TsNAPs per transaction. 0 commits once per ODA report.
+        :param run_id: Checkpoint into this already started sync run, e.g. in a worker process.
+        :param write_lock: Held for every ODA report write and TsNAP transaction, to keep services running in
+            several threads from writing the same rows at the same time. A TsNAP transaction is fetched before
+            the lock is taken.
+        :param keep_lookup_cache: Keep the shared lookup cache after the sync instead of clearing it, for the
+            next sync to reuse.
+        :param snapshot_path: Import this snapshot (see `SnapshotExporter`) instead of fetching from the DIIA API.
+        :param snapshot_mmap: Read the snapshot through a memory map.
+        """
+        if write_mode not in self.write_modes:
+            raise ValueError(f'Unknown write mode: {write_mode}. Expected one of {self.write_modes}.')
+
+        self.detail_fetch_concurrency = detail_fetch_concurrency
+        self.write_mode = write_mode
+        self.write_batch_size = write_batch_size
+        self.commit_batch_size = commit_batch_size
+        self.write_lock = write_lock
+        self.keep_lookup_cache = keep_lookup_cache
+        self.failed_reports: List[int] = []
+        self.failed_fetches: List[str] = []
+
+        self.oda_report_dao_service = ODAReportDaoService()
+        self.tsnap_report_dao_service = TsNAPReportDaoService()
+        self.sync_run_dao_service = SyncRunDaoService()
+        self.report_view_dao_service = ReportViewDaoService()
+        self.integrity_dao_service = IntegrityDaoService()
+        if snapshot_path:
+            self.sr_dia_api_dao_service = SnapshotApiDaoService.open(snapshot_path, snapshot_mmap)
+        else:
+            self.sr_dia_api_dao_service = SRDiiaApiDaoService()
+        if run_id is not None:
+            self.sync_run_dao_service.attach(run_id)
+
+    def create_or_update(self, year: int, quarter: int, resume: bool = False, retry_failed: bool = False):
+        """
+        Syncs all ODA reports of a quarter as a checkpointed run.
+
+        :param year: The year of the reports.
+        :param quarter: The quarter (1 to 4) of the reports.
+        :param resume: Continue the last unfinished run of the quarter, skipping the items it finished.
+        :param retry_failed: Continue the last unfinished run, syncing only the ODA reports with failed items.
+        """
+        with profiler.profiling():
+            self.sync_run_dao_service.start(year, quarter, resume=resume or retry_failed)
+            oda_reports = self.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+
+            self.create_or_update_reports(self.sync_run_dao_service.pending_reports(oda_reports, retry_failed))
+        logger.info(f'Sync run {self.sync_run_dao_service.run_id}: {self.sync_run_dao_service.finish()}')
+        summary = self.summary()
+        log_summary(summary)
+        audit_writes(self.integrity_dao_service, summary)
+        refresh_views(self.report_view_dao_service, summary)
+
+    def create_or_update_reports(self, oda_reports: List[ODAReport]):
+        """
+        Syncs the given ODA reports with their TsNAPs. A report that fails is logged and recorded in
+        `failed_reports`, and the sync goes on with the next one.
+
+        :param oda_reports: ODA reports from the DIIA API.
+        """
+        try:
+            for report in oda_reports:
+                try:
+                    with self.write_lock or nullcontext():
+                        self.oda_report_dao_service.update_or_create(report)
+
+                    complete = self.create_or_update_tsnaps(report['id'])
+                except Exception as err:
+                    logger.exception(f'Failed to sync ODA report {report["id"]}: {err}')
+                    self.oda_report_dao_service.session.rollback()
+                    self.failed_reports.append(report['id'])
+                    complete = False
+
+                self.sync_run_dao_service.mark('report', report['id'], [report['id']], 'done' if complete else 'failed')
+        finally:
+            logger.info(f'Lookup cache: {lookup_cache.stats()}')
+            if not self.keep_lookup_cache:
+                lookup_cache.clear()
+
+    def close(self):
+        """Ends the sessions of the DAO services."""
+        for dao_service in (self.oda_report_dao_service, self.tsnap_report_dao_service, self.sync_run_dao_service,
+                            self.report_view_dao_service, self.integrity_dao_service):
+            dao_service.close()
+
+    def summary(self) -> dict:
+        """
+        Returns the outcome of the sync so far.
+
+        :return dict: Change counts, failed items, DIIA API request, response cache and concurrency counters,
+            and the SQL audit counters.
+        """
+        return {
+            'oda_reports': dict(self.oda_report_dao_service.change_counts),
+            'tsnaps': dict(self.tsnap_report_dao_service.change_counts),
+            'requests': http_client.stats(),
+            'response_cache': response_cache.stats(),
+            'api_concurrency': self.sr_dia_api_dao_service.limiter.stats(),
+            'sql': sql_audit.stats(),
+            'failed_reports': list(self.failed_reports),
+            'failed_fetches': list(self.failed_fetches),
+            'failed_tsnaps': list(self.tsnap_report_dao_service.failed_items),
+        }
+
+    def create_or_update_tsnaps(self, report_id) -> bool:
+        """
+        Syncs the TsNAPs of an ODA report as a pipeline: pagination, detail fetching and writing run at the
+        same time, connected by bounded queues.
+
+        TsNAPs the current run has already written are not fetched again. Written TsNAPs are checkpointed
+        after every commit; pages and TsNAPs that could not be fetched or saved are checkpointed as failed.
+
+        :param report_id: The ID of the ODA report.
+
+        :return bool: True if every page and every TsNAP of the report was synced.
+        """
+        done_tsnaps = self.sync_run_dao_service.keys('done', kind='tsnap', report_id=report_id)
+        # Filled by the pipeline threads; list.append is thread-safe.
+        pages = []
+        fetch_failures = []
+        save_failures = []
+
+        with Pipeline() as pipeline:
+            pending_tsnaps = pipeline.stage('pagination', self.sr_dia_api_dao_service.iter_tsnaps_in_region(
+                report_id, on_page=lambda page, response: pages.append((page, 'results' in response)),
+                skip=done_tsnaps))
+            tsnap_details = pipeline.stage('detail fetch', self.fetch_tsnap_details(pending_tsnaps, fetch_failures))
+
+            for transaction_details in lazy_chunks(tsnap_details, self.commit_batch_size):
+                written, failed = self.write_tsnaps(report_id, transaction_details, pipeline)
+                self.sync_run_dao_service.mark('tsnap', report_id, written, 'done')
+                self.sync_run_dao_service.mark('tsnap', report_id, failed, 'failed')
+                save_failures.extend(failed)
+
+        pipeline.log_stats()
+
+        failed_pages = [f'{report_id}:{page}' for page, fetched in pages if not fetched]
+        self.sync_run_dao_service.mark('page', report_id, [f'{report_id}:{page}' for page, fetched in pages if fetched], 'done')
+        self.sync_run_dao_service.mark('page', report_id, failed_pages, 'failed')
+        self.sync_run_dao_service.mark('tsnap', report_id, fetch_failures, 'failed')
+        self.failed_fetches.extend(fetch_failures)
+
+        return not (failed_pages or fetch_failures or save_failures)
+
+    def write_tsnaps(self, report_id: int, details: Iterable[TSNAPDetails],
+                     pipeline: Optional[Pipeline] = None) -> Tuple[List[str], List[str]]:
+        """
+        Writes TsNAPs of an ODA report in one transaction, together with the rollups of the report.
+
+        :param report_id: The ID of the ODA report; it must already be saved.
+        :param details: Details of the TsNAPs, written in batches of `write_batch_size`.
+        :param pipeline: The pipeline to count the write and merge work in, if any.
+
+        :return tuple: idfs of the written TsNAPs and of the TsNAPs that failed.
+        """
+        if self.write_lock is not None:
+            details = list(details)
+        measure = pipeline.measure if pipeline is not None else lambda name, items=1: nullcontext()
+
+        written, failed = [], []
+        with self.write_lock or nullcontext(), sql_audit.entity('tsnap'), self.tsnap_report_dao_service.unit_of_work():
+            for batch in chunked(details, self.write_batch_size):
+                with measure('write', len(batch)):
+                    failed.extend(self._write_tsnaps(batch))
+                written.extend(tsnap_detail['asc_org']['idf'] for tsnap_detail in batch)
+            if self.write_mode == 'copy':
+                with measure('merge', len(written)):
+                    self.tsnap_report_dao_service.merge_staged()
+            written = [idf for idf in written if idf not in failed]
+            self.tsnap_report_dao_service.update_rollups(report_id, written)
+
+        return written, failed
+
+    def fetch_tsnap_details(self, tsnaps_in_region: Iterable[TSNAPRegion], failures: List[str]) -> Iterator[TSNAPDetails]:
+        """
+        Fetches the details of TsNAPs in parallel, keeping the order of the region listing.
+
+        :param tsnaps_in_region: TsNAPs of the region.
+        :param failures: Collects the idfs of the TsNAPs whose details could not be fetched.
+
+        :return Iterator[TSNAPDetails]: Details of the TsNAPs that have them.
+        """
+        fetched = bounded_map(lambda tsnap: (tsnap, self.sr_dia_api_dao_service.get_tsnap_details(tsnap['id'])),
+                              tsnaps_in_region, self.detail_fetch_concurrency)
+
+        for tsnap, tsnap_detail in fetched:
+            if tsnap_detail is None:
+                failures.append(tsnap['asc_org']['idf'])
+            elif tsnap_detail:
+                yield tsnap_detail[0]
+
+    def _write_tsnaps(self, batch: List[TSNAPDetails]) -> List[str]:
+        """
+        Writes a batch of TsNAPs in the current transaction.
+
+        In the 'orm' write mode every TsNAP runs in its own savepoint, so one that fails is rolled back,
+        logged and skipped. In the 'copy' write mode the batch is only staged; `merge_staged` writes it
+        before the commit.
+
+        :param batch: Details of the TsNAPs to write.
+
+        :return List[str]: idfs of the TsNAPs that failed.
+        """
+        if self.write_mode == 'bulk':
+            self.tsnap_report_dao_service.bulk_update_or_create(batch)
+            return []
+        if self.write_mode == 'copy':
+            self.tsnap_report_dao_service.stage(batch)
+            return []
+
+        failed_before = len(self.tsnap_report_dao_service.failed_items)
+        self.tsnap_report_dao_service.preload([tsnap_detail['asc_org']['idf'] for tsnap_detail in batch])
+        for tsnap_detail in batch:
+            with self.tsnap_report_dao_service.savepoint(tsnap_detail['asc_org']['idf']):
+                self.tsnap_report_dao_service.update_or_create(tsnap_detail)
+        self.tsnap_report_dao_service.release()
+
+        return self.tsnap_report_dao_service.failed_items[failed_before:]
+
+
+def refresh_views(report_view_dao_service: ReportViewDaoService, summary: dict):
+    """
+    Refreshes the materialized report views if the sync created or changed any TsNAP.
+
+    :param report_view_dao_service: The DAO service of the views.
+    :param summary: The summary of the sync.
+    """
+    if summary['tsnaps'].get('new') or summary['tsnaps'].get('changed'):
+        report_view_dao_service.refresh()
+
+
+def audit_writes(integrity_dao_service: IntegrityDaoService, summary: dict) -> List[str]:
+    """
+    Logs the SQL statements of a sync per processed entity and flags its write amplification, if the SQL
+    audit is enabled.
+
+    Flagged are: more rows written to a TsNAP table than TsNAPs were created or changed, more statements
+    per TsNAP than `SQL_STATEMENT_BUDGET_PER_TSNAP` (when set), and orphaned or shared rows in the
+    database (see `IntegrityDaoService`).
+
+    :param integrity_dao_service: The DAO service of the integrity checks.
+    :param summary: The summary of the sync.
+
+    :return List[str]: The flagged problems.
+    """
+    if not sql_audit.enabled:
+        return []
+
+    problems = []
+    for entity, counts in per_entity(summary['sql']).items():
+        logger.info(f'SQL statements of {entity}: {counts}')
 
-    def create_or_update(self, year: int, quarter: int):
-        oda_reports = self.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+    written = summary['tsnaps'].get('new', 0) + summary['tsnaps'].get('changed', 0)
+    for model, _ in TsNAPReportDaoService.staged_models:
+        rows = summary['sql'].get(f'rows/{model.__tablename__}', 0)
+        if rows > written:
+            problems.append(f'{rows} rows written to {model.__tablename__} for {written} new or changed TsNAPs')
 
-        for report in oda_reports:
-            self.oda_report_dao_service.update_or_create(report)
+    per_tsnap = per_entity(summary['sql']).get('tsnap', {}).get('per_item')
+    if SQL_STATEMENT_BUDGET_PER_TSNAP and per_tsnap and per_tsnap > SQL_STATEMENT_BUDGET_PER_TSNAP:
+        problems.append(f'{per_tsnap} SQL statements per TsNAP, over the budget of {SQL_STATEMENT_BUDGET_PER_TSNAP}')
 
-            self.create_or_update_tsnaps(report['id'])
+    problems.extend(f'{count} {name.replace("/", " ")} rows'
+                    for name, count in integrity_dao_service.anomalies().items() if count)
+    for problem in problems:
+        logger.error(f'Write audit: {problem}')
+    return problems
 
-    def create_or_update_tsnaps(self, report_id):
-        tsnaps_in_region = self.sr_dia_api_dao_service.get_tsnaps_in_region(report_id)
 
-        for tsnap in tsnaps_in_region:
-            tsnap_detail = self.sr_dia_api_dao_service.get_tsnap_details(tsnap['id'])
+def log_summary(summary: dict):
+    """
+    Writes the outcome of a sync to the log.
 
-            if tsnap_detail:
-                self.tsnap_report_dao_service.update_or_create(tsnap_detail[0])
+    :param summary: The summary returned by `TsNAPStaticReportService.summary`.
+    """
+    logger.info(f'DIIA API requests: {summary["requests"]}')
+    logger.info(f'DIIA API response cache: {summary["response_cache"]}')
+    logger.info(f'DIIA API concurrency: {summary["api_concurrency"]}')
+    logger.info(f'ODA reports: {summary["oda_reports"]}')
+    logger.info(f'TsNAPs: {summary["tsnaps"]}')
+    if summary['failed_reports']:
+        logger.error(f'Failed ODA reports: {", ".join(map(str, summary["failed_reports"]))}')
+    if summary['failed_fetches']:
+        logger.error(f'Failed to fetch TsNAPs: {", ".join(summary["failed_fetches"])}')
+    if summary['failed_tsnaps']:
+        logger.error(f'Failed to save TsNAPs: {", ".join(summary["failed_tsnaps"])}')
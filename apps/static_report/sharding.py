@@ -0,0 +1,149 @@
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+import instrumentation
+from apps.static_report.dao_services import (IntegrityDaoService, ReportViewDaoService, SRDiiaApiDaoService,
+                                             SyncRunDaoService)
+from apps.static_report.services import TsNAPStaticReportService, audit_writes, log_summary, refresh_views
+from apps.static_report.snapshot import SnapshotApiDaoService
+from apps.static_report.types import ODAReport
+from profiler import profiler
+from rate_limiter import api_limiter
+from settings import SYNC_WORKER_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+
+def sync_shard(oda_reports: List[ODAReport], service_options: dict,
+               max_concurrency: int = api_limiter.max_limit, max_rps: float = api_limiter.max_rps) -> Tuple[dict, dict]:
+    """
+    Syncs a shard of ODA reports in a worker process.
+
+    The worker gets its own database connections, HTTP session and API limiter: all are reset after fork
+    (see `forking.after_fork`).
+
+    :param oda_reports: ODA reports of the shard.
+    :param service_options: Keyword arguments for `TsNAPStaticReportService`.
+    :param max_concurrency: The share of the API concurrency ceiling this worker may use.
+    :param max_rps: The share of the API requests-per-second ceiling this worker may use.
+
+    :return tuple: The summary of the shard, and its metrics and profile samples from `instrumentation.export`.
+    """
+    # A worker process may run several shards; each one reports only its own metrics.
+    instrumentation.reset()
+    # Assigned, not scaled: the limiter of the process still has the ceilings of the previous shard.
+    api_limiter.set_share(max_concurrency, max_rps)
+    service = TsNAPStaticReportService(**service_options)
+    try:
+        with profiler.profiling():
+            service.create_or_update_reports(oda_reports)
+        return service.summary(), instrumentation.export()
+    finally:
+        service.close()
+
+
+def merge_summaries(summaries: List[dict]) -> dict:
+    """
+    Merges the summaries of several shards: counters are added up, failed items are concatenated.
+
+    :param summaries: Summaries returned by `sync_shard`.
+
+    :return dict: The summary of the whole sync.
+    """
+    merged = {'oda_reports': Counter(), 'tsnaps': Counter(), 'requests': Counter(), 'response_cache': Counter(),
+              'api_concurrency': Counter(), 'sql': Counter(),
+              'failed_reports': [], 'failed_fetches': [], 'failed_tsnaps': []}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(merged[key], Counter):
+                merged[key].update(value)
+            else:
+                merged[key].extend(value)
+
+    return {key: dict(value) if isinstance(value, Counter) else value for key, value in merged.items()}
+
+
+class ShardedStaticReportService:
+    """
+    Syncs the ODA reports of a quarter in several worker processes.
+
+    Regions are independent, so the reports are spread round-robin over the workers and each worker runs
+    the regular `TsNAPStaticReportService` on its shard. Every worker opens its own database connections,
+    so `workers` times `DB_POOL_SIZE` plus `DB_MAX_OVERFLOW` has to fit into the database connection budget.
+    """
+
+    def __init__(self, workers: int = SYNC_WORKER_PROCESSES, **service_options):
+        """
+        :param workers: Number of worker processes.
+        :param service_options: Keyword arguments for `TsNAPStaticReportService` in the workers.
+        """
+        self.workers = workers
+        self.service_options = service_options
+        self.sync_run_dao_service = SyncRunDaoService()
+        self.report_view_dao_service = ReportViewDaoService()
+        self.integrity_dao_service = IntegrityDaoService()
+        if service_options.get('snapshot_path'):
+            self.sr_dia_api_dao_service = SnapshotApiDaoService.open(service_options['snapshot_path'])
+        else:
+            self.sr_dia_api_dao_service = SRDiiaApiDaoService()
+
+    def create_or_update(self, year: int, quarter: int, resume: bool = False, retry_failed: bool = False) -> dict:
+        """
+        Syncs all ODA reports of a quarter as a checkpointed run shared by all workers.
+
+        :param year: The year of the reports.
+        :param quarter: The quarter (1 to 4) of the reports.
+        :param resume: Continue the last unfinished run of the quarter, skipping the items it finished.
+        :param retry_failed: Continue the last unfinished run, syncing only the ODA reports with failed items.
+
+        :return dict: The merged summary of all workers.
+        """
+        run_id = self.sync_run_dao_service.start(year, quarter, resume=resume or retry_failed)
+        oda_reports = self.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+        oda_reports = self.sync_run_dao_service.pending_reports(oda_reports, retry_failed)
+        # The workers are forked: nothing of this session may be in use while they run.
+        self.sync_run_dao_service.close()
+
+        summary = self.create_or_update_reports(oda_reports, run_id)
+        logger.info(f'Sync run {run_id}: {self.sync_run_dao_service.finish()}')
+        log_summary(summary)
+        audit_writes(self.integrity_dao_service, summary)
+        refresh_views(self.report_view_dao_service, summary)
+        return summary
+
+    def create_or_update_reports(self, oda_reports: List[ODAReport], run_id: Optional[int] = None) -> dict:
+        """
+        Spreads ODA reports over the workers and waits for all of them.
+
+        A worker that crashes does not stop the others: its reports are recorded as failed.
+
+        :param oda_reports: ODA reports from the DIIA API.
+        :param run_id: The sync run the workers checkpoint into.
+
+        :return dict: The merged summary of all workers.
+        """
+        shards = [shard for shard in (oda_reports[index::self.workers] for index in range(self.workers)) if shard]
+        if not shards:
+            return merge_summaries([])
+
+        summaries = []
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('fork')) as executor:
+            service_options = {**self.service_options, 'run_id': run_id}
+            max_concurrency = max(api_limiter.max_limit // len(shards), 1)
+            max_rps = api_limiter.max_rps / len(shards)
+            futures = {executor.submit(sync_shard, shard, service_options, max_concurrency, max_rps): shard
+                       for shard in shards}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    summary, exported = future.result()
+                    summaries.append(summary)
+                    instrumentation.merge(exported)
+                except Exception as err:
+                    logger.exception(f'Worker failed: {err}')
+                    summaries.append({'failed_reports': [report['id'] for report in shard]})
+
+        return merge_summaries(summaries)
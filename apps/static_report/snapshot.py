@@ -0,0 +1,285 @@
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Collection, Dict, Iterator, List, Optional, Tuple
+
+import json_stream
+from apps.static_report.dao_services import SRDiiaApiDaoService
+from apps.static_report.types import ODAReport, TSNAPDetails, TSNAPRegion
+from apps.static_report.utils import bounded_map
+from rate_limiter import api_limiter
+from settings import DETAIL_FETCH_CONCURRENCY, SNAPSHOT_EXPORT_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+READ_CHUNK_SIZE = 1 << 20
+
+
+def index_path(path: str) -> str:
+    return f'{path}.idx'
+
+
+class SnapshotExporter:
+    """
+    Dumps the DIIA API data of a quarter into a snapshot file, to sync it later without the API.
+
+    The snapshot is a series of gzip members, one per ODA report (region), so `zcat` reads it whole and a
+    region can be decompressed on its own. Every member holds one JSON line per TsNAP of the region:
+    `{"entry": <item of entries/>, "details": <results of detail/>}`, with `null` details if they could not
+    be fetched. The `PATH.idx` index (JSON) has the `list/` items of the quarter with the offset and length
+    of their members and the outcome of every entries page.
+    """
+    def __init__(self, region_concurrency: int = SNAPSHOT_EXPORT_CONCURRENCY,
+                 detail_fetch_concurrency: int = DETAIL_FETCH_CONCURRENCY):
+        """
+        :param region_concurrency: Number of regions fetched at the same time.
+        :param detail_fetch_concurrency: Maximum number of TsNAP detail requests of a region running in parallel.
+        """
+        self.region_concurrency = max(region_concurrency, 1)
+        self.detail_fetch_concurrency = detail_fetch_concurrency
+        self.sr_dia_api_dao_service = SRDiiaApiDaoService()
+
+    def export(self, path: str, year: int, quarter: int) -> dict:
+        """
+        Writes the snapshot of a quarter. The snapshot and its index replace the old ones only once complete.
+
+        :param path: The snapshot file.
+        :param year: The year of the reports.
+        :param quarter: The quarter (1 to 4) of the reports.
+
+        :return dict: Number of exported regions and TsNAPs, and the TsNAPs and pages that could not be fetched.
+        """
+        oda_reports = self.sr_dia_api_dao_service.get_oda_reports(year, quarter)
+        regions = []
+        summary = {'regions': 0, 'tsnaps': 0, 'failed_fetches': [], 'failed_pages': []}
+
+        with open(f'{path}.tmp', 'wb') as file, \
+                ThreadPoolExecutor(max_workers=self.region_concurrency, thread_name_prefix='export') as executor:
+            futures = {executor.submit(self._export_region, report): report for report in oda_reports}
+            for future in as_completed(futures):
+                report = futures[future]
+                member, tsnaps, pages, failures = future.result()
+                regions.append({'report': report, 'offset': file.tell(), 'length': len(member), 'tsnaps': tsnaps,
+                                'pages': pages})
+                file.write(member)
+
+                summary['regions'] += 1
+                summary['tsnaps'] += tsnaps
+                summary['failed_fetches'].extend(failures)
+                summary['failed_pages'].extend(f'{report["id"]}:{page}' for page, fetched in pages if not fetched)
+                logger.info(f'Exported ODA report {report["id"]}: {tsnaps} TsNAPs.')
+
+        index = {'format': SNAPSHOT_FORMAT, 'year': year, 'quarter': quarter,
+                 'created_at': datetime.now().isoformat(timespec='seconds'),
+                 'regions': sorted(regions, key=lambda region: region['offset'])}
+        with open(f'{index_path(path)}.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(f'{path}.tmp', path)
+        os.replace(f'{index_path(path)}.tmp', index_path(path))
+
+        logger.info(f'Snapshot {path} of {year} Q{quarter}: {summary["regions"]} regions, {summary["tsnaps"]} TsNAPs.')
+        if summary['failed_fetches'] or summary['failed_pages']:
+            logger.error(f'Not in the snapshot: TsNAPs {", ".join(summary["failed_fetches"]) or "-"}; '
+                         f'pages {", ".join(summary["failed_pages"]) or "-"}')
+        return summary
+
+    def _export_region(self, report: ODAReport) -> Tuple[bytes, int, List[Tuple[int, bool]], List[str]]:
+        """
+        Fetches the TsNAPs of a region with their details and compresses them into a gzip member.
+
+        :param report: The ODA report of the region.
+
+        :return tuple: The member, the number of TsNAPs, `(page, fetched)` of every entries page and the idfs of
+            the TsNAPs whose details could not be fetched.
+        """
+        pages, failures, tsnaps = [], [], 0
+        entries = self.sr_dia_api_dao_service.iter_tsnaps_in_region(
+            report['id'], on_page=lambda page, response: pages.append((page, 'results' in response)))
+        fetched = bounded_map(lambda entry: (entry, self.sr_dia_api_dao_service.get_tsnap_details(entry['id'])),
+                              entries, self.detail_fetch_concurrency)
+
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as member:
+            for entry, details in fetched:
+                if details is None:
+                    failures.append(entry['asc_org']['idf'])
+                member.write(json.dumps({'entry': entry, 'details': details}, ensure_ascii=False).encode())
+                member.write(b'\n')
+                tsnaps += 1
+
+        return buffer.getvalue(), tsnaps, pages, failures
+
+
+class SnapshotReader:
+    """
+    Reads the regions of a snapshot written by `SnapshotExporter`.
+
+    Regions are located through the index and decompressed chunk by chunk while their lines are read, so
+    memory stays constant however large a region is. Chunks are read with `pread` or, with `use_mmap`, from
+    a read-only memory map of the file that the page cache shares among all the processes importing it.
+    Both are safe to use from several threads.
+    """
+
+    def __init__(self, path: str, use_mmap: bool = False):
+        """
+        :param path: The snapshot file; its index is `PATH.idx`.
+        :param use_mmap: Read through a memory map instead of `pread`.
+        """
+        self.path = path
+        self.index = self.read_index(path)
+        self.regions = {region['report']['id']: region for region in self.index['regions']}
+        self._fd = os.open(path, os.O_RDONLY)
+        self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ) if use_mmap and os.fstat(self._fd).st_size else None
+
+    @staticmethod
+    def read_index(path: str) -> dict:
+        """
+        Loads the index of a snapshot.
+
+        :param path: The snapshot file.
+
+        :return dict: The index.
+        :raises ValueError: If the snapshot is of an unknown format.
+        """
+        with open(index_path(path)) as file:
+            index = json.load(file)
+        if index.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f'Unsupported snapshot format {index.get("format")} of {path}')
+        return index
+
+    @property
+    def year(self) -> int:
+        return self.index['year']
+
+    @property
+    def quarter(self) -> int:
+        return self.index['quarter']
+
+    def iter_region(self, report_id: int) -> Iterator[dict]:
+        """
+        Yields the TsNAPs of a region one by one, as `{"entry": ..., "details": ...}` records.
+
+        :param report_id: The ID of the ODA report of the region.
+
+        :return Iterator[dict]: The records; none if the region is not in the snapshot.
+        """
+        region = self.regions.get(report_id)
+        if region is None:
+            return
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pending = b''
+        for chunk in self._chunks(region['offset'], region['length']):
+            pending += decompressor.decompress(chunk)
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                yield json_stream.loads(line)
+        pending += decompressor.flush()
+        if pending.strip():
+            yield json_stream.loads(pending)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        os.close(self._fd)
+
+    def _chunks(self, offset: int, length: int) -> Iterator[bytes]:
+        end = offset + length
+        while offset < end:
+            size = min(READ_CHUNK_SIZE, end - offset)
+            chunk = self._mmap[offset:offset + size] if self._mmap is not None else os.pread(self._fd, size, offset)
+            if not chunk:
+                raise ValueError(f'Snapshot {self.path} is truncated')
+            yield chunk
+            offset += len(chunk)
+
+
+class SnapshotApiDaoService:
+    """
+    Serves a snapshot in place of the DIIA API, so that the regular sync imports it: all write modes,
+    checkpoints, sharding across worker processes and rollups work as with the API.
+
+    TsNAP details travel with their listing entries; `iter_tsnaps_in_region` keeps them until
+    `get_tsnap_details` asks for them, which the pipeline does shortly after, so only the TsNAPs in flight
+    are held in memory. Skipped TsNAPs are never kept, and the details of a region whose iteration is
+    abandoned are dropped.
+    """
+    limiter = api_limiter
+
+    def __init__(self, reader: SnapshotReader):
+        """
+        :param reader: The snapshot.
+        """
+        self.reader = reader
+        self._details: Dict[int, Tuple[int, Optional[List[TSNAPDetails]]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: str, use_mmap: bool = False) -> 'SnapshotApiDaoService':
+        return cls(SnapshotReader(path, use_mmap))
+
+    def get_oda_reports(self, year: int, quarter: int) -> List[ODAReport]:
+        """
+        Returns the ODA reports of the snapshot.
+
+        :param year: Must be the year of the snapshot.
+        :param quarter: Must be the quarter of the snapshot.
+
+        :return List[ODAReport]: The ODA reports, or an empty list for another quarter.
+        """
+        if (year, quarter) != (self.reader.year, self.reader.quarter):
+            logger.error(f'Snapshot {self.reader.path} is of {self.reader.year} Q{self.reader.quarter}, '
+                         f'not of {year} Q{quarter}.')
+            return []
+        return [region['report'] for region in self.reader.index['regions']]
+
+    def iter_tsnaps_in_region(self, report_id: int, on_page: Optional[Callable[[int, dict], None]] = None,
+                              skip: Collection[str] = ()) -> Iterator[TSNAPRegion]:
+        """
+        Yields the TsNAPs of a region from the snapshot.
+
+        :param report_id: The ID of the ODA report.
+        :param on_page: Called, once the region is read, with the entries pages as the export fetched them:
+            pages it could not fetch are reported as failed again.
+        :param skip: asc_org idfs of TsNAPs not to yield, e.g. those a resumed run has already written.
+
+        :return Iterator[TSNAPRegion]: TSNAP regions associated with the specified report ID.
+        """
+        logger.info(f'Get list of TSNAP region from snapshot: report_id: {report_id}')
+        try:
+            for record in self.reader.iter_region(report_id):
+                if record['entry']['asc_org']['idf'] in skip:
+                    continue
+                with self._lock:
+                    self._details[record['entry']['id']] = (report_id, record['details'])
+                yield record['entry']
+        except GeneratorExit:
+            # The consumer gave up on the region: nobody will ask for the details still kept.
+            with self._lock:
+                for entry_id in [entry_id for entry_id, (region, _) in self._details.items() if region == report_id]:
+                    del self._details[entry_id]
+            raise
+
+        region = self.reader.regions.get(report_id, {})
+        for page, fetched in region.get('pages', []):
+            if on_page is not None:
+                on_page(page, {'results': []} if fetched else {})
+
+    def get_tsnap_details(self, report_entries_id: int) -> Optional[List[TSNAPDetails]]:
+        """
+        Returns the details of a TsNAP yielded by `iter_tsnaps_in_region`.
+
+        :param report_entries_id: The ID of the TSNAP report entry.
+
+        :return List[TSNAPDetails]: The details, or None if the export could not fetch them.
+        """
+        with self._lock:
+            return self._details.pop(report_entries_id, (None, None))[1]
@@ -1,4 +1,13 @@
 import datetime
+import hashlib
+import itertools
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
 
 
 def get_current_quarter() -> int:
@@ -9,9 +18,9 @@ def get_current_quarter() -> int:
         The current quarter as an integer (1 to 4).
     """
     current_month = datetime.datetime.now().month
-    quarter_count = 4
+    months_per_quarter = 3
 
-    return current_month//quarter_count + 1
+    return (current_month - 1)//months_per_quarter + 1
 
 
 def get_current_year() -> int:
@@ -22,3 +31,129 @@ def get_current_year() -> int:
         The current year as an integer (1 to 12).
     """
     return datetime.datetime.now().year
+
+
+def parse_quarter(value: str) -> Tuple[int, int]:
+    """
+    Parse a quarter written as `YYYYQN`, e.g. `2024Q3`.
+
+    :param value: The quarter.
+
+    :return Tuple[int, int]: The year and the quarter (1 to 4).
+    :raises ValueError: If the value is not a quarter.
+    """
+    year, separator, quarter = value.upper().partition('Q')
+    if not separator or not year.isdigit() or quarter not in ('1', '2', '3', '4'):
+        raise ValueError(f'Invalid quarter: {value!r}. Expected YYYYQN, e.g. 2024Q3.')
+
+    return int(year), int(quarter)
+
+
+def quarter_range(first: Tuple[int, int], last: Tuple[int, int]) -> List[Tuple[int, int]]:
+    """
+    List the quarters from `first` to `last`, both included.
+
+    :param first: The first `(year, quarter)`.
+    :param last: The last `(year, quarter)`.
+
+    :return List[Tuple[int, int]]: `(year, quarter)` pairs in chronological order; empty if `last` is before `first`.
+    """
+    return [(index // 4, index % 4 + 1) for index in range(first[0] * 4 + first[1] - 1, last[0] * 4 + last[1])]
+
+
+def parse_quarter_range(value: str) -> List[Tuple[int, int]]:
+    """
+    Parse a range of quarters written as `FIRST:LAST`, e.g. `2023Q1:2024Q4`, or a single quarter.
+
+    :param value: The range.
+
+    :return List[Tuple[int, int]]: `(year, quarter)` pairs in chronological order.
+    :raises ValueError: If the value is not a range of quarters or `LAST` is before `FIRST`.
+    """
+    first, _, last = value.partition(':')
+    quarters = quarter_range(parse_quarter(first), parse_quarter(last or first))
+    if not quarters:
+        raise ValueError(f'Invalid quarter range: {value!r}. The last quarter is before the first one.')
+
+    return quarters
+
+
+def bounded_map(func: Callable[[T], R], items: Iterable[T], max_workers: int) -> Iterator[R]:
+    """
+    Apply `func` to every item using a thread pool and yield the results in input order.
+
+    Unlike `ThreadPoolExecutor.map`, the input is consumed lazily: at most `2 * max_workers`
+    calls are in flight at once, so a slow consumer does not make results pile up in memory.
+
+    :param func: Callable applied to every item.
+    :param items: Items to process. May be a generator.
+    :param max_workers: Number of worker threads. Values below 2 run `func` sequentially.
+
+    :return Iterator: Results of `func`, in the same order as `items`.
+    """
+    if max_workers < 2:
+        for item in items:
+            yield func(item)
+        return
+
+    window = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Split items into lists of at most `size` elements.
+
+    :param items: Items to split. May be a generator.
+    :param size: Maximum length of a chunk. Values below 1 put all items into a single chunk.
+
+    :return Iterator[List]: Consecutive chunks of `items`.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if 0 < size <= len(chunk):
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def lazy_chunks(items: Iterable[T], size: int) -> Iterator[Iterator[T]]:
+    """
+    Split items into consecutive iterators of at most `size` elements, without materializing them.
+
+    Every chunk must be consumed before the next one is requested.
+
+    :param items: Items to split. May be a generator.
+    :param size: Maximum length of a chunk. Values below 1 put all items into a single chunk.
+
+    :return Iterator[Iterator]: Consecutive chunks of `items`.
+    """
+    iterator = iter(items)
+    for first in iterator:
+        rest = iterator if size < 1 else itertools.islice(iterator, size - 1)
+        yield itertools.chain([first], rest)
+
+
+def payload_hash(data: Any) -> str:
+    """
+    Compute a stable hash of an API payload.
+
+    Keys are sorted before hashing, so the hash does not depend on the order of the fields in the response.
+
+    :param data: JSON-serializable payload.
+
+    :return str: Hex SHA-256 digest.
+    """
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+LIST_PATH = re.compile(r'^/v1/static_reports/list/(\d+)/(\d+)/?$')
+ENTRIES_PATH = re.compile(r'^/v1/static_reports/entries/(\d+)$')
+DETAIL_PATH = re.compile(r'^/v1/static_reports/detail/(\d+)$')
+
+
+class DiiaStub:
+    """
+    A local stand-in for the DIIA static reports API serving synthetic `list/`, `entries/` and `detail/` data.
+
+    Report ids are 1..regions, the entry ids of report `r` are `r * 100000 + n`. Every `list/` request starts
+    a new generation of the data in which `change_rate` of the TsNAPs get a different payload, so repeated
+    runs exercise both the changed and the unchanged write paths. Responses carry an `ETag`, and conditional
+    requests for unchanged bodies are answered with 304.
+    """
+
+    def __init__(self, regions: int = 3, tsnaps_per_region: int = 100, page_size: int = 20,
+                 latency: float = 0.0, error_rate: float = 0.0, change_rate: float = 0.0, seed: int = 0):
+        """
+        :param regions: Number of ODA reports.
+        :param tsnaps_per_region: Number of TsNAPs in every report.
+        :param page_size: Number of entries per `entries/` page.
+        :param latency: Delay of every response, in seconds.
+        :param error_rate: Share of requests answered with 503.
+        :param change_rate: Share of TsNAPs whose payload changes in every new generation.
+        :param seed: Seed of the random errors and changes.
+        """
+        self.regions = regions
+        self.tsnaps_per_region = tsnaps_per_region
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.seed = seed
+        self.generation = 0
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        """The base URL to use as `DIIA_API_URL`."""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> 'DiiaStub':
+        """
+        Starts serving in a background thread.
+
+        :param host: Interface to listen on.
+        :param port: Port to listen on; 0 picks a free one.
+
+        :return DiiaStub: The started stub.
+        """
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='diia-stub', daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stops serving."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, path: str, query: dict) -> tuple:
+        """
+        Builds the response to a request.
+
+        :param path: The request path.
+        :param query: The request query parameters.
+
+        :return tuple: Status code and JSON body.
+        """
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+
+        if failed:
+            return 503, {'detail': 'Service temporarily unavailable.'}
+
+        if match := LIST_PATH.match(path):
+            with self._lock:
+                self.generation += 1
+            year, quarter = int(match.group(1)), int(match.group(2))
+            reports = [self.oda_report(report_id, year, quarter) for report_id in range(1, self.regions + 1)]
+            return 200, {'count': len(reports), 'next': None, 'previous': None, 'results': reports}
+
+        if match := ENTRIES_PATH.match(path):
+            return 200, self.entries_page(int(match.group(1)), int(query.get('page', 1)))
+
+        if match := DETAIL_PATH.match(path):
+            entry_id = int(match.group(1))
+            if not 1 <= entry_id // 100000 <= self.regions:
+                return 404, {'detail': 'Not found.'}
+            return 200, {'results': [self.tsnap_details(entry_id)]}
+
+        return 404, {'detail': 'Not found.'}
+
+    def oda_report(self, report_id: int, year: int, quarter: int) -> dict:
+        """Builds an item of the `list/` response."""
+        return {
+            'id': report_id,
+            'year': year,
+            'quarter': quarter,
+            'rsa': {'name': f'Regional administration {report_id}', 'edrpou': f'{report_id:08d}',
+                    'address': f'Administrative street {report_id}'},
+        }
+
+    def entries_page(self, report_id: int, page: int) -> dict:
+        """Builds a page of the `entries/` response."""
+        first = (page - 1) * self.page_size
+        last = min(first + self.page_size, self.tsnaps_per_region)
+        has_next = last < self.tsnaps_per_region
+        return {
+            'count': self.tsnaps_per_region,
+            'next': f'{self.url}/v1/static_reports/entries/{report_id}?page={page + 1}' if has_next else None,
+            'previous': None,
+            'results': [
+                {'id': entry_id, 'asc_org': self.asc_org(entry_id)}
+                for entry_id in range(report_id * 100000 + first, report_id * 100000 + last)
+            ],
+        }
+
+    def asc_org(self, entry_id: int) -> dict:
+        """Builds the `asc_org` object of a TsNAP."""
+        locality = entry_id % 97
+        return {
+            'idf': f'SN{entry_id:08d}',
+            'name': f'Administrative service center {entry_id}',
+            'address': {
+                'address_full': f'{entry_id} Central street',
+                'postal_code': f'{entry_id % 100000:05d}',
+                'lat': 50.0 + (entry_id % 1000) / 1000,
+                'lon': 30.0 + (entry_id % 1000) / 1000,
+                'locality': {'codifier': f'UA{locality:017d}', 'name': f'Locality {locality}'},
+            },
+        }
+
+    def tsnap_details(self, entry_id: int) -> dict:
+        """Builds the `detail/` payload of a TsNAP. Only fields stored by the models are filled in."""
+        version = self._version(entry_id)
+        idf = f'SN{entry_id:08d}'
+        return {
+            'id': entry_id,
+            'asc_org': self.asc_org(entry_id),
+            'general_data': {
+                'asc_name': f'Administrative service center {entry_id}', 'asc_idf': idf, 'asc_type': 1,
+                'created_by': 'City council', 'edrpou': f'{entry_id:08d}', 'is_diia': entry_id % 2 == 0,
+                'is_active': entry_id % 10 != 0, 'is_inactive': entry_id % 10 == 0, 'created_by_type': 1,
+                'date_created': '2019-01-15', 'region': f'Region {entry_id // 100000}',
+                'num_days_per_week': 5, 'num_served_people': 1000 + version, 'website': f'https://asc{entry_id}.example',
+            },
+            'activity_data': {
+                'num_total_empl': 10 + entry_id % 20, 'manager_name': f'Manager {entry_id}', 'num_managers': 1,
+                'has_online_inform': True, 'num_feedback_total': version, 'has_technical_room': False,
+            },
+            'info_support_data': {
+                'has_person_org_register': True, 'has_real_estate_rights_register': True,
+                'has_demography_register': True, 'has_land_cadastre': entry_id % 3 == 0, 'has_e_sevices': True,
+            },
+            'admin_service_data': {
+                'num_total_services': 100 + entry_id % 50, 'num_e_services': 20 + version,
+                'num_from_this_year_start': 500, 'num_services_residence': 50,
+            },
+            'resp_person_data': {
+                'name': f'Responsible person {entry_id}', 'phone': '+380000000000', 'email': f'asc{entry_id}@example.com',
+            },
+        }
+
+    def _version(self, entry_id: int) -> int:
+        """Number of generations in which the payload of the TsNAP changed."""
+        return sum(1 for generation in range(2, self.generation + 1)
+                   if random.Random(f'{self.seed}:{generation}:{entry_id}').random() < self.change_rate)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                path, _, query_string = self.path.partition('?')
+                query = dict(param.split('=', 1) for param in query_string.split('&') if '=' in param)
+                status, body = stub.respond(path, query)
+
+                encoded = json.dumps(body).encode('utf-8')
+                etag = f'"{hashlib.md5(encoded).hexdigest()}"'
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(encoded)))
+                if status == 200:
+                    self.send_header('ETag', etag)
+                if status == 503:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    """Adds the options of the synthetic data set to a command line parser."""
+    parser.add_argument('--regions', type=int, default=3, help='Number of ODA reports.')
+    parser.add_argument('--tsnaps-per-region', type=int, default=100, help='Number of TsNAPs in every report.')
+    parser.add_argument('--page-size', type=int, default=20, help='Number of entries per page.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay of every response, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503.')
+    parser.add_argument('--change-rate', type=float, default=0.0,
+                        help='Share of TsNAPs whose payload changes between runs.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random errors and changes.')
+
+
+def stub_from_arguments(args: argparse.Namespace) -> DiiaStub:
+    """Creates a stub configured by the options added with `add_stub_arguments`."""
+    return DiiaStub(regions=args.regions, tsnaps_per_region=args.tsnaps_per_region, page_size=args.page_size,
+                    latency=args.latency, error_rate=args.error_rate, change_rate=args.change_rate, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic DIIA static reports locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stub = stub_from_arguments(args).start(args.host, args.port)
+    print(f'Serving DIIA_API_URL={stub.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,115 @@
+"""
+End-to-end benchmark of `TsNAPStaticReportService` against the local DIIA stub and a local Postgres.
+
+The database is taken from the usual POSTGRES_* variables; use a scratch database, `--reset-db` drops all
+tables of the models. Example::
+
+    POSTGRES_HOST=localhost POSTGRES_DB=trembita_bench POSTGRES_USER=trembita POSTGRES_PASSWORD=... \\
+        python -m benchmarks.run_benchmark --regions 5 --tsnaps-per-region 200 --latency 0.02 --runs 2
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from collections import Counter
+
+from benchmarks.diia_stub import add_stub_arguments, stub_from_arguments
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MiB (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> dict:
+    parser = argparse.ArgumentParser(description='Benchmark a sync against the local DIIA stub.')
+    add_stub_arguments(parser)
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port of the stub; a fixed one keeps the URLs stable for HTTP_CACHE_PATH.')
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--quarter', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=1, help='Number of consecutive syncs of the same quarter.')
+    parser.add_argument('--write-mode', default=None, help='Write mode of the service; SYNC_WRITE_MODE by default.')
+    parser.add_argument('--reset-db', action='store_true', help='Drop and recreate the tables before the first run.')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+    parser.add_argument('--sql-budget', type=float, default=0,
+                        help='Fail if a run executes more SQL statements per TsNAP than this; 0 disables the check.')
+    args = parser.parse_args()
+
+    stub = stub_from_arguments(args).start(port=args.port)
+    # settings.py reads the environment on import, so the stub URL has to be set first.
+    os.environ['DIIA_API_URL'] = stub.url
+
+    from sqlalchemy import text
+
+    from apps.static_report.migrations import migrate
+    from apps.static_report.services import TsNAPStaticReportService
+    from database import db
+    from sql_audit import per_entity, sql_audit
+
+    if args.reset_db:
+        with db.engine.begin() as connection:
+            connection.execute(text('DROP MATERIALIZED VIEW IF EXISTS tsnap_full_view'))
+        db.Base.metadata.drop_all(db.engine)
+    migrate(db.engine)
+
+    sql_audit.enabled = True
+    sql_audit.install(db.engine)
+    service_options = {'write_mode': args.write_mode} if args.write_mode else {}
+    runs = []
+    for run in range(1, args.runs + 1):
+        sql_audit.reset()
+        service = TsNAPStaticReportService(**service_options)
+        before_summary, before_requests = service.summary(), stub.requests
+
+        started = time.perf_counter()
+        service.create_or_update(args.year, args.quarter)
+        seconds = time.perf_counter() - started
+
+        summary = service.summary()
+        tsnaps = Counter(summary['tsnaps'])
+        tsnaps.subtract(before_summary['tsnaps'])
+        entities = per_entity(summary['sql'])
+        sql = Counter()
+        for counts in entities.values():
+            sql.update(counts['statements'])
+        requests = stub.requests - before_requests
+        runs.append({
+            'run': run,
+            'seconds': round(seconds, 3),
+            'requests': requests,
+            'requests_per_sec': round(requests / seconds, 1),
+            'tsnaps': dict(tsnaps),
+            'rows_per_sec': round(sum(tsnaps.values()) / seconds, 1),
+            'sql': dict(sql),
+            'sql_per_tsnap': round(sum(sql.values()) / max(sum(tsnaps.values()), 1), 2),
+            'sql_by_entity': entities,
+            'rows_written': {key.split('/', 1)[1]: value for key, value in summary['sql'].items()
+                             if key.startswith('rows/')},
+        })
+
+    stub.stop()
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'runs': runs,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+    over_budget = [run['run'] for run in runs if args.sql_budget and run['sql_per_tsnap'] > args.sql_budget]
+    if over_budget:
+        report['over_sql_budget'] = over_budget
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main().get('over_sql_budget') else 0)
@@ -1,4 +1,5 @@
-CREATE VIEW tsnap_full_view AS
+-- Created and refreshed by the application (apps/static_report/migrations.py); kept here for reference.
+CREATE MATERIALIZED VIEW tsnap_full_view AS
 SELECT 
     t.id AS tsnap_id,
     "asc".id AS asc_org_id,
@@ -38,3 +39,7 @@ JOIN activity_data act ON t.activity_data_id = act.id
 JOIN info_support_data info ON t.info_support_data_id = info.id
 JOIN admin_service_data admin ON t.admin_service_data_id = admin.id
 JOIN resp_person_data resp ON t.resp_person_data_id = resp.id;
+
+CREATE UNIQUE INDEX ix_tsnap_full_view_tsnap_id ON tsnap_full_view (tsnap_id);
+CREATE INDEX ix_tsnap_full_view_asc_org_idf ON tsnap_full_view (asc_org_idf);
+CREATE INDEX ix_tsnap_full_view_locality_codifier ON tsnap_full_view (locality_codifier);
@@ -1,22 +1,57 @@
 import threading
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 
-from settings import DATABASE_URL
+from forking import after_fork
+from settings import (DATABASE_URL, DB_EXECUTEMANY_MODE, DB_EXECUTEMANY_PAGE_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING,
+                      DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT)
 from sqlalchemy.orm import sessionmaker, Session as SessionType
 
 
+def create_db_engine(url: str = DATABASE_URL, **options) -> Engine:
+    """
+    Creates an engine with the pool and driver settings of `settings.py`.
+
+    The pool holds `DB_POOL_SIZE` connections plus up to `DB_MAX_OVERFLOW` more under load, and waits up to
+    `DB_POOL_TIMEOUT` seconds for a free one. Connections are checked with a ping before use and replaced
+    after `DB_POOL_RECYCLE` seconds, so ones dropped by the server or a proxy are not handed out. psycopg2
+    sends executemany statements in pages of `DB_EXECUTEMANY_PAGE_SIZE` parameter sets: multi-row VALUES
+    for inserts and, in the 'values_plus_batch' mode, `execute_batch` for updates.
+
+    Args:
+        url (str): The database URL.
+        **options: Keyword arguments for `create_engine` overriding the settings.
+
+    Returns:
+        Engine: The engine.
+    """
+    return create_engine(url, **{
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'executemany_mode': DB_EXECUTEMANY_MODE,
+        'executemany_batch_page_size': DB_EXECUTEMANY_PAGE_SIZE,
+        'insertmanyvalues_page_size': DB_EXECUTEMANY_PAGE_SIZE,
+        **options,
+    })
+
+
 class DatabaseSingleton:
     """
     A singleton class to manage a single instance of the database engine and base.
     
     Attributes:
         engine (sqlalchemy.engine.base.Engine): The SQLAlchemy engine connected to the database.
+        session_factory (sqlalchemy.orm.sessionmaker): The factory of the sessions bound to the engine.
         Base (sqlalchemy.ext.declarative.api.DeclarativeMeta): The base class for SQLAlchemy models.
         
     Methods:
         __new__(cls): Ensures that only one instance of DatabaseSingleton is created.
+        dispose_after_fork(cls): Drops the pooled connections inherited by a forked process.
     """
     _instance = None
     _lock = threading.Lock()
@@ -34,18 +69,30 @@ class DatabaseSingleton:
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super(DatabaseSingleton, cls).__new__(cls)
-                cls._instance.engine = create_engine(DATABASE_URL)
+                cls._instance.engine = create_db_engine()
+                cls._instance.session_factory = sessionmaker(bind=cls._instance.engine)
                 cls._instance.Base = declarative_base()
+                after_fork(cls._instance.dispose_after_fork)
         return cls._instance
 
+    def dispose_after_fork(cls):
+        """
+        Makes the engine usable in a forked child process.
+
+        Pooled connections are sockets shared with the parent process, so the child replaces the pool
+        without closing them and opens its own connections on demand. Sessions bound to the engine keep working.
+        """
+        cls._instance.engine.dispose(close=False)
+
     def create_session(cls) -> SessionType:
         """
         Creates and returns a new SQLAlchemy session using the engine from the singleton instance.
 
+        A session takes a connection from the pool only while it is in a transaction.
+
         Returns: 
             SessionType: A new SQLAlchemy session instance.
         """
-        Session = sessionmaker(bind=cls._instance.engine)
-        return Session()
+        return cls._instance.session_factory()
 
 db = DatabaseSingleton()
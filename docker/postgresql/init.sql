@@ -17,3 +17,6 @@ BEGIN
    END IF;
 END
 $do$;
+
+SELECT 'CREATE DATABASE trembita_test'
+WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = 'trembita_test')\gexec
@@ -0,0 +1,31 @@
+import os
+from typing import Callable, List
+
+_callbacks: List[Callable[[], None]] = []
+
+
+def after_fork(callback: Callable[[], None]) -> Callable[[], None]:
+    """
+    Registers a function resetting process-wide state in every forked child process.
+
+    The worker processes of `--workers` are forked from a process that already holds database and HTTP
+    connections, SQLite handles, locks and the counters of the run. Connections and handles must not be used
+    by two processes, and a lock may have been held by another thread at the time of the fork, so a child
+    resets them before it runs anything: it opens its own connections on demand and starts with empty
+    counters, which its parent merges from the results of the worker. Callbacks run in the order they were
+    registered.
+
+    :param callback: A function without arguments, e.g. the `_reset_after_fork` method of a singleton.
+
+    :return Callable: The callback.
+    """
+    _callbacks.append(callback)
+    return callback
+
+
+def _run_after_fork():
+    for callback in _callbacks:
+        callback()
+
+
+os.register_at_fork(after_in_child=_run_after_fork)
@@ -0,0 +1,225 @@
+import io
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from forking import after_fork
+from metrics import metrics
+from rate_limiter import AdaptiveLimiter
+from settings import (HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_DEFAULT_TIMEOUT, HTTP_MAX_RETRIES,
+                      HTTP_POOL_SIZE, HTTP_TIMEOUTS)
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    A shared HTTP client with a pooled keep-alive session, per-endpoint timeouts and retries.
+
+    Requests answered with 429 or 5xx, and requests that fail on the connection level, are retried
+    with jittered exponential backoff. A `Retry-After` header sent by the server takes precedence over
+    the computed delay.
+
+    Attributes:
+        session (requests.Session): The pooled session shared by all threads.
+        counters (Counter): Number of `requests`, `retries` and `failures` made by the client.
+    """
+    retry_statuses = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, max_retries: int = HTTP_MAX_RETRIES,
+                 backoff_base: float = HTTP_BACKOFF_BASE, backoff_max: float = HTTP_BACKOFF_MAX,
+                 timeouts: Optional[Dict[str, float]] = None, default_timeout: float = HTTP_DEFAULT_TIMEOUT):
+        """
+        :param pool_size: Maximum number of keep-alive connections kept per host.
+        :param max_retries: Number of retries after the first attempt.
+        :param backoff_base: Delay before the first retry, in seconds. Doubled on every next retry.
+        :param backoff_max: Upper bound for a single delay, in seconds.
+        :param timeouts: Timeouts in seconds keyed by endpoint name.
+        :param default_timeout: Timeout for endpoints missing in `timeouts`.
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeouts = HTTP_TIMEOUTS if timeouts is None else timeouts
+        self.default_timeout = default_timeout
+
+        self.pool_size = pool_size
+        self.session = self._create_session()
+
+        self.counters = Counter()
+        self._counters_lock = threading.Lock()
+        after_fork(self._reset_after_fork)
+
+    def get(self, url: str, endpoint: Optional[str] = None, headers: Optional[Dict[str, str]] = None,
+            limiter: Optional[AdaptiveLimiter] = None, stream: bool = False) -> requests.Response:
+        """
+        Makes a GET request, retrying transient failures.
+
+        :param url: The absolute URL to request.
+        :param endpoint: Endpoint name used to pick the timeout.
+        :param headers: Extra request headers.
+        :param limiter: Limiter every attempt takes a slot from. Waiting for a retry does not hold a slot.
+        :param stream: Return as soon as the headers arrive, leaving the body to be read through
+            `ResponseStream`. The response then keeps its limiter slot and its pooled connection until it is
+            closed.
+
+        :return requests.Response: The successful response.
+        :raises requests.exceptions.RequestException: When the request still fails after all retries.
+        """
+        timeout = self.timeouts.get(endpoint, self.default_timeout)
+
+        for attempt in range(self.max_retries + 1):
+            self._count('requests')
+            response = None
+            streaming = False
+            if limiter is not None:
+                limiter.acquire()
+            started = time.perf_counter()
+            try:
+                with metrics.time('api_request_seconds', endpoint=endpoint or 'other'):
+                    response = self.session.get(url, timeout=timeout, headers=headers, stream=stream)
+                if response.status_code not in self.retry_statuses:
+                    if not response.ok:
+                        self._count('failures')
+                        response.close()
+                    response.raise_for_status()
+                    if stream and limiter is not None:
+                        streaming = True
+                        self._release_on_close(response, limiter, endpoint or 'other', started)
+                    return response
+                error = requests.exceptions.HTTPError(f'{response.status_code} for url: {url}', response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as req_err:
+                error = req_err
+            finally:
+                if limiter is not None and not streaming:
+                    throttled = response is None or response.status_code in self.retry_statuses
+                    limiter.release(endpoint or 'other', time.perf_counter() - started, throttled)
+
+            # The headers are all the retry needs; an unread body would keep the connection out of the pool.
+            if response is not None:
+                response.close()
+            if attempt == self.max_retries:
+                break
+
+            delay = self._retry_delay(attempt, response)
+            logger.warning(f'Retrying {url} in {delay:.2f}s ({attempt + 1}/{self.max_retries}): {error}')
+            self._count('retries')
+            time.sleep(delay)
+
+        self._count('failures')
+        raise error
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns a snapshot of the request counters.
+
+        :return dict: Number of requests, retries and failures.
+        """
+        with self._counters_lock:
+            return {name: self.counters[name] for name in ('requests', 'retries', 'failures')}
+
+    def _retry_delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """
+        Computes the delay before the next attempt.
+
+        :param attempt: Zero-based number of the failed attempt.
+        :param response: The failed response, if the server answered at all.
+
+        :return float: Delay in seconds.
+        """
+        retry_after = self._parse_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _parse_retry_after(response: Optional[requests.Response]) -> Optional[float]:
+        """
+        Reads the `Retry-After` header, given either in seconds or as an HTTP date.
+
+        :param response: The failed response.
+
+        :return float: Delay in seconds, or None if the header is missing or malformed.
+        """
+        if response is None or not response.headers.get('Retry-After'):
+            return None
+
+        value = response.headers['Retry-After']
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _release_on_close(response: requests.Response, limiter: AdaptiveLimiter, endpoint: str, started: float):
+        """
+        Makes a streamed response return its limiter slot when it is closed, so that reading the body counts
+        as part of the request.
+        """
+        close = response.close
+        released = threading.Event()
+
+        def close_and_release():
+            close()
+            if not released.is_set():
+                released.set()
+                limiter.release(endpoint, time.perf_counter() - started, False)
+
+        response.close = close_and_release
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _reset_after_fork(self):
+        """Gives a forked child process its own connections and counters instead of the parent's."""
+        self.session = self._create_session()
+        self.counters = Counter()
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+
+class ResponseStream(io.RawIOBase):
+    """
+    A file-like view of the body of a response streamed by `HttpClient.get`, decoding its content encoding.
+    Closing it closes the response, which returns its connection to the pool and its limiter slot.
+    """
+
+    def __init__(self, response: requests.Response):
+        super().__init__()
+        self.response = response
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.response.raw.read(len(buffer), decode_content=True)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.response.close()
+        super().close()
+
+
+http_client = HttpClient()
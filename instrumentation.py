@@ -0,0 +1,61 @@
+from functools import wraps
+from typing import Callable, Optional, Union
+
+from metrics import metrics
+from profiler import profiler
+from sql_audit import sql_audit
+
+
+def instrumented(stage: str, entity: Optional[str] = None, processed: Union[int, Callable[..., int]] = 1,
+                 metric: str = 'dao_upsert_seconds'):
+    """
+    Decorator feeding every call of a DAO method to the run metrics, the SQL audit and the profiler.
+
+    The profile samples taken during a call are tagged with `stage`. For a method writing an entity, the
+    duration of the call is also recorded in `metric` by entity, and its SQL statements are attributed to
+    the entity.
+
+    :param stage: The profiler stage, e.g. 'flush'.
+    :param entity: The entity the method writes, e.g. 'tsnap'; None to only tag the stage.
+    :param processed: Number of entities a call processes, or a function of the call's first argument
+        after `self` returning it, e.g. `len` for a batch.
+    :param metric: The latency histogram of the calls.
+    """
+    def decorator(func):
+        if entity is None:
+            return profiler.tagged(stage)(func)
+
+        @wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            count = processed(args[0]) if callable(processed) else processed
+            with metrics.time(metric, entity=entity), sql_audit.entity(entity, count), profiler.stage(stage):
+                return func(obj, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export() -> dict:
+    """
+    Returns the recorded metrics and profile samples, to be merged into another process with `merge`. The
+    SQL audit counters are part of the service summary instead.
+
+    :return dict: The exported `metrics` and `profile`.
+    """
+    return {'metrics': metrics.export(), 'profile': profiler.export()}
+
+
+def merge(exported: dict):
+    """
+    Adds up the metrics and profile samples of another process.
+
+    :param exported: The result of `export`.
+    """
+    metrics.merge(exported['metrics'])
+    profiler.merge(exported['profile'])
+
+
+def reset():
+    """Drops the recorded metrics, SQL audit counters and profile samples."""
+    metrics.reset()
+    sql_audit.reset()
+    profiler.reset()
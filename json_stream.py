@@ -0,0 +1,71 @@
+import json
+import logging
+from typing import IO, Any, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+SCALAR_EVENTS = frozenset({'string', 'number', 'boolean', 'null'})
+
+
+def loads(body: bytes) -> Any:
+    """
+    Parses a JSON document, with orjson when it is installed.
+
+    :param body: The raw JSON.
+
+    :return: The parsed document.
+    :raises ValueError: If the body is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def iter_items(file: IO[bytes], key: str, meta: dict) -> Iterator[Any]:
+    """
+    Yields the items of a top-level array of a JSON object one by one, while reading the object.
+
+    With ijson installed only the current item is held in memory, whatever the size of the document.
+    Without it the whole document is parsed first.
+
+    :param file: A binary file-like object with the JSON object.
+    :param key: The key of the array, e.g. `results`.
+    :param meta: Filled with the top-level scalar fields of the object, e.g. `count` and `next`. Fields
+        that come after the array are only there once the iterator is exhausted.
+
+    :return Iterator: The items of the array.
+    :raises ValueError: If the document is not valid JSON or is not an object.
+    """
+    if ijson is None:
+        document = loads(file.read())
+        if not isinstance(document, dict):
+            raise ValueError(f'Expected a JSON object, got {type(document).__name__}')
+        meta.update((name, value) for name, value in document.items() if not isinstance(value, (dict, list)))
+        yield from document.get(key) or []
+        return
+
+    def events():
+        for prefix, event, value in ijson.parse(file, use_float=True):
+            if event in SCALAR_EVENTS and prefix and '.' not in prefix:
+                meta[prefix] = value
+            yield prefix, event, value
+
+    try:
+        yield from ijson.items(events(), f'{key}.item')
+    except ijson.JSONError as err:
+        raise ValueError(f'Invalid JSON: {err}') from err
+
+
+def backend() -> str:
+    """Names the libraries in use, for the log."""
+    return f'{"ijson/" + ijson.backend if ijson else "json"} streaming, {"orjson" if orjson else "json"} parsing'
@@ -1,16 +1,88 @@
+import argparse
 import logging
-import sys
 import time
 from datetime import datetime
 
+import json_stream
+from apps.static_report.backfill import BackfillService
+from apps.static_report.daemon import SyncDaemon
+from apps.static_report.dao_services import SRDiiaApiDaoService
+from apps.static_report.migrations import migrate
 from apps.static_report.services import TsNAPStaticReportService
-from apps.static_report.utils import get_current_quarter, get_current_year
+from apps.static_report.sharding import ShardedStaticReportService
+from apps.static_report.snapshot import SnapshotExporter, SnapshotReader
+from apps.static_report.utils import get_current_quarter, get_current_year, parse_quarter, parse_quarter_range
 from database import *
+from metrics import metrics
+from profiler import profiler
+from response_cache import response_cache
 from settings import *
-
-sys.setrecursionlimit(100)
+from sql_audit import sql_audit
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync the DIIA static reports for the current quarter or a range of quarters.')
+    parser.add_argument('--write-mode', choices=TsNAPStaticReportService.write_modes, default=SYNC_WRITE_MODE,
+                        help='How TsNAPs are written to the database.')
+    parser.add_argument('--workers', type=int, default=SYNC_WORKER_PROCESSES,
+                        help='Number of worker processes the ODA reports are spread over.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last unfinished run of the quarter from its checkpoints.')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Continue the last unfinished run of the quarter, retrying only the failed items.')
+    parser.add_argument('--http-cache', default=HTTP_CACHE_PATH, metavar='PATH',
+                        help='SQLite file to cache DIIA API responses in; empty disables the cache.')
+    parser.add_argument('--offline', action='store_true', default=HTTP_CACHE_OFFLINE,
+                        help='Serve DIIA API responses only from the response cache.')
+    parser.add_argument('--metrics-json', default=METRICS_JSON_PATH, metavar='PATH',
+                        help='Where to write the latency report of the run; empty disables it.')
+    parser.add_argument('--metrics-prom', default=METRICS_PROMETHEUS_PATH, metavar='PATH',
+                        help='Where to write the run metrics in the Prometheus text format (a *.prom file '
+                             'in the node-exporter textfile directory); empty disables it.')
+    parser.add_argument('--backfill', type=parse_quarter_range, metavar='FIRST[:LAST]',
+                        help='Sync a range of quarters instead of the current one, e.g. 2023Q1:2024Q4.')
+    parser.add_argument('--quarter', type=parse_quarter, metavar='YYYYQN',
+                        help='Sync or export this quarter instead of the current one, e.g. 2024Q3.')
+    parser.add_argument('--quarter-concurrency', type=int, default=BACKFILL_QUARTER_CONCURRENCY,
+                        help='Number of quarters a backfill syncs at the same time.')
+    parser.add_argument('--stream-json', action='store_true', default=API_STREAM_RESULTS,
+                        help='Decode region pages item by item while downloading them, keeping memory constant.')
+    parser.add_argument('--export-snapshot', metavar='PATH',
+                        help='Write the DIIA API data of the quarter to a snapshot file instead of syncing it.')
+    parser.add_argument('--import-snapshot', metavar='PATH',
+                        help='Sync the quarter of a snapshot file instead of fetching from the DIIA API.')
+    parser.add_argument('--snapshot-mmap', action='store_true',
+                        help='Read the imported snapshot through a memory map.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep the current quarter up to date continuously until SIGTERM/SIGINT.')
+    parser.add_argument('--sql-audit', action='store_true', default=SQL_AUDIT,
+                        help='Count SQL statements per processed entity and flag duplicate or orphaned rows.')
+    parser.add_argument('--profile', action='store_true', default=PROFILE,
+                        help='Sample the sync by stage and write collapsed stacks for flamegraphs.')
+    parser.add_argument('--profile-output', default=PROFILE_OUTPUT_PATH, metavar='PATH',
+                        help='Where to write the collapsed stacks of all stages; every stage is also written '
+                             'next to it, e.g. profile.detail_fetch.collapsed.')
+    args = parser.parse_args()
+    if args.offline and not args.http_cache:
+        parser.error('--offline requires --http-cache')
+    if args.backfill and args.workers > 1:
+        parser.error('--backfill runs quarters in threads of one process; it cannot be combined with --workers')
+    if args.export_snapshot and args.import_snapshot:
+        parser.error('--export-snapshot and --import-snapshot are exclusive')
+    if args.backfill and (args.quarter or args.export_snapshot or args.import_snapshot):
+        parser.error('--backfill cannot be combined with --quarter or snapshots')
+    if args.daemon and (args.backfill or args.quarter or args.export_snapshot or args.import_snapshot
+                        or args.workers > 1 or args.resume or args.retry_failed):
+        parser.error('--daemon syncs the current quarter from the DIIA API in one process; it cannot be combined '
+                     'with --backfill, --quarter, snapshots, --workers, --resume or --retry-failed')
+    if args.import_snapshot and args.quarter:
+        parser.error('--import-snapshot syncs the quarter of the snapshot; it cannot be combined with --quarter')
+    response_cache.path = args.http_cache
+    response_cache.offline = args.offline
+    SRDiiaApiDaoService.streaming = args.stream_json
+    sql_audit.enabled = args.sql_audit
+    sql_audit.install(db.engine)
+    profiler.enabled = args.profile
+
     logging.basicConfig(filename='./trembita.log',
                         filemode='a',
                         level=logging.DEBUG,
@@ -20,12 +92,33 @@ if __name__ == '__main__':
     start_timestamp = datetime.now()
     logging.info(f"Task started at {start_timestamp.strftime('%Y-%m-%d %H:%M:%S')} \n")
 
-    db.Base.metadata.create_all(db.engine)
+    if args.stream_json:
+        logging.info(f'Streaming JSON decoding: {json_stream.backend()}')
 
-    year = get_current_year()
-    quarter = get_current_quarter()
+    year, quarter = args.quarter or (get_current_year(), get_current_quarter())
+    if args.export_snapshot:
+        # The export only reads the DIIA API; the database is not touched.
+        SnapshotExporter().export(args.export_snapshot, year, quarter)
+    elif args.daemon:
+        migrate(db.engine)
+        SyncDaemon(write_mode=args.write_mode).run()
+    elif args.backfill:
+        migrate(db.engine)
+        service = BackfillService(args.quarter_concurrency, write_mode=args.write_mode)
+        service.backfill(args.backfill, resume=args.resume, retry_failed=args.retry_failed)
+    else:
+        migrate(db.engine)
+        service_options = {'write_mode': args.write_mode}
+        if args.import_snapshot:
+            index = SnapshotReader.read_index(args.import_snapshot)
+            year, quarter = index['year'], index['quarter']
+            service_options.update(snapshot_path=args.import_snapshot, snapshot_mmap=args.snapshot_mmap)
 
-    TsNAPStaticReportService().create_or_update(year, quarter)
+        if args.workers > 1:
+            service = ShardedStaticReportService(args.workers, **service_options)
+        else:
+            service = TsNAPStaticReportService(**service_options)
+        service.create_or_update(year, quarter, resume=args.resume, retry_failed=args.retry_failed)
 
     end_time = time.time()
     end_timestamp = datetime.now()
@@ -33,3 +126,16 @@ if __name__ == '__main__':
 
     logging.info(f"Task ended at {end_timestamp.strftime('%Y-%m-%d %H:%M:%S')}\n")
     logging.info(f"Total execution time: {total_duration:.2f} seconds\n")
+
+    metrics.observe('run_seconds', total_duration)
+    metrics.log_report()
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+    else:
+        logging.warning('METRICS_PROMETHEUS_PATH is not set: the Prometheus textfile was not written.')
+    if args.profile:
+        profiler.log_report()
+        if args.profile_output:
+            profiler.write_collapsed(args.profile_output)
@@ -0,0 +1,263 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, List, Optional, Tuple
+
+from forking import after_fork
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Upper bounds of the latency histogram buckets, in seconds."""
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    A latency histogram with fixed buckets.
+
+    Fixed buckets keep the memory constant however many values are observed, let histograms of several
+    processes be merged by adding up the counts, and map directly onto a Prometheus histogram. Quantiles
+    are estimated by linear interpolation inside the bucket and clamped to the observed min and max.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        :param buckets: Sorted upper bounds of the buckets; an overflow bucket is added.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, state: dict):
+        """
+        Adds up the values of another histogram with the same buckets.
+
+        :param state: The other histogram, as returned by `state`.
+        """
+        self.counts = [count + other for count, other in zip(self.counts, state['counts'])]
+        self.count += state['count']
+        self.sum += state['sum']
+        self.min = min(self.min, state['min'])
+        self.max = max(self.max, state['max'])
+
+    def state(self) -> dict:
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimates a quantile of the observed values.
+
+        :param q: The quantile, between 0 and 1.
+
+        :return float: The estimate in seconds, or None if nothing was observed.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(max(estimate, self.min), self.max)
+            seen += count
+
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        Returns the count, total and quantiles of the observed values.
+
+        :return dict: `count`, `sum`, `min`, `max` and `p50`/`p95`/`p99`, in seconds.
+        """
+        summary = {'count': self.count, 'sum': round(self.sum, 6),
+                   'min': round(self.min, 6) if self.count else None, 'max': round(self.max, 6)}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            summary[f'p{round(q * 100)}'] = round(value, 6) if value is not None else None
+        return summary
+
+
+class Metrics:
+    """
+    A thread-safe registry of latency histograms keyed by metric name and labels.
+
+    The hooks in the HTTP client and the DAO services record into the module-level `metrics` instance; at
+    the end of a run it is written as a JSON report and as a Prometheus text-format file. The registries of
+    worker processes are merged into their parent's with `export` and `merge`.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[tuple, Histogram] = {}
+        self._lock = threading.Lock()
+        after_fork(self._reset_after_fork)
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        """
+        Records a duration.
+
+        :param name: The metric name, e.g. `api_request_seconds`.
+        :param seconds: The observed duration.
+        :param labels: Labels of the metric, e.g. `endpoint='detail'`.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, name: str, **labels: str):
+        """
+        Records the duration of the enclosed block, also when it raises.
+
+        :param name: The metric name.
+        :param labels: Labels of the metric.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, **labels: str):
+        """
+        Decorator recording the duration of every call of a function.
+
+        :param name: The metric name.
+        :param labels: Labels of the metric.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def export(self) -> List[tuple]:
+        """
+        Returns the raw histograms, to be merged into another process's registry.
+
+        :return list: `(name, labels, state)` tuples.
+        """
+        with self._lock:
+            return [(name, labels, histogram.state()) for (name, labels), histogram in self._histograms.items()]
+
+    def merge(self, exported: List[tuple]):
+        """
+        Adds up histograms exported by another registry.
+
+        :param exported: The result of `export`.
+        """
+        with self._lock:
+            for name, labels, state in exported:
+                histogram = self._histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self._histograms[(name, labels)] = Histogram()
+                histogram.merge(state)
+
+    def reset(self):
+        """Drops all recorded values."""
+        with self._lock:
+            self._histograms.clear()
+
+    def report(self) -> Dict[str, list]:
+        """
+        Summarizes all histograms.
+
+        :return dict: For every metric name, a list of summaries with their labels.
+        """
+        report = {}
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                report.setdefault(name, []).append({'labels': dict(labels), **histogram.summary()})
+        return report
+
+    def write_json(self, path: str):
+        """
+        Writes the summaries of all histograms as JSON.
+
+        :param path: The output file.
+        """
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path: str, prefix: str = 'trembita_'):
+        """
+        Writes all histograms in the Prometheus text format, for the node-exporter textfile collector.
+
+        The file is replaced atomically, so the collector never reads a partial file; its name has to end
+        with `.prom` to be picked up.
+
+        :param path: The output file.
+        :param prefix: Prefix of the metric names.
+        """
+        lines = []
+        with self._lock:
+            by_name = {}
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                by_name.setdefault(name, []).append((labels, histogram))
+
+            for name, histograms in by_name.items():
+                metric = f'{prefix}{name}'
+                lines.append(f'# TYPE {metric} histogram')
+                for labels, histogram in histograms:
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append(f'{metric}_bucket{_format_labels(labels, le=le)} {cumulative}')
+                    lines.append(f'{metric}_sum{_format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{metric}_count{_format_labels(labels)} {histogram.count}')
+
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+    def log_report(self):
+        """Writes the p50/p95/p99 of every histogram to the log."""
+        for name, summaries in self.report().items():
+            for summary in summaries:
+                labels = ', '.join(f'{key}={value}' for key, value in summary['labels'].items())
+                logger.info(f'{name}{{{labels}}}: count={summary["count"]} total={summary["sum"]:.3f}s '
+                            f'p50={summary["p50"]}s p95={summary["p95"]}s p99={summary["p99"]}s')
+
+    def _reset_after_fork(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+def _format_labels(labels: tuple, **extra: str) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _write_atomically(path: str, content: str):
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,287 @@
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from forking import after_fork
+from settings import PROFILE, PROFILE_INTERVAL, PROFILE_TOP_N
+
+logger = logging.getLogger(__name__)
+
+OTHER_STAGE = 'other'
+
+
+class SamplingProfiler:
+    """
+    A wall-clock sampling profiler whose samples are tagged with the stage of the sync being run.
+
+    While `profiling` is active, a background thread takes the Python stacks of the profiled threads every
+    `interval` seconds. The DAO methods are tagged with their stage (`stage`, `tagged`, `stage_iter`):
+    'pagination' for `list/` and `entries/`, 'detail_fetch' for `detail/`, 'flush' for the DAO writes and
+    'commit' for commits. A thread is sampled while it runs a tagged method, so the fetching thread pools are
+    profiled too, and the threads that started `profiling` are sampled all the time, as 'other' outside any
+    stage. Samples are counted by stage and stack only, so memory grows with the number of distinct stacks,
+    not with the duration.
+
+    The samples of a worker process are added to its parent's with `export` and `merge`.
+    """
+
+    def __init__(self, enabled: bool = PROFILE, interval: float = PROFILE_INTERVAL):
+        """
+        :param enabled: Sample while `profiling` is active.
+        :param interval: Seconds between two samples.
+        """
+        self.enabled = enabled
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stages: Dict[int, str] = {}
+        self._roots: Counter = Counter()
+        self._labels: Dict[object, str] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._sampler = None
+        after_fork(self._reset_after_fork)
+
+    @contextmanager
+    def profiling(self):
+        """
+        Samples the current thread, and every thread running a tagged stage, during the enclosed block.
+        Blocks may be nested and run in several threads at once; sampling stops when the last one ends.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._roots[thread_id] += 1
+            if self._sampler is None:
+                self._stopping.clear()
+                self._sampler = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._sampler.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._roots[thread_id] -= 1
+                if self._roots[thread_id] <= 0:
+                    del self._roots[thread_id]
+                sampler = self._sampler if not self._roots else None
+                if sampler is not None:
+                    self._sampler = None
+                    self._stopping.set()
+            if sampler is not None:
+                sampler.join()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Tags the samples of the current thread taken during the enclosed block with a stage.
+
+        :param name: The stage, e.g. 'detail_fetch'.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        previous = self._stages.get(thread_id)
+        self._stages[thread_id] = name
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._stages.pop(thread_id, None)
+            else:
+                self._stages[thread_id] = previous
+
+    def tagged(self, name: str):
+        """
+        Decorator tagging the samples taken during every call of a function with a stage.
+
+        :param name: The stage.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stage_iter(self, name: str, items: Iterable) -> Iterator:
+        """
+        Tags the samples taken while the items of a lazy iterator are produced with a stage, but not while
+        the consumer processes them.
+
+        :param name: The stage.
+        :param items: The iterator, e.g. a generator fetching pages.
+
+        :return Iterator: The items.
+        """
+        return self._stage_iter(name, iter(items)) if self.enabled else iter(items)
+
+    def export(self) -> List[Tuple[tuple, int]]:
+        """
+        Returns the samples, to be merged into another process's profiler.
+
+        :return list: `(stack, count)` pairs; a stack is the stage followed by the frames from the root.
+        """
+        with self._lock:
+            return list(self.samples.items())
+
+    def merge(self, exported: List[Tuple[tuple, int]]):
+        """
+        Adds up samples exported by another profiler.
+
+        :param exported: The result of `export`.
+        """
+        with self._lock:
+            for stack, count in exported:
+                self.samples[tuple(stack)] += count
+
+    def reset(self):
+        """Drops all samples."""
+        with self._lock:
+            self.samples.clear()
+
+    def stage_counts(self) -> Dict[str, int]:
+        """
+        Counts the samples by stage.
+
+        :return dict: The number of samples of every stage.
+        """
+        counts = Counter()
+        for stack, count in self.export():
+            counts[stack[0]] += count
+        return dict(counts.most_common())
+
+    def top(self, count: int = PROFILE_TOP_N) -> List[dict]:
+        """
+        Finds the functions the samples were taken in most often.
+
+        :param count: Number of functions.
+
+        :return list: The hottest functions by self samples (taken in the function itself), with their total
+            samples (taken in the function or the functions it called) and self samples by stage.
+        """
+        functions: Dict[str, dict] = {}
+        for stack, samples in self.export():
+            stage, frames = stack[0], stack[1:]
+            for frame in set(frames):
+                functions.setdefault(frame, {'function': frame, 'self': 0, 'total': 0, 'stages': Counter()})
+                functions[frame]['total'] += samples
+            if frames:
+                functions[frames[-1]]['self'] += samples
+                functions[frames[-1]]['stages'][stage] += samples
+
+        hottest = sorted(functions.values(), key=lambda function: (function['self'], function['total']), reverse=True)
+        return [{**function, 'stages': dict(function['stages'])} for function in hottest[:count]]
+
+    def log_report(self, count: int = PROFILE_TOP_N):
+        """
+        Logs the samples by stage and the hottest functions.
+
+        :param count: Number of functions.
+        """
+        total = sum(self.stage_counts().values())
+        if not total:
+            logger.info('Profile: no samples.')
+            return
+
+        stages = ', '.join(f'{stage} {samples / total:.1%}' for stage, samples in self.stage_counts().items())
+        lines = [f'Profile: {total} samples every {self.interval * 1000:g} ms; {stages}.',
+                 f'Top {count} functions (self %, total %, self samples by stage):']
+        for function in self.top(count):
+            stages = ', '.join(f'{stage} {samples}' for stage, samples in function['stages'].items())
+            lines.append(f'{function["self"] / total:6.1%} {function["total"] / total:6.1%}  {function["function"]}'
+                         f'  [{stages}]')
+        logger.info('\n'.join(lines))
+
+    def write_collapsed(self, path: str) -> List[str]:
+        """
+        Writes the samples as collapsed stacks (`frame;frame;... count` lines) for flamegraph.pl, inferno or
+        speedscope: all stages into `path`, with the stage as the root frame, and every stage into its own
+        file next to it, e.g. `profile.detail_fetch.collapsed` for `profile.collapsed`.
+
+        :param path: The file of all stages.
+
+        :return list: The written files.
+        """
+        root, extension = os.path.splitext(path)
+        by_stage: Dict[str, List[str]] = {}
+        lines = []
+        for stack, count in sorted(self.export()):
+            lines.append(f'{";".join(stack)} {count}')
+            by_stage.setdefault(stack[0], []).append(f'{";".join(stack[1:]) or stack[0]} {count}')
+
+        written = []
+        for file_path, file_lines in [(path, lines)] + [(f'{root}.{stage}{extension or ".collapsed"}', stage_lines)
+                                                        for stage, stage_lines in sorted(by_stage.items())]:
+            with open(file_path, 'w') as file:
+                file.writelines(f'{line}\n' for line in file_lines)
+            written.append(file_path)
+
+        logger.info(f'Profile written to {", ".join(written)}')
+        return written
+
+    def _stage_iter(self, name: str, iterator: Iterator) -> Iterator:
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            frames = sys._current_frames()
+            taken = Counter()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stage = self._stages.get(thread_id)
+                if stage is None:
+                    if thread_id not in self._roots:
+                        continue
+                    stage = OTHER_STAGE
+                taken[(stage, *self._stack(frame))] += 1
+            del frames
+
+            with self._lock:
+                self.samples.update(taken)
+
+    def _stack(self, frame) -> List[str]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == __file__:
+                # The stage wrappers of this module.
+                frame = frame.f_back
+                continue
+            label = self._labels.get(code)
+            if label is None:
+                directory, file_name = os.path.split(code.co_filename)
+                label = self._labels[code] = (f'{getattr(code, "co_qualname", code.co_name)} '
+                                              f'({os.path.basename(directory)}/{file_name}:{code.co_firstlineno})')
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def _reset_after_fork(self):
+        self.samples = Counter()
+        self._stages = {}
+        self._roots = Counter()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._sampler = None
+
+
+profiler = SamplingProfiler()
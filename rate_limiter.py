@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from typing import Dict
+
+from forking import after_fork
+from metrics import metrics
+from settings import (API_CONCURRENCY_INITIAL, API_CONCURRENCY_MAX, API_CONCURRENCY_MIN, API_LATENCY_TOLERANCE,
+                      API_MAX_RPS)
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of in-flight DIIA API requests with AIMD, plus an optional requests-per-second ceiling.
+
+    Every request takes a slot with `acquire` and returns it with `release`, reporting its latency and
+    whether the API pushed back (429, 5xx, connection errors and timeouts):
+
+    - a fast, successful request raises the limit by `1 / limit`, i.e. by one slot per window of requests;
+    - a request slower than `latency_tolerance` times the baseline latency of its endpoint lowers the limit
+      to 90%. The baseline is the fastest latency seen, drifting slowly toward the recent ones so that a
+      single unusually fast response does not hold the limit down for the rest of the run;
+    - a pushed-back request halves the limit.
+
+    Decreases happen at most once per `decrease_interval` seconds, so a burst of failures of requests that
+    were in flight together counts as a single congestion signal. The thread pools fetching pages and
+    details cap the concurrency from above, so their sizes should be at least `max_limit`.
+    """
+    decrease_interval = 1.0
+    baseline_drift = 0.01
+    latency_backoff = 0.9
+    error_backoff = 0.5
+
+    def __init__(self, min_limit: int = API_CONCURRENCY_MIN, initial_limit: int = API_CONCURRENCY_INITIAL,
+                 max_limit: int = API_CONCURRENCY_MAX, latency_tolerance: float = API_LATENCY_TOLERANCE,
+                 max_rps: float = API_MAX_RPS):
+        """
+        :param min_limit: The limit never drops below this number of requests.
+        :param initial_limit: The limit to start with.
+        :param max_limit: The limit never grows above this number of requests.
+        :param latency_tolerance: How many times slower than the baseline a request may be before it counts
+            as a congestion signal.
+        :param max_rps: Hard ceiling of requests started per second; 0 disables it.
+        """
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.initial_limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.max_rps = max_rps
+        self._reset()
+        after_fork(self._reset)
+
+    @property
+    def limit(self) -> int:
+        """The current number of requests allowed in flight."""
+        return int(self._limit)
+
+    def acquire(self):
+        """Blocks until a slot is free and the requests-per-second ceiling allows another request."""
+        started = time.perf_counter()
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self._in_flight)
+            delay = self._reserve_start()
+
+        if delay > 0:
+            time.sleep(delay)
+        metrics.observe('api_slot_wait_seconds', time.perf_counter() - started)
+
+    def release(self, endpoint: str, latency: float, throttled: bool):
+        """
+        Frees a slot and adjusts the limit.
+
+        :param endpoint: The endpoint name, e.g. `detail`; latencies are compared per endpoint.
+        :param latency: Duration of the request in seconds.
+        :param throttled: Whether the API pushed back: 429, 5xx, a connection error or a timeout.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            previous = self._limit
+
+            baseline = self._baselines.get(endpoint)
+            slow = baseline is not None and latency > baseline * self.latency_tolerance
+            if baseline is None or latency < baseline:
+                self._baselines[endpoint] = latency
+            else:
+                self._baselines[endpoint] = baseline + (latency - baseline) * self.baseline_drift
+
+            if throttled or slow:
+                now = time.monotonic()
+                if now - self._decreased_at >= self.decrease_interval:
+                    self._decreased_at = now
+                    backoff = self.error_backoff if throttled else self.latency_backoff
+                    self._limit = max(self.min_limit, self._limit * backoff)
+                    self.counters['decreases'] += 1
+                if throttled:
+                    self.counters['throttled'] += 1
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+            self.peak_limit = max(self.peak_limit, int(self._limit))
+            if int(self._limit) != int(previous):
+                logger.debug(f'DIIA API concurrency limit: {int(previous)} -> {int(self._limit)}')
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the current and peak concurrency.
+
+        :return dict: The current limit and in-flight requests, their peaks, the number of pushed-back
+            requests and of limit decreases.
+        """
+        with self._condition:
+            return {'limit': int(self._limit), 'in_flight': self._in_flight, 'peak_limit': self.peak_limit,
+                    'peak_in_flight': self.peak_in_flight, 'throttled': self.counters['throttled'],
+                    'decreases': self.counters['decreases']}
+
+    def _reserve_start(self) -> float:
+        """
+        Reserves the next start time allowed by the requests-per-second ceiling. Called under the lock.
+
+        :return float: Seconds to wait before starting the request.
+        """
+        if self.max_rps <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        start = max(now, self._next_start)
+        self._next_start = start + 1 / self.max_rps
+        return start - now
+
+    def set_share(self, max_limit: int, max_rps: float):
+        """
+        Lowers the ceilings to the share of one of several processes calling the API, and starts over.
+
+        :param max_limit: The share of `max_limit`; the minimum and initial limits are clamped to it.
+        :param max_rps: The share of `max_rps`; 0 disables the ceiling.
+        """
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = min(self.min_limit, self.max_limit)
+        self.initial_limit = min(self.initial_limit, self.max_limit)
+        self.max_rps = max_rps
+        self._reset()
+
+    def _reset(self):
+        """Starts from the initial limit; also gives a forked child process its own lock and counters."""
+        self._condition = threading.Condition()
+        self._limit = float(self.initial_limit)
+        self._in_flight = 0
+        self._baselines: Dict[str, float] = {}
+        self._decreased_at = 0.0
+        self._next_start = 0.0
+        self.peak_limit = self.initial_limit
+        self.peak_in_flight = 0
+        self.counters = {'throttled': 0, 'decreases': 0}
+
+
+api_limiter = AdaptiveLimiter()
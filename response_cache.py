@@ -0,0 +1,180 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Dict, NamedTuple, Optional
+
+from forking import after_fork
+from settings import HTTP_CACHE_MAX_BYTES, HTTP_CACHE_MAX_ENTRIES, HTTP_CACHE_OFFLINE, HTTP_CACHE_PATH, HTTP_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+
+class ResponseCache:
+    """
+    An on-disk cache of DIIA API response bodies keyed by URL, stored in SQLite.
+
+    Entries younger than `ttl` are served without a request. Older entries are kept for revalidation: if
+    the API sent an `ETag` or `Last-Modified` header, the next request is made conditional and a
+    `304 Not Modified` answer is served from the cache. When the bodies take more than `max_bytes` or there
+    are more than `max_entries` entries, the least recently used ones are evicted: region pages and detail
+    bodies differ in size by orders of magnitude, so only the byte budget bounds the disk space. In offline
+    mode only the cache is used, regardless of age.
+
+    The cache is disabled when `path` is empty. Every thread opens its own connection, so one cache file
+    can be shared by the threads and the sharded workers.
+
+    Attributes:
+        counters (Counter): Number of `hits`, `revalidated`, `misses` and `stores`.
+    """
+    evict_every = 100
+
+    def __init__(self, path: str = HTTP_CACHE_PATH, ttl: float = HTTP_CACHE_TTL,
+                 max_entries: int = HTTP_CACHE_MAX_ENTRIES, max_bytes: int = HTTP_CACHE_MAX_BYTES,
+                 offline: bool = HTTP_CACHE_OFFLINE):
+        """
+        :param path: Path to the SQLite file, or an empty string to disable the cache.
+        :param ttl: Number of seconds an entry is served without revalidation.
+        :param max_entries: Maximum number of cached responses.
+        :param max_bytes: Maximum total size of the cached bodies.
+        :param offline: Serve only from the cache, never touching the network.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stores_since_eviction = 0
+        after_fork(self._reset_after_fork)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """
+        Looks up a cached response and marks it as recently used.
+
+        :param url: The request URL.
+
+        :return CachedResponse: The cached response, or None if the URL is not cached.
+        """
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+
+        connection.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        return CachedResponse(*row)
+
+    def is_fresh(self, cached: CachedResponse) -> bool:
+        """
+        Tells whether a cached response can be served without asking the API.
+
+        :param cached: The cached response.
+
+        :return bool: True in offline mode or if the entry is younger than the TTL.
+        """
+        return self.offline or time.time() - cached.stored_at < self.ttl
+
+    def set(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """
+        Stores a response body, replacing an older one.
+
+        :param url: The request URL.
+        :param body: The raw response body.
+        :param etag: The `ETag` header of the response.
+        :param last_modified: The `Last-Modified` header of the response.
+        """
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO responses (url, body, size, etag, last_modified, stored_at, accessed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (url, body, len(body), etag, last_modified, now, now))
+        self.count('stores')
+
+        with self._lock:
+            self._stores_since_eviction += 1
+            evict = self._stores_since_eviction >= self.evict_every
+            if evict:
+                self._stores_since_eviction = 0
+        if evict:
+            self.evict()
+
+    def touch(self, url: str):
+        """
+        Restarts the TTL of an entry the API confirmed as not modified.
+
+        :param url: The request URL.
+        """
+        self._connection().execute('UPDATE responses SET stored_at = ? WHERE url = ?', (time.time(), url))
+
+    def delete(self, url: str):
+        """
+        Drops an entry.
+
+        :param url: The request URL.
+        """
+        self._connection().execute('DELETE FROM responses WHERE url = ?', (url,))
+
+    def evict(self):
+        """Deletes the least recently used entries that do not fit into `max_bytes` and `max_entries`."""
+        deleted = self._connection().execute(
+            'DELETE FROM responses WHERE url IN (SELECT url FROM ('
+            'SELECT url, SUM(size) OVER recent AS total, ROW_NUMBER() OVER recent AS position FROM responses '
+            'WINDOW recent AS (ORDER BY accessed_at DESC, url)) WHERE total > ? OR position > ?)',
+            (self.max_bytes, self.max_entries)).rowcount
+        if deleted:
+            logger.debug(f'Evicted {deleted} cached responses.')
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns a snapshot of the cache counters.
+
+        :return dict: Number of hits, revalidated entries, misses and stored responses.
+        """
+        with self._lock:
+            return {name: self.counters[name] for name in ('hits', 'revalidated', 'misses', 'stores')}
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'url TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, etag TEXT, last_modified TEXT, '
+                'stored_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            if 'size' not in {column[1] for column in connection.execute('PRAGMA table_info(responses)')}:
+                # A cache file written before the byte budget.
+                connection.execute('ALTER TABLE responses ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+                connection.execute('UPDATE responses SET size = length(body)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+            self._local.connection = connection
+        return connection
+
+    def _reset_after_fork(self):
+        """Makes a forked child process open its own SQLite connections instead of sharing the parent's."""
+        self._local = threading.local()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+
+response_cache = ResponseCache()
@@ -2,6 +2,55 @@ import os
 
 DIIA_API_URL=os.environ.get('DIIA_API_URL')
 
+API_CONCURRENCY_MIN=int(os.getenv('API_CONCURRENCY_MIN', 1))
+API_CONCURRENCY_INITIAL=int(os.getenv('API_CONCURRENCY_INITIAL', 4))
+API_CONCURRENCY_MAX=int(os.getenv('API_CONCURRENCY_MAX', 12))
+API_LATENCY_TOLERANCE=float(os.getenv('API_LATENCY_TOLERANCE', 3))
+API_MAX_RPS=float(os.getenv('API_MAX_RPS', 0))
+
+# The detail pool caps the API concurrency from above, so it defaults to the limiter's ceiling.
+DETAIL_FETCH_CONCURRENCY=int(os.getenv('DETAIL_FETCH_CONCURRENCY', API_CONCURRENCY_MAX))
+ENTRIES_FETCH_CONCURRENCY=int(os.getenv('ENTRIES_FETCH_CONCURRENCY', 4))
+PIPELINE_QUEUE_SIZE=int(os.getenv('PIPELINE_QUEUE_SIZE', 256))
+API_STREAM_RESULTS=os.getenv('API_STREAM_RESULTS', '0') == '1'
+
+SYNC_WRITE_MODE=os.getenv('SYNC_WRITE_MODE', 'orm')
+TSNAP_WRITE_BATCH_SIZE=int(os.getenv('TSNAP_WRITE_BATCH_SIZE', 500))
+SYNC_COMMIT_BATCH_SIZE=int(os.getenv('SYNC_COMMIT_BATCH_SIZE', 0))
+LOOKUP_CACHE_MAX_ENTRIES=int(os.getenv('LOOKUP_CACHE_MAX_ENTRIES', 100000))
+SYNC_WORKER_PROCESSES=int(os.getenv('SYNC_WORKER_PROCESSES', 1))
+BACKFILL_QUARTER_CONCURRENCY=int(os.getenv('BACKFILL_QUARTER_CONCURRENCY', 2))
+SNAPSHOT_EXPORT_CONCURRENCY=int(os.getenv('SNAPSHOT_EXPORT_CONCURRENCY', 2))
+DAEMON_POLL_INTERVAL=float(os.getenv('DAEMON_POLL_INTERVAL', 3600))
+DAEMON_REFRESH_RATE=float(os.getenv('DAEMON_REFRESH_RATE', 1))
+DAEMON_TICK_SECONDS=float(os.getenv('DAEMON_TICK_SECONDS', 10))
+DAEMON_MIN_REFRESH_AGE=float(os.getenv('DAEMON_MIN_REFRESH_AGE', 21600))
+
+HTTP_POOL_SIZE=int(os.getenv('HTTP_POOL_SIZE', 16))
+HTTP_MAX_RETRIES=int(os.getenv('HTTP_MAX_RETRIES', 5))
+HTTP_BACKOFF_BASE=float(os.getenv('HTTP_BACKOFF_BASE', 0.5))
+HTTP_BACKOFF_MAX=float(os.getenv('HTTP_BACKOFF_MAX', 60))
+HTTP_DEFAULT_TIMEOUT=float(os.getenv('HTTP_DEFAULT_TIMEOUT', 30))
+HTTP_CACHE_PATH=os.getenv('HTTP_CACHE_PATH', '')
+HTTP_CACHE_TTL=float(os.getenv('HTTP_CACHE_TTL', 86400))
+HTTP_CACHE_MAX_ENTRIES=int(os.getenv('HTTP_CACHE_MAX_ENTRIES', 200000))
+HTTP_CACHE_MAX_BYTES=int(os.getenv('HTTP_CACHE_MAX_BYTES', 1024 ** 3))
+HTTP_CACHE_OFFLINE=os.getenv('HTTP_CACHE_OFFLINE', '0') == '1'
+HTTP_TIMEOUTS={
+    'list': float(os.getenv('HTTP_TIMEOUT_LIST', 30)),
+    'entries': float(os.getenv('HTTP_TIMEOUT_ENTRIES', 30)),
+    'detail': float(os.getenv('HTTP_TIMEOUT_DETAIL', 15)),
+}
+
+METRICS_JSON_PATH=os.getenv('METRICS_JSON_PATH', './metrics.json')
+METRICS_PROMETHEUS_PATH=os.getenv('METRICS_PROMETHEUS_PATH', '')
+SQL_AUDIT=os.getenv('SQL_AUDIT', '0') == '1'
+SQL_STATEMENT_BUDGET_PER_TSNAP=float(os.getenv('SQL_STATEMENT_BUDGET_PER_TSNAP', 0))
+PROFILE=os.getenv('PROFILE', '0') == '1'
+PROFILE_INTERVAL=float(os.getenv('PROFILE_INTERVAL', 0.01))
+PROFILE_OUTPUT_PATH=os.getenv('PROFILE_OUTPUT_PATH', './profile.collapsed')
+PROFILE_TOP_N=int(os.getenv('PROFILE_TOP_N', 20))
+
 POSTGRES_DB=os.getenv('POSTGRES_DB')
 POSTGRES_USER=os.getenv('POSTGRES_USER')
 POSTGRES_PASSWORD=os.getenv('POSTGRES_PASSWORD')
@@ -9,3 +58,11 @@ POSTGRES_HOST=os.getenv('POSTGRES_HOST', 'db')
 POSTGRES_PORT=os.getenv('POSTGRES_PORT', 5432)
 
 DATABASE_URL = f'postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}'
+DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW=int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT=float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE=int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING=os.getenv('DB_POOL_PRE_PING', '1') == '1'
+DB_EXECUTEMANY_MODE=os.getenv('DB_EXECUTEMANY_MODE', 'values_plus_batch')
+DB_EXECUTEMANY_PAGE_SIZE=int(os.getenv('DB_EXECUTEMANY_PAGE_SIZE', 500))
+DB_STREAM_BATCH_SIZE=int(os.getenv('DB_STREAM_BATCH_SIZE', 5000))
@@ -0,0 +1,148 @@
+import logging
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from forking import after_fork
+from settings import SQL_AUDIT
+
+logger = logging.getLogger(__name__)
+
+WRITTEN_TABLE = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)', re.IGNORECASE)
+
+
+class SQLAudit:
+    """
+    Counts the SQL statements an engine executes, by the entity being processed, and the rows written
+    to every table.
+
+    DAO methods are tagged with the entity they process (`tagged`), so that a statement is attributed to
+    the entity whose write caused it and statements per processed entity can be compared across write
+    modes and against a budget. Statements run outside any tagged method are attributed to 'other'.
+
+    The counters are flat, `statements/<entity>/<TYPE>`, `processed/<entity>` and `rows/<table>`, so that
+    the counters of several worker processes add up like the other summary counters.
+
+    Attributes:
+        counters (Counter): The counters.
+    """
+
+    def __init__(self, enabled: bool = SQL_AUDIT):
+        """
+        :param enabled: Count the statements of the engines passed to `install`.
+        """
+        self.enabled = enabled
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._entity: ContextVar[str] = ContextVar('sql_audit_entity', default='other')
+        after_fork(self._reset_after_fork)
+
+    def install(self, engine: Engine):
+        """
+        Starts counting the statements and commits of an engine, if the audit is enabled.
+
+        :param engine: The engine to watch.
+        """
+        if self.enabled and not event.contains(engine, 'after_cursor_execute', self._after_cursor_execute):
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(engine, 'commit', self._on_commit)
+
+    @contextmanager
+    def entity(self, name: str, processed: int = 0):
+        """
+        Attributes the statements of the enclosed block to an entity.
+
+        :param name: The entity, e.g. 'tsnap'.
+        :param processed: Number of entities the block processes.
+        """
+        self.count(f'processed/{name}', processed)
+        token = self._entity.set(name)
+        try:
+            yield
+        finally:
+            self._entity.reset(token)
+
+    def tagged(self, name: str, processed: Union[int, Callable[..., int]] = 1):
+        """
+        Decorator attributing the statements of every call of a method to an entity.
+
+        :param name: The entity, e.g. 'tsnap'.
+        :param processed: Number of entities a call processes, or a function of the call's first argument
+            after `self` returning it, e.g. `len` for a batch.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(obj, *args, **kwargs):
+                count = processed(args[0]) if callable(processed) else processed
+                with self.entity(name, count):
+                    return func(obj, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: int = 1):
+        if value:
+            with self._lock:
+                self.counters[name] += value
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns a snapshot of the counters.
+
+        :return dict: The counters; empty if the audit is disabled.
+        """
+        with self._lock:
+            return dict(self.counters)
+
+    def reset(self):
+        """Drops all counts."""
+        with self._lock:
+            self.counters.clear()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        entity = self._entity.get()
+        with self._lock:
+            self.counters[f'statements/{entity}/{statement.lstrip().split(None, 1)[0].upper()}'] += 1
+            written = WRITTEN_TABLE.match(statement)
+            if written and cursor.rowcount > 0:
+                self.counters[f'rows/{written.group(1)}'] += cursor.rowcount
+
+    def _on_commit(self, conn):
+        self.count(f'statements/{self._entity.get()}/COMMIT')
+
+    def _reset_after_fork(self):
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+
+def per_entity(stats: Dict[str, int]) -> Dict[str, dict]:
+    """
+    Groups the statement counters of `SQLAudit.stats` by entity.
+
+    :param stats: The counters.
+
+    :return dict: For every entity, the processed count, the statements by type, their total and the
+        statements per processed entity (None if nothing was counted as processed).
+    """
+    entities = {}
+    for key, value in stats.items():
+        kind, _, rest = key.partition('/')
+        if kind == 'statements':
+            name, _, statement_type = rest.partition('/')
+            entities.setdefault(name, {'processed': 0, 'statements': {}})['statements'][statement_type] = value
+        elif kind == 'processed':
+            entities.setdefault(rest, {'processed': 0, 'statements': {}})['processed'] = value
+
+    for entity in entities.values():
+        entity['total'] = sum(entity['statements'].values())
+        entity['per_item'] = round(entity['total'] / entity['processed'], 2) if entity['processed'] else None
+    return entities
+
+
+sql_audit = SQLAudit()
@@ -0,0 +1,46 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from apps.static_report import utils
+from apps.static_report.utils import get_current_quarter, parse_quarter, parse_quarter_range, quarter_range
+
+
+def freeze_now(monkeypatch, now: datetime.datetime):
+    monkeypatch.setattr(utils, 'datetime', SimpleNamespace(datetime=SimpleNamespace(now=lambda: now)))
+
+
+@pytest.mark.parametrize('month, quarter', [(1, 1), (2, 1), (3, 1), (4, 2), (5, 2), (6, 2),
+                                            (7, 3), (8, 3), (9, 3), (10, 4), (11, 4), (12, 4)])
+def test_get_current_quarter(monkeypatch, month, quarter):
+    freeze_now(monkeypatch, datetime.datetime(2024, month, 15))
+    assert get_current_quarter() == quarter
+
+
+@pytest.mark.parametrize('now, quarter', [(datetime.datetime(2023, 12, 31, 23, 59, 59), (2023, 4)),
+                                          (datetime.datetime(2024, 1, 1, 0, 0, 0), (2024, 1))])
+def test_current_quarter_at_year_boundary(monkeypatch, now, quarter):
+    freeze_now(monkeypatch, now)
+    assert (utils.get_current_year(), get_current_quarter()) == quarter
+
+
+def test_parse_quarter():
+    assert parse_quarter('2024Q3') == (2024, 3)
+    assert parse_quarter('2024q1') == (2024, 1)
+    for value in ('2024Q0', '2024Q5', '2024', 'Q3', '2024-3'):
+        with pytest.raises(ValueError):
+            parse_quarter(value)
+
+
+def test_quarter_range_crosses_years():
+    assert quarter_range((2023, 3), (2024, 2)) == [(2023, 3), (2023, 4), (2024, 1), (2024, 2)]
+    assert quarter_range((2024, 2), (2024, 2)) == [(2024, 2)]
+    assert quarter_range((2024, 1), (2023, 4)) == []
+
+
+def test_parse_quarter_range():
+    assert parse_quarter_range('2023Q4:2024Q1') == [(2023, 4), (2024, 1)]
+    assert parse_quarter_range('2024Q2') == [(2024, 2)]
+    with pytest.raises(ValueError):
+        parse_quarter_range('2024Q1:2023Q4')